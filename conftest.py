@@ -1,32 +1,32 @@
 import pytest
-from mock import sentinel
 import mock
 
 
-class MockSock(object):
+@pytest.fixture(autouse=True)
+def dibctl_cache_dir(tmpdir, monkeypatch):
+    monkeypatch.setenv('DIBCTL_CACHE_DIR', str(tmpdir.join('dibctl_cache')))
+    return tmpdir.join('dibctl_cache')
 
-    def __init__(self, sequence):
-        self.sequence = sequence
 
-    AF_INET = sentinel.AF_INET
-    SOCK_STREAM = sentinel.SOCK_STREAM
+class MockProbe(object):
 
-    def socket(self, arg1, arg2):
-        assert arg1 is self.AF_INET
-        assert arg2 is self.SOCK_STREAM
-        return self
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.CONNECT_TIMEOUT = 3
 
-    def connect_ex(self, ip):
+    def probe(self, addresses, port, timeout, banner=None):
         next = self.sequence[0]
         if next is None:
-            return -1  # Loop forever with None
+            return None  # Loop forever with None
         self.sequence = self.sequence[1:]
-        return next
+        if next == 0:
+            return addresses[0]
+        return None
 
 
 @pytest.fixture(scope="module")
-def MockSocket(request):
-    return MockSock
+def MockPortProbe(request):
+    return MockProbe
 
 
 class MockTimeClass(object):
@@ -47,12 +47,14 @@ def MockTime(request):
 
 
 @pytest.fixture
-def quick_commands(MockSocket, MockTime):
+def quick_commands(MockPortProbe, MockTime):
     def full_read(ignore_self, filename):
         return open(filename, 'rb', buffering=65536).read()
     from dibctl import commands
     with mock.patch.object(commands.prepare_os, "time", MockTime()):
-        with mock.patch.object(commands.prepare_os, "socket", MockSocket([0])):
+        with mock.patch.object(
+            commands.prepare_os, "port_probe", MockPortProbe([0])
+        ):
             with mock.patch.object(
                 commands.prepare_os.uuid,
                 "uuid4",
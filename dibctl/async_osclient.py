@@ -0,0 +1,110 @@
+import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import parallel
+import timeout
+
+'''Non-blocking facade for OSClient'''
+
+DEFAULT_WORKERS = 16
+
+
+class AsyncOSClient(object):
+    '''
+        Runs OSClient calls in a shared thread pool. Each method
+        from ASYNC_METHODS returns AsyncResult immediately
+        (use .get() to wait for the value or the exception), so
+        many boots, polls and deletions may be in flight at once.
+        All calls share auth (token) and http session of the
+        wrapped OSClient, and connection pool of that session is
+        limited to the number of workers (unless limit_pool is False,
+        f.e. when caller keeps using OSClient directly as well).
+    '''
+
+    ASYNC_METHODS = (
+        'new_keypair',
+        'delete_keypair',
+        'boot_instance',
+        'get_instance',
+        'delete_instance',
+        'upload_image',
+        'get_image',
+        'delete_image',
+        'fuzzy_find_flavor',
+        'get_flavor',
+    )
+
+    def __init__(self, os_client, workers=DEFAULT_WORKERS, limit_pool=True):
+        self.os = os_client
+        self.workers = workers
+        if limit_pool:
+            self.os.set_connection_pool(workers)
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def _get_pool(self):
+        with self.lock:
+            if not self.pool:
+                self.pool = ThreadPool(self.workers)
+            return self.pool
+
+    def submit(self, func, *args, **kwargs):
+        '''runs func(*args, **kwargs) in the pool, returns AsyncResult'''
+        return self._get_pool().apply_async(func, args, kwargs)
+
+    def __getattr__(self, name):
+        if name not in self.ASYNC_METHODS:
+            raise AttributeError(name)
+        method = getattr(self.os, name)
+
+        def call(*args, **kwargs):
+            return self.submit(method, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    @staticmethod
+    def wait(results, timeout_s=None, started=None):
+        '''
+            waits for all AsyncResults (up to timeout_s seconds since
+            'started', default is now), returns list of parallel.Result
+            (value or error for each of them), error of unfinished
+            call is TimeoutError
+        '''
+        deadline = None
+        if timeout_s is not None:
+            deadline = (started or time.time()) + timeout_s
+        collected = []
+        for index, result in enumerate(results):
+            limit = parallel.WAIT_FOREVER
+            if deadline is not None:
+                limit = max(0, deadline - time.time())
+            try:
+                collected.append(parallel.Result(index, result.get(limit), None))
+            except multiprocessing.TimeoutError:
+                collected.append(parallel.Result(index, None, timeout.TimeoutError(
+                    "Timed out after %s" % timeout_s
+                )))
+            except Exception as e:
+                collected.append(parallel.Result(index, None, e))
+        return collected
+
+    def close(self, wait=True):
+        '''
+            without wait calls which are still running are abandoned
+            (their threads are left to finish on their own)
+        '''
+        with self.lock:
+            if self.pool:
+                if wait:
+                    self.pool.close()
+                    self.pool.join()
+                else:
+                    self.pool.terminate()
+                self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(wait=exc_type is None)
@@ -0,0 +1,78 @@
+import os
+import time
+import fcntl
+import contextlib
+import cache
+
+'''
+    Persistent cache of keystone discovery results and
+    authentication state (token with service catalog),
+    shared by consecutive dibctl runs.
+'''
+
+AUTH_CACHE_FILE_NAME = 'auth_cache.json'
+VERSION_TTL = 24 * 3600
+
+
+InsecureCacheError = cache.InsecureCacheError
+
+
+class AuthCache(object):
+    '''
+        All changes are done under exclusive lock (lock file
+        near cache file). Cache is ignored if it (or it's directory)
+        is accessible by anyone but owner.
+        Auth state is stored by keystoneauth cache id of the
+        auth plugin (hash of auth_url, project, user, password, etc),
+        tokens are reused until expiration (keystoneauth reauthenticates
+        expired tokens and on 401 by itself).
+    '''
+
+    def __init__(self, cache_file=None):
+        if not cache_file:
+            cache_file = os.path.join(cache.cache_dir(), AUTH_CACHE_FILE_NAME)
+        self.cache_file = cache_file
+        self.lock_file = cache_file + '.lock'
+
+    check_permissions = staticmethod(cache.check_permissions)
+
+    @contextlib.contextmanager
+    def locked(self):
+        directory = os.path.dirname(os.path.abspath(self.cache_file))
+        self.check_permissions(directory, 0o022)
+        self.check_permissions(self.cache_file, 0o077)
+        self.check_permissions(self.lock_file, 0o022)
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield cache.load_json(self.cache_file, {})
+        finally:
+            os.close(fd)
+
+    def _load(self):
+        with self.locked() as data:
+            return data
+
+    def _update(self, section, key, value):
+        with self.locked() as data:
+            data.setdefault(section, {})[key] = value
+            cache.save_json(self.cache_file, data)
+
+    def get_version(self, auth_url):
+        record = self._load().get('versions', {}).get(auth_url)
+        if record and time.time() - record['timestamp'] < VERSION_TTL:
+            return record['version']
+        return None
+
+    def set_version(self, auth_url, version):
+        self._update(
+            'versions',
+            auth_url,
+            {'version': version, 'timestamp': time.time()}
+        )
+
+    def get_auth_state(self, cache_id):
+        return self._load().get('auth', {}).get(cache_id)
+
+    def set_auth_state(self, cache_id, state):
+        self._update('auth', cache_id, state)
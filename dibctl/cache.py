@@ -0,0 +1,131 @@
+import os
+import json
+import fcntl
+import cPickle as pickle
+import tempfile
+import contextlib
+
+'''Local on-disk cache for dibctl (upload state, hashes, etc)'''
+
+CACHE_DIR_ENV = 'DIBCTL_CACHE_DIR'
+
+
+class InsecureCacheError(EnvironmentError):
+    pass
+
+
+def cache_dir(*subdirs):
+    '''
+        returns path to the dibctl cache directory (or it's subdirectory),
+        creating it if needed. DIBCTL_CACHE_DIR environment variable
+        overrides default location (~/.cache/dibctl)
+    '''
+    base = os.environ.get(CACHE_DIR_ENV)
+    if not base:
+        xdg = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(
+            '~/.cache'
+        )
+        base = os.path.join(xdg, 'dibctl')
+    return ensure_dir(os.path.join(base, *subdirs))
+
+
+def ensure_dir(path):
+    '''creates directory (accessible only by owner) if needed'''
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def _check_stat(path, stat, forbidden_mode):
+    if stat.st_uid != os.getuid() or stat.st_mode & forbidden_mode:
+        raise InsecureCacheError(
+            "%s should be owned by the current user and have mode "
+            "without %s bits set" % (path, oct(forbidden_mode))
+        )
+
+
+def check_permissions(path, forbidden_mode):
+    '''
+        raises InsecureCacheError if existing path is not owned by
+        the current user or has any of forbidden_mode bits set
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    _check_stat(path, stat, forbidden_mode)
+
+
+def load_json(filename, default=None):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def load_pickle(filename, default=None):
+    '''
+        unpickles filename, file (and it's directory) writable by
+        anyone but owner is ignored, as unpickling runs code
+    '''
+    try:
+        directory = os.path.dirname(os.path.abspath(filename))
+        check_permissions(directory, 0o022)
+        with open(filename, 'rb') as f:
+            _check_stat(filename, os.fstat(f.fileno()), 0o077)
+            return pickle.load(f)
+    except InsecureCacheError as e:
+        print("Ignoring cache: %s" % e)
+        return default
+    except Exception:
+        return default
+
+
+def _save(filename, data, dump, mode='w'):
+    '''
+        atomically replaces filename with dump of data.
+        File is readable only by owner.
+    '''
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(prefix='.tmp_', dir=directory)
+    try:
+        with os.fdopen(fd, mode) as f:
+            dump(data, f)
+        os.chmod(tmp_name, 0o600)
+        os.rename(tmp_name, filename)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def save_json(filename, data):
+    _save(filename, data, json.dump)
+
+
+def save_pickle(filename, data):
+    _save(
+        filename,
+        data,
+        lambda data, f: pickle.dump(data, f, pickle.HIGHEST_PROTOCOL),
+        'wb'
+    )
+
+
+@contextlib.contextmanager
+def locked_json(filename, default=None):
+    '''
+        loads json from filename under exclusive lock (flock on
+        filename + '.lock'), lock is held until the block exits.
+        Use save_json inside the block to change the file.
+    '''
+    fd = os.open(filename + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield load_json(filename, default)
+    finally:
+        os.close(fd)
@@ -1,16 +1,22 @@
 import argparse
 import config
 import os
-import dib
 import sys
-import osclient
-import do_tests
-import prepare_os
 import version
-import image_preprocessing
-from keystoneauth1 import exceptions as keystone_exceptions
-from novaclient import exceptions as novaclient_exceptions
-from glanceclient import exc as glanceclient_exceptions
+import parallel
+import time
+import lazy_import
+
+# imported on first use: OpenStack clients, pytest and paramiko
+# are not needed for build, validate and help
+dib = lazy_import.module('dib', globals())
+osclient = lazy_import.module('osclient', globals())
+do_tests = lazy_import.module('do_tests', globals())
+prepare_os = lazy_import.module('prepare_os', globals())
+matrix = lazy_import.module('matrix', globals())
+instance_pool = lazy_import.module('instance_pool', globals())
+image_preprocessing = lazy_import.module('image_preprocessing', globals())
+image_upload = lazy_import.module('image_upload', globals())
 
 
 class PrematureExitError(SystemExit):
@@ -29,6 +35,62 @@ class NotFoundInConfigError(PrematureExitError):
     pass
 
 
+class UploadFailedError(PrematureExitError):
+    pass
+
+
+class RotateFailedError(PrematureExitError):
+    pass
+
+
+def connect(upload_env, glance_data, debug=False):
+    return osclient.OSClient(
+        keystone_data=upload_env['keystone'],
+        nova_data={},
+        glance_data=glance_data,
+        neutron_data={},
+        overrides=os.environ,
+        ca_path=upload_env.get('ssl_ca_path', '/etc/ssl/cacerts'),
+        insecure=upload_env.get('ssl_insecure', False),
+        disable_warnings=upload_env.get('disable_warnings', False),
+        debug=debug,
+        use_auth_cache=upload_env.get('auth_cache', False)
+    )
+
+
+def run_with_pool(command, dt, run, success=bool):
+    '''
+        Returns result of run(). With --from-pool run() uses idle
+        instance from the pool (if there is one), which is returned
+        to the pool if success(result) is true, or removed otherwise.
+    '''
+    if not command.args.from_pool or command.args.instance:
+        return run()
+    pool = instance_pool.InstancePool()
+    record = instance_pool.lease(
+        pool,
+        pool.pool_name(command.args.imagelabel, command.env_label),
+        dt,
+        command.args.uuid,
+        command.image
+    )
+    if not record:
+        return run()
+    succeeded = False
+    try:
+        result = run()
+        succeeded = success(result)
+        return result
+    finally:
+        instance_pool.give_back(
+            pool,
+            record,
+            succeeded,
+            command.test_env,
+            keep=getattr(command.args, 'keep_failed_instance', False)
+        )
+
+
 class GenericCommand(object):
     # An abstract class, shouldn't be used directly
     options = []
@@ -39,10 +101,13 @@ class GenericCommand(object):
     # 'upload-confg',
     # 'test-env-config',
     # 'imagelabel',
+    # 'imagelabels',
     # 'uploadlabel',
+    # 'uploadlabels',
     name = 'generic'
     help = 'replace me'
     image = None
+    lazy_config = True  # validate only used entries of configs
 
     def __init__(self, subparser):
         self.parser = subparser.add_parser(self.name, help=self.help)
@@ -68,8 +133,12 @@ class GenericCommand(object):
             self.parser.add_argument('--test-config', help='Name of custom test.yaml')
         if 'imagelabel' in self.options:
             self.parser.add_argument('imagelabel', help='Label of image in the images.yaml')
+        if 'imagelabels' in self.options:
+            self.parser.add_argument('imagelabels', nargs='*', help='Labels of images in the images.yaml')
         if 'uploadlabel' in self.options:
             self.parser.add_argument('envlabel', help='Use given environment from upload.yaml')
+        if 'uploadlabels' in self.options:
+            self.parser.add_argument('envlabels', nargs='+', help='Use given environments from upload.yaml')
         self.add_options()
         self.parser.set_defaults(command=self.command)
 
@@ -78,41 +147,43 @@ class GenericCommand(object):
         if 'img-config' in self.options:
             self.image_config = config.ImageConfig(
                 config_file=self.args.images_config,
-                override_filename=self.args.filename
+                override_filename=self.args.filename,
+                lazy=self.lazy_config
             )
         if 'img-config-no-file' in self.options:
             self.image_config = config.ImageConfig(
-                config_file=self.args.images_config
+                config_file=self.args.images_config,
+                lazy=self.lazy_config
             )
         if 'upload-config' in self.options:
             self.upload_config = config.UploadEnvConfig(
-                config_file=self.args.upload_config
+                config_file=self.args.upload_config,
+                lazy=self.lazy_config
             )
         if 'test-env-config' in self.options:
             self.test_env_config = config.TestEnvConfig(
-                config_file=self.args.test_config
+                config_file=self.args.test_config,
+                lazy=self.lazy_config
             )
         if 'imagelabel' in self.options:
             self.image = self.image_config[self.args.imagelabel]
         else:
             self.image = {}
+        if 'imagelabels' in self.options:
+            self.images = [
+                (label, self.image_config[label]) for label in self.args.imagelabels
+            ]
         if 'uploadlabel' in self.options:
             self.upload_env = self.upload_config[self.args.envlabel]
             self.glance_data = osclient.smart_join_glance_config(
                 self.image.get('glance', {}),
                 self.upload_env.get('glance', {})
             )
-            self.os = osclient.OSClient(
-                keystone_data=self.upload_env['keystone'],
-                nova_data={},
-                glance_data=self.glance_data,
-                neutron_data={},
-                overrides=os.environ,
-                ca_path=self.upload_env.get('ssl_ca_path', '/etc/ssl/cacerts'),
-                insecure=self.upload_env.get('ssl_insecure', False),
-                disable_warnings=self.upload_env.get('disable_warnings', False),
-                debug=self.args.debug
-            )
+            self.os = connect(self.upload_env, self.glance_data, self.args.debug)
+        if 'uploadlabels' in self.options:
+            self.upload_envs = [
+                (label, self.upload_config[label]) for label in self.args.envlabels
+            ]
         return self._command()
 
     def _command(self):
@@ -191,11 +262,38 @@ class TestCommand(GenericCommand):
             action='store_true',
             help="Do not remove instance and ssh key is test failed"
         )
+        self.parser.add_argument(
+            '--continue-on-fail',
+            action='store_true',
+            help="Run the rest of tests after a test failure"
+        )
         self.parser.add_argument(
             '--shell',
             action='store_true',
             help="Open ssh shell to the server if some test failed and there is ssh config for image"
         )
+        self.parser.add_argument(
+            '--matrix',
+            action='store_true',
+            help='Test in all environments (flavors, zones) from tests.matrix section of images.yaml concurrently'
+        )
+        self.parser.add_argument(
+            '--environments',
+            nargs='+',
+            dest='matrix_envs',
+            help='Test concurrently in given environments (override environments of tests.matrix)'
+        )
+        self.parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,  # matrix.DEFAULT_WORKERS, not imported just for parser
+            help='Number of concurrent test runs per cloud in matrix mode (default: %(default)s)'
+        )
+        self.parser.add_argument(
+            '--from-pool',
+            action='store_true',
+            help='Use idle pre-booted instance from the pool (see "dibctl pool"), return it after successful tests'
+        )
 
     def _prepare(self):
         tests = self.image.get('tests', None)
@@ -206,9 +304,48 @@ class TestCommand(GenericCommand):
         env_label = self.args.envlabel or tests.get('environment_name', None)
         if not env_label:
             raise TestEnvironmentNotFoundError('No environment name for tests were no given in config or command line')
+        self.env_label = env_label
         self.test_env = self.test_env_config[env_label]
 
+    def _matrix_cells(self):
+        tests = self.image.get('tests', None)
+        if not tests:
+            raise NoTestsError(
+                'No tests section was defined for image %s in the image config. Abort.' % self.args.imagelabel
+            )
+        matrix_cfg = tests.get('matrix', None) or {}
+        env_labels = self.args.matrix_envs or matrix_cfg.get('environments', None)
+        if not env_labels:
+            raise TestEnvironmentNotFoundError('No environments for test matrix were given in config or command line')
+        return matrix.make_cells(
+            self.test_env_config,
+            env_labels,
+            matrix_cfg.get('flavors', None),
+            matrix_cfg.get('availability_zones', None)
+        )
+
+    def _matrix_command(self):
+        if self.args.uuid or self.args.instance or self.args.upload_only or self.args.shell:
+            self.parser.error(
+                'matrix mode does not support --use-existing-image, '
+                '--use-existing-instance, --upload-only and --shell'
+            )
+        tm = matrix.TestMatrix(
+            self.image,
+            self._matrix_cells(),
+            workers=self.args.workers,
+            keep_failed_image=self.args.keep_failed_image,
+            keep_failed_instance=self.args.keep_failed_instance,
+            continue_on_fail=self.args.continue_on_fail
+        )
+        if tm.run():
+            return 0
+        else:
+            return 80
+
     def _command(self):
+        if self.args.matrix or self.args.matrix_envs:
+            return self._matrix_command()
         self._prepare()
         dt = do_tests.DoTests(
             self.image,
@@ -216,14 +353,19 @@ class TestCommand(GenericCommand):
             image_uuid=self.args.uuid,
             upload_only=self.args.upload_only,
             keep_failed_image=self.args.keep_failed_image,
-            keep_failed_instance=self.args.keep_failed_instance
+            keep_failed_instance=self.args.keep_failed_instance,
+            continue_on_fail=self.args.continue_on_fail
         )
         if self.args.instance:
             dt.reconfigure_for_existing_instance(
                 self.args.instance,
                 self.args.private_key_file
             )
-        status = dt.process(shell_only=False, shell_on_errors=self.args.shell)
+        status = run_with_pool(
+            self,
+            dt,
+            lambda: dt.process(shell_only=False, shell_on_errors=self.args.shell)
+        )
         if status:
             return 0
         else:
@@ -256,6 +398,11 @@ class ShellCommand(GenericCommand):
             help='Use private key file for tests (existing instance only)',
             dest='private_key_file'
         )
+        self.parser.add_argument(
+            '--from-pool',
+            action='store_true',
+            help='Use idle pre-booted instance from the pool (see "dibctl pool") and return it back after shell'
+        )
 
     def _prepare(self):
         env_label = self.image.get(
@@ -265,6 +412,7 @@ class ShellCommand(GenericCommand):
                 'No environemnt name for tests were no given '
                 'in config or command line'
             )
+        self.env_label = env_label
         self.test_env = self.test_env_config[env_label]
 
     def _command(self):
@@ -282,26 +430,128 @@ class ShellCommand(GenericCommand):
                 self.args.instance, self.args.private_key_file
             )
         try:
-            status = dt.process(shell_only=True, shell_on_errors=False)
+            status = run_with_pool(
+                self,
+                dt,
+                lambda: dt.process(shell_only=True, shell_on_errors=False),
+                success=lambda status: True
+            )
         except do_tests.TestError as e:
             print("Error on ssh: %s" % e)
             return 1
         return status
 
 
-class UploadCommand(GenericCommand):
-    name = 'upload'
-    help = 'Upload image'
-    options = ['imagelabel', 'input', 'img-config',
-               'upload-config', 'uploadlabel']
+class PoolCommand(GenericCommand):
+    name = 'pool'
+    help = 'Manage pool of pre-booted test instances'
+    options = ['input', 'img-config', 'test-env-config']
 
     def add_options(self):
         self.parser.add_argument(
-            '--no-obsolete', action='store_true',
-            help='Do not obsolete images with same name'
+            'action',
+            choices=['fill', 'list', 'reap'],
+            help='fill: boot instances into the pool, list: show pool, reap: remove idle instances'
+        )
+        self.parser.add_argument(
+            'imagelabel',
+            nargs='?',
+            help='Label of image in the images.yaml (for fill)'
+        )
+        self.parser.add_argument(
+            '--environment',
+            dest='envlabel',
+            help='Use given environment (override label from images.yaml)'
+        )
+        self.parser.add_argument(
+            '--size',
+            type=int,
+            default=1,
+            help='Number of instances to boot (default: %(default)s)'
+        )
+        self.parser.add_argument(
+            '--use-existing-image',
+            help='Boot instances from given image uuid instead of uploading image',
+            dest='uuid'
+        )
+        self.parser.add_argument(
+            '--ttl',
+            type=int,
+            default=3600,  # instance_pool.IDLE_TTL
+            help='Idle instances older than ttl seconds are not used and are removed by reap (default: %(default)s)'
+        )
+        self.parser.add_argument(
+            '--all',
+            action='store_true',
+            help='reap: remove all idle instances regardless of ttl'
         )
 
-    def _prepare(self):
+    def fill(self, pool):
+        if not self.args.imagelabel:
+            self.parser.error('fill requires image label')
+        image = self.image_config[self.args.imagelabel]
+        env_label = self.args.envlabel or image.get('tests.environment_name', None)
+        if not env_label:
+            raise TestEnvironmentNotFoundError('No environment name for tests were no given in config or command line')
+        results = instance_pool.fill(
+            pool,
+            self.args.imagelabel,
+            image,
+            env_label,
+            self.test_env_config[env_label],
+            self.args.size,
+            image_uuid=self.args.uuid
+        )
+        for result in results:
+            if result.error:
+                print("Unable to boot instance for the pool: %s" % result.error)
+            else:
+                print("Instance %s added to pool %s" % (
+                    result.value['instance_id'], result.value['pool']
+                ))
+        if any(result.error for result in results):
+            return 1
+        return 0
+
+    def list(self, pool):
+        now = time.time()
+        for record in pool.records():
+            print("%-30s %-36s %-6s %6d s idle" % (
+                record['pool'],
+                record['instance_id'],
+                'leased' if record['leased'] else 'idle',
+                now - record['last_used']
+            ))
+        return 0
+
+    def reap(self, pool):
+        results = instance_pool.reap(pool, self.test_env_config, self.args.all)
+        for result in results:
+            if result.error:
+                print("Error while removing instance %s: %s" % (
+                    result.item['instance_id'], result.error
+                ))
+        print("Removed %s instances" % len(results))
+        if any(result.error for result in results):
+            return 1
+        return 0
+
+    def _command(self):
+        pool = instance_pool.InstancePool(ttl=self.args.ttl)
+        return getattr(self, self.args.action)(pool)
+
+
+class UploadTarget(object):
+    '''Upload of the image into a single upload environment (region)'''
+
+    def __init__(self, label, upload_env, image, debug=False):
+        self.label = label
+        self.upload_env = upload_env
+        self.debug = debug
+        self.glance_data = osclient.smart_join_glance_config(
+            image.get('glance', {}),
+            upload_env.get('glance', {})
+        )
         try:
             self.name = self.glance_data['name']
         except KeyError as e:
@@ -318,42 +568,166 @@ class UploadCommand(GenericCommand):
         self.min_disk = self.glance_data.get('min_disk', 0)
         self.min_ram = self.glance_data.get('min_ram', 0)
         self.protected = self.glance_data.get('protected', False)
+        self.preprocessing = self.upload_env.get('preprocessing', {})
+        self.os = None
+        self.image = None
+
+    def same_upload_file(self, other):
+        '''True if both targets upload the same (preprocessed) file'''
+        return (
+            self.preprocessing == other.preprocessing and
+            self.disk_format == other.disk_format and
+            self.container_format == other.container_format
+        )
 
-    def upload_to_glance(self):
-        print("Uploading image")
-        with image_preprocessing.Preprocess(
-            input_filename=self.image['filename'],
-            glance_data=self.glance_data,
-            preprocessing_settings=self.upload_env.get('preprocessing', {})
-        ) as upload_filename:
-            self.image = self.os.upload_image(
-                self.name,
-                upload_filename,
-                self.public,
-                container_format=self.container_format,
-                disk_format=self.disk_format,
-                min_disk=self.min_disk,
-                min_ram=self.min_ram,
-                protected=self.protected,
-                meta=self.meta
-            )
-            print(
-                "Image ''%s' uploaded with uuid %s from file %s" % (
-                    self.image.name, self.image.id, upload_filename
-                )
+    def upload(self, upload_filename, source=None):
+        self.os = connect(self.upload_env, self.glance_data, self.debug)
+        self.image = self.os.upload_image(
+            self.name,
+            upload_filename,
+            self.public,
+            container_format=self.container_format,
+            disk_format=self.disk_format,
+            min_disk=self.min_disk,
+            min_ram=self.min_ram,
+            protected=self.protected,
+            meta=self.meta,
+            source=source
+        )
+        print(
+            "Image ''%s' uploaded with uuid %s from file %s into %s" % (
+                self.image.name, self.image.id, upload_filename, self.label
             )
+        )
 
     def obsolete_old_images(self):
         candidates = self.os.older_images(self.name, self.image.id)
         for img in candidates:
             obsolete_image = self.os.mark_image_obsolete(self.name, img)
-            print("Obsoleting %s" % obsolete_image.id)
+            print("Obsoleting %s in %s" % (obsolete_image.id, self.label))
+
+
+class UploadCommand(GenericCommand):
+    name = 'upload'
+    help = 'Upload image'
+    options = ['imagelabel', 'input', 'img-config',
+               'upload-config', 'uploadlabels']
+
+    def add_options(self):
+        self.parser.add_argument(
+            '--no-obsolete', action='store_true',
+            help='Do not obsolete images with same name'
+        )
+        self.parser.add_argument(
+            '--parallel', type=int, default=parallel.DEFAULT_WORKERS,
+            help='How many environments to upload concurrently (default %(default)s)'
+        )
+
+    def _prepare(self):
+        self.targets = [
+            UploadTarget(label, upload_env, self.image, self.args.debug)
+            for label, upload_env in self.upload_envs
+        ]
+
+    def group_targets(self):
+        '''groups targets which share the same file to upload'''
+        groups = []
+        for target in self.targets:
+            for group in groups:
+                if group[0].same_upload_file(target):
+                    group.append(target)
+                    break
+            else:
+                groups.append([target])
+        return groups
+
+    def upload_target(self, target, upload_filename, source=None):
+        target.upload(upload_filename, source)
+        if not self.args.no_obsolete:
+            target.obsolete_old_images()
+
+    def upload_batch(self, batch, upload_filename, source=None):
+        '''
+            uploads file to all targets in batch reading it only once.
+            source opens stream to read instead of file.
+        '''
+        if len(batch) == 1:
+            return parallel.run_parallel(
+                lambda target: self.upload_target(target, upload_filename, source),
+                batch
+            )
+        if source:
+            fileobj = source()
+        else:
+            fileobj = image_upload.open_source(upload_filename)
+        tee = image_upload.TeeReader(fileobj, len(batch))
+
+        def upload(pair):
+            target, consumer = pair
+            try:
+                self.upload_target(target, upload_filename, lambda: consumer)
+            finally:
+                consumer.close()
+        results = parallel.run_parallel(upload, zip(batch, tee.consumers), len(batch))
+        return [parallel.Result(r.item[0], r.value, r.error) for r in results]
+
+    def upload_group(self, group):
+        print("Uploading image to %s" % ", ".join(t.label for t in group))
+        results = []
+        preprocess = image_preprocessing.Preprocess(
+            input_filename=self.image['filename'],
+            glance_data=group[0].glance_data,
+            preprocessing_settings=group[0].preprocessing
+        )
+        try:
+            with preprocess as upload_filename:
+                if preprocess.source:
+                    batches = [group]  # stream can be read only once
+                else:
+                    batches = parallel.batches(group, self.args.parallel)
+                for batch in batches:
+                    results.extend(self.upload_batch(
+                        batch, upload_filename, preprocess.source
+                    ))
+        except image_preprocessing.PreprocessError as e:
+            done = set(r.item for r in results)
+            results.extend(
+                parallel.Result(t, None, e) for t in group if t not in done
+            )
+        return results
+
+    def report(self, results):
+        print("Upload summary:")
+        for result in results:
+            if result.error:
+                print("%s: FAILED: %s" % (result.item.label, result.error))
+            else:
+                print("%s: uploaded as %s" % (result.item.label, result.item.image.id))
+        failed = [r.item.label for r in results if r.error]
+        if failed:
+            raise UploadFailedError(
+                "Upload failed for %s of %s environments: %s" % (
+                    len(failed), len(results), ", ".join(failed)
+                )
+            )
 
     def _command(self):
         self._prepare()
-        self.upload_to_glance()
-        if not self.args.no_obsolete:
-            self.obsolete_old_images()
+        if len(self.targets) == 1:
+            print("Uploading image")
+            target = self.targets[0]
+            preprocess = image_preprocessing.Preprocess(
+                input_filename=self.image['filename'],
+                glance_data=target.glance_data,
+                preprocessing_settings=target.preprocessing
+            )
+            with preprocess as upload_filename:
+                self.upload_target(target, upload_filename, preprocess.source)
+            return 0
+        results = []
+        for group in self.group_targets():
+            results.extend(self.upload_group(group))
+        self.report(results)
         return 0
 
 
@@ -368,9 +742,30 @@ class RotateCommand(GenericCommand):
             action='store_true',
             help="Do not delete anything, just print candidates"
         )
+        self.parser.add_argument(
+            '--page-size',
+            type=int,
+            default=1000,  # osclient.OSClient.LIST_PAGE_SIZE
+            help="How many instances/images to request per API call (default %(default)s)"
+        )
+        self.parser.add_argument(
+            '--workers',
+            type=int,
+            default=parallel.DEFAULT_WORKERS,
+            help="How many images to delete concurrently (default %(default)s)"
+        )
 
-    def _command(self):
-        candidate_list = self.os.find_obsolete_unused_candidates()
+    def rotate(self, namefilter=None):
+        start = time.time()
+        candidate_list = self.os.find_obsolete_unused_candidates(
+            namefilter,
+            page_size=self.args.page_size
+        )
+        print("Listing took %.1f s" % (time.time() - start))
+        return self.remove(candidate_list)
+
+    def remove(self, candidate_list):
+        start = time.time()
         if not candidate_list:
             print("No unused obsolete images found.")
             return 0
@@ -380,37 +775,70 @@ class RotateCommand(GenericCommand):
             print("Images are obsolete and unused and will be removed:")
         for candidate in candidate_list:
             print("%s" % (candidate,))
-            if not self.args.dry_run:
-                self.os.delete_image(candidate)
+        if self.args.dry_run:
+            return 0
+        results = self.os.delete_images(candidate_list, self.args.workers)
+        failed = [r for r in results if r.error]
+        for result in failed:
+            print("Unable to remove %s: %s" % (result.item, result.error))
+        print("Removed %s of %s images in %.1f s" % (
+            len(results) - len(failed), len(results), time.time() - start
+        ))
+        if failed:
+            raise RotateFailedError(
+                "%s images were not removed" % len(failed)
+            )
         return 0
 
-class RotateSingleCommand(GenericCommand):
+    def _command(self):
+        return self.rotate()
+
+
+class RotateSingleCommand(RotateCommand):
     name = 'rotate-single'
-    help = 'Remove unused obsolete images for a specific label'
-    options = ['upload-config', 'uploadlabel', 'imagelabel', 'img-config-no-file']
+    help = 'Remove unused obsolete images for specific labels'
+    options = ['upload-config', 'uploadlabel', 'imagelabels', 'img-config-no-file']
 
     def add_options(self):
+        super(RotateSingleCommand, self).add_options()
         self.parser.add_argument(
-            '--dry-run',
+            '--all',
             action='store_true',
-            help="Do not delete anything, just print candidates"
+            help="Rotate images for all labels in images.yaml"
         )
 
+    def image_names(self):
+        if self.args.all == bool(self.images):
+            self.parser.error("Either image labels or --all should be given")
+        if self.args.all:
+            self.images = sorted(self.image_config.items())
+        names = []
+        for label, image in self.images:
+            glance_data = osclient.smart_join_glance_config(
+                image.get('glance', {}),
+                self.upload_env.get('glance', {})
+            )
+            if 'name' not in glance_data:
+                raise config.NotFoundInConfigError(
+                    "Image %s has no glance name" % label
+                )
+            if glance_data['name'] not in names:
+                names.append(glance_data['name'])
+        return names
+
     def _command(self):
-        name = self.glance_data['name']
-        candidate_list = self.os.find_obsolete_unused_candidates(name)
-        if not candidate_list:
-            print("No unused obsolete images found.")
-            return 0
-        if self.args.dry_run:
-            print("Images are obsolete and unused, but wouldn't be removed per --dry-run:")
-        else:
-            print("Images are obsolete and unused and will be removed:")
-        for candidate in candidate_list:
-            print("%s" % (candidate,))
-            if not self.args.dry_run:
-                self.os.delete_image(candidate)
-        return 0
+        names = self.image_names()
+        if len(names) == 1:
+            return self.rotate(names[0])
+        start = time.time()
+        candidates = self.os.find_obsolete_unused_candidates_by_name(
+            names,
+            page_size=self.args.page_size
+        )
+        print("Listing took %.1f s" % (time.time() - start))
+        for name in names:
+            print("%s: %s unused obsolete images" % (name, len(candidates[name])))
+        return self.remove(set().union(*candidates.values()))
 
 
 class ObsoleteCommand(GenericCommand):
@@ -457,6 +885,7 @@ class ValidateCommand(GenericCommand):
     name = 'validate'
     help = 'Validate configuration files against config schema'
     options = ['upload-config', 'img-config', 'test-env-config', 'input']
+    lazy_config = False
 
     def _command(self):
         print("Configs have been validated.")
@@ -489,6 +918,7 @@ class Main(object):
         BuildCommand(subparsers)
         TestCommand(subparsers)
         ShellCommand(subparsers)
+        PoolCommand(subparsers)
         UploadCommand(subparsers)
         RotateCommand(subparsers)
         RotateSingleCommand(subparsers)
@@ -503,42 +933,69 @@ class Main(object):
         return command(self.args)
 
 
+# Exceptions are given by name, so their modules are not imported
+# just for this table. Exception can come only from imported module,
+# so names are resolved (by error_code) only in imported modules.
+SAD_TABLE = (
+    ('config.ConfigNotFound', 10),
+    ('config.NotFoundInConfigError', 11),
+    ('osclient.CredNotFound', 12),
+    ('image_preprocessing.PreprocessError', 18),
+    (UploadFailedError, 19),
+    (RotateFailedError, 21),
+    ('keystoneauth1.exceptions.http.Unauthorized', 20),
+    ('glanceclient.exc.HTTPNotFound', 50),
+    ('novaclient.exceptions.BadRequest', 60),
+    ('novaclient.exceptions.Forbidden', 61),
+    ('prepare_os.InstanceError', 70),
+    ('do_tests.PortWaitError', 71)
+    # 80 is not handled here, but it is
+)
+
+KNOWN_ERRORS = (  # reported without trace, exit code 1
+    (PrematureExitError, 1),
+    ('osclient.CredNotFound', 1),
+    ('osclient.OpenStackError', 1),
+    ('prepare_os.InstanceError', 1),
+    ('keystoneauth1.exceptions.ClientException', 1),
+    ('novaclient.exceptions.ClientException', 1),
+    ('osclient.DiscoveryError', 1),
+    ('glanceclient.exc.HTTPNotFound', 1),
+    (IOError, 1)
+)
+
+
+def error_code(error, table):
+    '''
+        returns code for the most specific class of error
+        found in table, or None
+    '''
+    codes = {}
+    for exception, code in table:
+        if isinstance(exception, str):
+            exception = lazy_import.find_loaded(exception, globals())
+        if exception is not None:
+            codes.setdefault(exception, code)
+    for cls in type(error).__mro__:
+        if cls in codes:
+            return codes[cls]
+    return None
+
+
 def main(line=None):
-    sad_table = {
-        config.ConfigNotFound: 10,
-        config.NotFoundInConfigError: 11,
-        osclient.CredNotFound: 12,
-        image_preprocessing.PreprocessError: 18,
-        keystone_exceptions.http.Unauthorized: 20,
-        glanceclient_exceptions.HTTPNotFound: 50,
-        novaclient_exceptions.BadRequest: 60,
-        novaclient_exceptions.Forbidden: 61,
-        prepare_os.InstanceError: 70,
-        do_tests.PortWaitError: 71
-        # 80 is not handled here, but it is
-    }
     m = Main(line)
     try:
         code = m.run()
-    except tuple(sad_table.keys()) as e:
-        code = sad_table[e.__class__]
-        print("Error: %s, code %s" % (str(e), code))
-    except (
-        PrematureExitError,
-        osclient.CredNotFound,
-        osclient.OpenStackError,
-        prepare_os.InstanceError,
-        keystone_exceptions.ClientException,
-        novaclient_exceptions.ClientException,
-        osclient.DiscoveryError,
-        glanceclient_exceptions.HTTPNotFound,
-        IOError
-    ) as e:
-        print("Error: %s (%s)" % (str(e.message), e.__class__))
-        code = 1
-    except Exception as e:
-        print("Bad exception: %s %s" % (e, e.__class__))
-        raise
+    except (Exception, PrematureExitError) as e:
+        code = error_code(e, SAD_TABLE)
+        if code is not None:
+            print("Error: %s, code %s" % (str(e), code))
+        elif error_code(e, KNOWN_ERRORS) is not None:
+            print("Error: %s (%s)" % (str(e.message), e.__class__))
+            code = 1
+        else:
+            print("Bad exception: %s %s" % (e, e.__class__))
+            raise
     return code
 
 
@@ -1,10 +1,17 @@
 #!/usr/bin/python
 import os
+import json
+import hashlib
+import cPickle as pickle
 import yaml
 import jsonschema
+import cache
 
 '''Config support for dibctl'''
 
+YAML_LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+SNAPSHOT_FILE_NAME = 'config_snapshots.pickle'
+
 
 class ConfigError(ValueError):
     pass
@@ -97,6 +104,11 @@ SCHEMA_KEYSTONE = {
     },
     "additionalProperties": False
 }
+SCHEMA_STRING_LIST = {
+    'type': 'array',
+    'items': {'type': 'string'},
+    'minItems': 1
+}
 SCHEMA_VERSION = {
     'type': 'string',
     'pattern': '\d+\.\d+\.\d+'
@@ -114,7 +126,129 @@ SCHEMA_EXTERNAL_COMMAND = {
 }
 
 
+_validators = {}
+_entry_schemas = {}
+
+
+def load_yaml(text):
+    '''
+        uses libyaml loader if it's available. It's stricter than
+        pure python one (f.e. for 'key:[value]' in flow style), so
+        python loader is used for files libyaml can't parse.
+    '''
+    if YAML_LOADER is not yaml.Loader:
+        try:
+            return yaml.load(text, Loader=YAML_LOADER)
+        except yaml.YAMLError:
+            pass
+    return yaml.load(text, Loader=yaml.Loader)
+
+
+def compiled_validator(schema):
+    '''
+        returns jsonschema validator for schema and hash of schema,
+        validator is built (and schema is checked) once per schema
+    '''
+    key = id(schema)
+    if key not in _validators:
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        _validators[key] = (
+            schema,  # keeps id(schema) from reuse
+            validator_class(schema),
+            hashlib.sha1(json.dumps(schema, sort_keys=True)).hexdigest()
+        )
+    return _validators[key][1:]
+
+
+class SnapshotCache(object):
+    '''
+        Parsed config files from previous runs (with hashes of schemas
+        they were validated against), kept in the dibctl cache directory.
+        Snapshot is used only if file has the same mtime and size.
+        Cache is optional: any error with it falls back to parsing
+        of the file.
+    '''
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.snapshots = None
+        self.changed = False
+
+    def _load(self):
+        if self.snapshots is None:
+            if not self.filename:
+                try:
+                    self.filename = os.path.join(
+                        cache.cache_dir(), SNAPSHOT_FILE_NAME
+                    )
+                except EnvironmentError:
+                    pass
+            self.snapshots = {}
+            if self.filename:
+                self.snapshots = cache.load_pickle(self.filename, {})
+        return self.snapshots
+
+    @staticmethod
+    def _stamp(config_filename):
+        stat = os.stat(config_filename)
+        return (stat.st_mtime, stat.st_size)
+
+    def get(self, config_filename):
+        '''
+            returns content of unchanged file and set of schema
+            hashes it was validated against, or None
+        '''
+        try:
+            stamp = self._stamp(config_filename)
+        except EnvironmentError:
+            return None
+        entry = self._load().get(os.path.abspath(config_filename))
+        if entry and entry[0] == stamp:
+            return pickle.loads(entry[1]), entry[2]
+        return None
+
+    def put(self, config_filename, content, schema_hash=None):
+        '''stores content, schema_hash is given for validated content'''
+        try:
+            stamp = self._stamp(config_filename)
+        except EnvironmentError:
+            return
+        name = os.path.abspath(config_filename)
+        entry = self._load().get(name)
+        validated = set()
+        if entry and entry[0] == stamp:
+            validated = entry[2]
+        if schema_hash:
+            validated.add(schema_hash)
+        self.snapshots[name] = (
+            stamp,
+            pickle.dumps(content, pickle.HIGHEST_PROTOCOL),
+            validated
+        )
+        self.changed = True
+
+    def save(self):
+        '''saves new snapshots, forgets removed files'''
+        if not self.changed or not self.filename:
+            return
+        for name in list(self.snapshots):
+            if not os.path.isfile(name):
+                del self.snapshots[name]
+        try:
+            cache.save_pickle(self.filename, self.snapshots)
+        except EnvironmentError as e:
+            print("Unable to save config cache: %s" % e)
+        self.changed = False
+
+
 class Config(object):
+    '''
+        Merged content of config files. Lazy config indexes labels
+        of all files, but validates only entries which are accessed
+        (config files are expected to be objects with entries
+        under 'patternProperties' of the schema).
+    '''
 
     DEFAULT_CONFIG_NAME = None  # should be overriden in subclasses
     CONFIG_SEARCH_PATH = ["/etc/dibctl", "./dibctl", "./"]
@@ -133,15 +267,20 @@ class Config(object):
         else:
             self.config = config
         self.config_list = []
+        self.snapshots = None
+        self.pending = {}
 
-    def common_init(self, config_file=None):
+    def common_init(self, config_file=None, lazy=False):
         self.config = {}
         self.config_list = []
+        self.snapshots = SnapshotCache()
+        self.pending = {}
         if config_file:
-            self.add_config(config_file)
+            self.add_config(config_file, lazy)
         else:
             for config in self.find_all_configs():
-                self.add_config(config)
+                self.add_config(config, lazy)
+        self.snapshots.save()
         if len(self.config_list) < 1:
             raise ConfigNotFound(
                 "Unable to find %s or %s/*%s anywhere" % (
@@ -158,22 +297,90 @@ class Config(object):
             self.config[key] = snippet[key]
         print("Using %s (%s items)" % (snippet_filename, len(snippet)))
 
-    def add_config(self, config_filename):
+    def add_config(self, config_filename, lazy=False):
         '''
             Merge new piece of config from file into existing config
         '''
         if not os.path.isfile(config_filename):
             raise ConfigNotFound("%s is not found" % config_filename)
-        snippet_content = yaml.load(open(config_filename, 'r'))
-        try:
-            jsonschema.validate(snippet_content, self.SCHEMA)
-        except jsonschema.exceptions.ValidationError as e:
-            error_message = "There is an error in the file '%s': %s" % (
-                config_filename, e.message
-            )
-            raise InvaidConfigError(error_message)
+        snippet_content, validated = self.load_snippet(config_filename, lazy)
         self.config_list.append(config_filename)
         self.merge_config_snippet(snippet_content, config_filename)
+        for label in snippet_content:
+            if validated:
+                self.pending.pop(label, None)
+            else:
+                self.pending[label] = config_filename
+
+    @staticmethod
+    def _invalid(config_filename, error):
+        return InvaidConfigError(
+            "There is an error in the file '%s': %s" % (
+                config_filename, error.message
+            )
+        )
+
+    def load_snippet(self, config_filename, lazy=False):
+        '''
+            Returns parsed content of the file and True if it was
+            validated. Unchanged files are taken from snapshot cache.
+            In lazy mode entries are validated only on access.
+        '''
+        validator, schema_hash = compiled_validator(self.SCHEMA)
+        snapshot = None
+        if self.snapshots:
+            snapshot = self.snapshots.get(config_filename)
+        if snapshot:
+            snippet_content, validated_for = snapshot
+            if schema_hash in validated_for:
+                return snippet_content, True
+        else:
+            with open(config_filename, 'r') as f:
+                snippet_content = load_yaml(f.read())
+        if lazy and self.entry_schema() and isinstance(snippet_content, dict):
+            if self.snapshots and not snapshot:
+                self.snapshots.put(config_filename, snippet_content)
+            return snippet_content, False
+        try:
+            validator.validate(snippet_content)
+        except jsonschema.exceptions.ValidationError as e:
+            raise self._invalid(config_filename, e)
+        if self.snapshots:
+            self.snapshots.put(config_filename, snippet_content, schema_hash)
+        return snippet_content, True
+
+    def entry_schema(self):
+        '''
+            schema of one entry, with $schema of the whole file
+            (so it's validated by the same draft). Built once per
+            SCHEMA, as compiled_validator caches by schema object.
+        '''
+        key = id(self.SCHEMA)
+        if key not in _entry_schemas:
+            schema = self.SCHEMA.get('patternProperties', {}).get('.+')
+            if schema is not None and '$schema' in self.SCHEMA:
+                schema = dict(schema, **{'$schema': self.SCHEMA['$schema']})
+            _entry_schemas[key] = (self.SCHEMA, schema)
+        return _entry_schemas[key][1]
+
+    def validate_label(self, label):
+        '''validates entry which was not validated by lazy loading'''
+        if label not in self.pending:
+            return
+        validator, schema_hash = compiled_validator(self.entry_schema())
+        try:
+            validator.validate(self.config[label])
+        except jsonschema.exceptions.ValidationError as e:
+            raise self._invalid(self.pending[label], e)
+        del self.pending[label]
+        self.entry_validated(label)
+
+    def validate_all(self):
+        for label in list(self.pending):
+            self.validate_label(label)
+
+    def entry_validated(self, label):
+        pass  # hook for subclasses
 
     def gather_snippets(self, directory):
         content = [os.path.join(directory, f) for f in os.listdir(directory)]
@@ -193,6 +400,7 @@ class Config(object):
 
     def get(self, label, default_value=None):
         path = label.split('.')
+        self.validate_label(path[0])
         position = self.config
         for element in path[:-1]:
             position = position.get(element, {})
@@ -205,6 +413,7 @@ class Config(object):
     def __getitem__(self, label):
         try:
             path = label.split('.')
+            self.validate_label(path[0])
             position = self.config
             for element in path[:-1]:
                 position = position[element]
@@ -221,12 +430,15 @@ class Config(object):
             )
 
     def items(self):
+        self.validate_all()
         return self.config.items()
 
     def __iter__(self):
+        self.validate_all()
         return self.config.iteritems()
 
     def iteritems(self):
+        self.validate_all()
         return self.config.iteritems()
 
     def __contains__(self, key):
@@ -311,14 +523,27 @@ class ImageConfig(Config):
                                 "type": "object",
                                 "properties": {
                                     "username": {"type": "string"},
-                                    "port": SCHEMA_PORT
+                                    "port": SCHEMA_PORT,
+                                    "multiplexing": {"type": "boolean"}
                                 },
                                 "additionalProperties": False,
                                 "required": ["username"]
                             },
                             "wait_for_port": SCHEMA_PORT,
                             "port_wait_timeout": {"type": "number"},
+                            "reuse_identical_image": {"type": "boolean"},
+                            "reuse_instance": {"type": "boolean"},
+                            "concurrency": {"type": "integer", "minimum": 1},
                             "environment_name": {"type": "string"},
+                            "matrix": {
+                                "type": "object",
+                                "properties": {
+                                    "environments": SCHEMA_STRING_LIST,
+                                    "flavors": SCHEMA_STRING_LIST,
+                                    "availability_zones": SCHEMA_STRING_LIST
+                                },
+                                "additionalProperties": False
+                            },
                             "environment_variables": {"type": "object"},
                             "tests_list": {
                                 "type": "array",
@@ -327,7 +552,13 @@ class ImageConfig(Config):
                                     "properties": {
                                         "shell": SCHEMA_PATH,
                                         "pytest": SCHEMA_PATH,
-                                        "timeout": SCHEMA_TIMEOUT
+                                        "timeout": SCHEMA_TIMEOUT,
+                                        "test_timeout": SCHEMA_TIMEOUT,
+                                        "parallel": {
+                                            "type": "integer",
+                                            "minimum": 1
+                                        },
+                                        "group": {"type": "string"}
                                     },
                                     "additionalProperties": False
                                 }
@@ -342,16 +573,21 @@ class ImageConfig(Config):
         }
     }
 
-    def __init__(self, config_file=None, override_filename=None):
-        self.common_init(config_file)
-        if override_filename:
-            for img_key in self.config:
-                self.config[img_key].update(filename=override_filename)
+    def __init__(self, config_file=None, override_filename=None, lazy=False):
+        self.override_filename = override_filename
+        self.common_init(config_file, lazy)
+        for img_key in self.config:
+            if img_key not in self.pending:
+                self.entry_validated(img_key)
+
+    def entry_validated(self, label):
+        if self.override_filename:
+            self.config[label].update(filename=self.override_filename)
 
 
 class EnvConfig(Config):
-    def __init__(self, config_file=None):
-        self.common_init(config_file)
+    def __init__(self, config_file=None, lazy=False):
+        self.common_init(config_file, lazy)
 
 
 class TestEnvConfig(EnvConfig):
@@ -408,6 +644,7 @@ class TestEnvConfig(EnvConfig):
                     'ssl_insecure': {'type': 'boolean'},
                     'ssl_ca_path': SCHEMA_PATH,
                     'disable_warnings': {'type': 'boolean'},
+                    'auth_cache': {'type': 'boolean'},
                     'tests': {
                         'type': 'object',
                         'properties': {
@@ -439,12 +676,20 @@ class UploadEnvConfig(EnvConfig):
                     'ssl_insecure': {'type': 'boolean'},
                     'ssl_ca_path': SCHEMA_PATH,
                     'disable_warnings': {'type': 'boolean'},
+                    'auth_cache': {'type': 'boolean'},
                     'preprocessing': {
                         'type': 'object',
                         'properties': {
                             'cmdline': {'type': 'string'},
                             'output_filename': {'type': 'string'},
                             'use_existing': {'type': 'boolean'},
+                            'streaming': {'type': 'boolean'},
+                            'cache': {'type': 'boolean'},
+                            'cache_dir': {'type': 'string'},
+                            'cache_max_size_mb': {
+                                'type': 'integer',
+                                'minimum': 1
+                            },
                             'delete_processed_after_upload': {
                                 'type': 'boolean'
                             }
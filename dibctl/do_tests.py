@@ -1,8 +1,23 @@
 import prepare_os
-import pytest_runner
 import shell_runner
 import config
+import collections
+import tempfile
+import traceback
+import signal
+import time
+import sys
 import os
+import lazy_import
+
+pytest_runner = lazy_import.module('pytest_runner', globals())  # pytest, paramiko
+
+POLL_INTERVAL = 0.1
+KILL_GRACE_PERIOD = 10
+EXIT_PASSED = 0
+EXIT_FAILED = 1
+EXIT_ERROR = 2
+EXIT_CONTINUED = 3  # tests failed, but continue_on_fail is set
 
 
 class TestError(EnvironmentError):
@@ -21,6 +36,106 @@ class BadTestConfigError(TestError):
     pass
 
 
+class CancelledError(Exception):
+    pass
+
+
+def cancel(signum, frame):
+    raise CancelledError('Cancelled')
+
+
+class EntryProcess(object):
+    '''
+        tests_list entry running in a forked process, output of
+        the process is kept in a temporary file until report().
+        Process leads it's own process group, so pytest workers and
+        other children are killed together with it.
+    '''
+
+    def __init__(self, number, test):
+        self.number = number
+        self.test = test
+        self.pid = None
+        self.output = None
+        self.returncode = None
+        self.cancel_time = None
+
+    def start(self, run):
+        '''forks, child calls run() and exits with it's code'''
+        self.output = tempfile.TemporaryFile(prefix='dibctl_tests_')
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            code = EXIT_ERROR
+            try:
+                os.setpgid(0, 0)
+                os.dup2(self.output.fileno(), 1)
+                os.dup2(self.output.fileno(), 2)
+                sys.stdout = os.fdopen(1, 'w', 0)
+                sys.stderr = os.fdopen(2, 'w', 0)
+                signal.signal(signal.SIGTERM, cancel)
+                code = run()
+            except CancelledError:
+                print("Cancelled due to failure of other tests")
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        try:
+            os.setpgid(self.pid, self.pid)  # child may not have done it yet
+        except OSError:
+            pass  # it has, and may have exec'ed or exited already
+
+    def poll(self):
+        '''returns True if process has finished'''
+        if self.returncode is None and self.pid:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                if os.WIFEXITED(status):
+                    self.returncode = os.WEXITSTATUS(status)
+                else:
+                    self.returncode = EXIT_ERROR
+                if self.cancel_time:
+                    self._signal(signal.SIGKILL)  # leftovers of the process group
+        return self.returncode is not None
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.pid, sig)
+        except OSError:
+            pass  # has just exited
+
+    def cancel(self):
+        '''
+            asks process to stop (it stops it's tests), kills it's
+            process group if it can't
+        '''
+        now = time.time()
+        sig = signal.SIGTERM
+        if self.cancel_time:
+            if now - self.cancel_time < KILL_GRACE_PERIOD:
+                return
+            sig = signal.SIGKILL
+        self.cancel_time = now
+        self._signal(sig)
+
+    def report(self):
+        name = ', '.join('%s: %s' % item for item in sorted(self.test.items()))
+        if self.output:
+            print("Output of tests %s:" % name)
+            sys.stdout.flush()
+            self.output.seek(0)
+            sys.stdout.write(self.output.read())
+            self.output.close()
+            self.output = None
+        if self.pid is None:
+            print("Tests %s were not run" % name)
+        elif self.cancel_time:
+            print("Tests %s were cancelled" % name)
+        sys.stdout.flush()
+
+
 class DoTests(object):
     DEFAULT_PORT_WAIT_TIMEOUT = 61
     # DEFAULT_PORT = 22
@@ -50,7 +165,11 @@ class DoTests(object):
             self.delete_image = False
         else:
             self.delete_image = True
+        self.override_instance = None
+        self.private_key_file = None
+        self.tests_failed = False  # even if testing continued after that
         self.tests_list = image.get('tests.tests_list', [])
+        self.concurrency = image.get('tests.concurrency', 1)
         self.environment_variables = self.make_env_vars(image, test_env)
         self.test_env = test_env
 
@@ -98,12 +217,15 @@ class DoTests(object):
             instance_config,
             vars,
             timeout_val=timeout_val,
-            continue_on_fail=self.continue_on_fail
+            continue_on_fail=self.continue_on_fail,
+            workers=test.get('parallel', 1),
+            test_timeout=test.get('test_timeout')
         ):
             print("Done running tests  %s: %s." % (runner_name, path))
             return True
         else:
             print("Some %s: %s tests have failed." % (runner_name, path))
+            self.tests_failed = True
             if self.continue_on_fail:
                 print("Continue testing.")
                 return True
@@ -113,6 +235,11 @@ class DoTests(object):
 
     def run_all_tests(self, prep_os):
         success = True
+        if self.concurrency > 1 and len(self.tests_list) > 1:
+            success = self.run_tests_concurrently(prep_os)
+            if not success:
+                self.check_if_keep_stuff_after_fail(prep_os)
+            return success
 
         for test in self.tests_list:
             if self.run_test(self.ssh, test, prep_os, self.environment_variables) is not True:
@@ -121,6 +248,88 @@ class DoTests(object):
                 break
         return success
 
+    def run_forked_test(self, test, prep_os):
+        '''body of forked process for tests_list entry'''
+        os_client = getattr(prep_os, 'os', None)
+        if os_client:
+            os_client.set_connection_pool(1)  # new pool, not parent's sockets
+        if self.run_test(self.ssh, test, prep_os, self.environment_variables) is not True:
+            return EXIT_FAILED
+        if self.tests_failed:
+            return EXIT_CONTINUED
+        return EXIT_PASSED
+
+    @staticmethod
+    def entry_chains(entries):
+        '''
+            entries with the same 'group' are run one after another
+            (in order of tests_list), every entry without group
+            is a chain on it's own
+        '''
+        chains = collections.OrderedDict()
+        for entry in entries:
+            key = entry.test.get('group', entry.number)
+            chains.setdefault(key, []).append(entry)
+        return list(chains.values())
+
+    def run_tests_concurrently(self, prep_os):
+        '''
+            Runs up to 'concurrency' tests_list entries at once, each
+            in a forked process (runners are not thread-safe, and
+            forked pytest and shell runners keep their output apart).
+            Output of entries is printed in order of tests_list.
+            Without continue_on_fail the first failure cancels running
+            entries, and entries which were not started are skipped.
+        '''
+        for test in self.tests_list:
+            self.get_runner(test)  # config errors before anything runs
+        if self.ssh:
+            self.ssh.share()
+        entries = [EntryProcess(n, test) for n, test in enumerate(self.tests_list)]
+        queues = self.entry_chains(entries)
+        print("Running up to %s test entries at once" % self.concurrency)
+        active = {}  # chain number -> running entry
+        reported = 0
+        stop = False
+        try:
+            while True:
+                for number, entry in list(active.items()):
+                    if entry.poll():
+                        del active[number]
+                        if entry.returncode != EXIT_PASSED and not self.continue_on_fail:
+                            stop = True
+                if stop:
+                    for entry in active.values():
+                        entry.cancel()
+                for number, queue in enumerate(queues):
+                    if stop or len(active) >= self.concurrency:
+                        break
+                    if queue and number not in active:
+                        test = queue[0].test
+                        queue[0].start(lambda: self.run_forked_test(test, prep_os))
+                        active[number] = queue.pop(0)
+                while reported < len(entries) and entries[reported].poll():
+                    entries[reported].report()
+                    reported += 1
+                if not active and (stop or not any(queues)):
+                    break
+                time.sleep(POLL_INTERVAL)
+        finally:
+            while active:  # interrupted
+                for number, entry in list(active.items()):
+                    if entry.poll():
+                        del active[number]
+                    else:
+                        entry.cancel()
+                time.sleep(POLL_INTERVAL)
+        for entry in entries[reported:]:
+            entry.report()
+        if any(entry.returncode != EXIT_PASSED for entry in entries):
+            self.tests_failed = True
+        return all(
+            entry.returncode in (EXIT_PASSED, EXIT_CONTINUED) for entry in entries
+        )
+
     def init_ssh(self, prep_os):
         if 'ssh' in self.image['tests']:
             self.ssh = prep_os.ssh  # continue refactoring this!
@@ -149,11 +358,14 @@ class DoTests(object):
             self.image,
             self.test_env,
             override_image=self.override_image_uuid,
-            delete_image=self.delete_image
+            delete_image=self.delete_image,
+            override_instance=self.override_instance,
+            private_key_file=self.private_key_file
         )
         with prep_os:
             self.init_ssh(prep_os)
             self.wait_port(prep_os)
+            prep_os.timings.report()
             if shell_only:
                 result = self.open_shell(
                     prep_os.ssh,
@@ -162,6 +374,7 @@ class DoTests(object):
                 self.check_if_keep_stuff_after_fail(prep_os)
                 return result
             result = self.run_all_tests(prep_os)
+            prep_os.tests_passed = result and not self.tests_failed
             if not result:
                 print("Some tests failed")
                 if shell_on_errors:
@@ -203,4 +416,11 @@ class DoTests(object):
             self.report_ssh(prep_os.ssh)
 
     def reconfigure_for_existing_instance(self, instance, private_key_file=None):
-        raise NotImplementedError
+        '''
+            Run tests on existing instance (it's image and keypair),
+            skipping upload and boot. Nothing will be removed after tests.
+            private_key_file is used for ssh access.
+        '''
+        self.override_instance = instance
+        self.private_key_file = private_key_file
+        self.delete_image = False
@@ -1,13 +1,167 @@
 import config
+import cache
+import image_upload
 import subprocess
+import threading
+import tempfile
+import hashlib
+import fcntl
+import json
+import time
 import sys
 import os
 
+MB = 1024 * 1024
+CACHE_SUBDIR = 'preprocessed'
+CACHE_INDEX_FILE_NAME = 'index.json'
+USE_LOCK_SUFFIX = '.lock'
+DEFAULT_CACHE_MAX_SIZE_MB = 20 * 1024
+
 
 class PreprocessError(Exception):
     pass
 
 
+class PreprocessStream(object):
+    '''
+        File-like reader of the output of streaming preprocessing.
+        At the end of data checks exit code of the preprocessing
+        command, so failed conversion never looks like a short image.
+    '''
+
+    def __init__(self, preprocess, fileobj):
+        self.preprocess = preprocess
+        self.file = fileobj
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if not data:
+            self.preprocess.check_stream_result()
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class PreprocessCache(object):
+    '''
+        Directory with results of preprocessing, keyed by
+        Preprocess.cache_key(). Result is published atomically
+        (command writes into temporary file in the same directory,
+        which is renamed into place), so a partial result is never
+        visible. Index keeps size and time of the last use of each
+        entry; least recently used entries are removed when total
+        size exceeds max_size. Index is changed under exclusive
+        lock, so concurrent dibctl runs may share the cache.
+        Entries returned by lookup and publish are held by shared
+        lock (on key + USE_LOCK_SUFFIX file, taken under the index
+        lock) until release, and are never evicted while held.
+    '''
+
+    def __init__(self, directory=None, max_size=DEFAULT_CACHE_MAX_SIZE_MB * MB):
+        if directory:
+            self.directory = cache.ensure_dir(directory)
+        else:
+            self.directory = cache.cache_dir(CACHE_SUBDIR)
+        self.max_size = max_size
+        self.index_file = os.path.join(self.directory, CACHE_INDEX_FILE_NAME)
+        self.uses = []  # fds of held entry locks
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _change(self, func):
+        '''calls func(index) under lock and saves changed index'''
+        with cache.locked_json(self.index_file, {}) as index:
+            result = func(index)
+            cache.save_json(self.index_file, index)
+            return result
+
+    def _use(self, key):
+        '''holds entry until release(), called under the index lock'''
+        fd = os.open(
+            self.path(key) + USE_LOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0o600
+        )
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        self.uses.append(fd)
+        return self.path(key)
+
+    def in_use(self, key):
+        '''True if entry is held by any user (this one included)'''
+        try:
+            fd = os.open(self.path(key) + USE_LOCK_SUFFIX, os.O_RDWR)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def release(self):
+        '''releases entries returned by lookup and publish'''
+        for fd in self.uses:
+            os.close(fd)
+        self.uses = []
+
+    def lookup(self, key):
+        '''
+            returns path to cached result (marking it as used and
+            holding it until release) or None
+        '''
+        def touch(index):
+            if key in index and os.path.isfile(self.path(key)):
+                index[key]['last_used'] = time.time()
+                return self._use(key)
+            index.pop(key, None)
+            return None
+        return self._change(touch)
+
+    def temp_name(self):
+        '''name for the output of preprocessing command (file is not created)'''
+        fd, name = tempfile.mkstemp(prefix='.tmp_', dir=self.directory)
+        os.close(fd)
+        os.remove(name)
+        return name
+
+    def publish(self, key, filename):
+        '''
+            moves result into the cache, evicts old entries, returns
+            new path (holding it until release)
+        '''
+        size = os.path.getsize(filename)
+
+        def add(index):
+            os.rename(filename, self.path(key))
+            index[key] = {'size': size, 'last_used': time.time()}
+            self.evict(index, keep=key)
+            return self._use(key)
+        return self._change(add)
+
+    def evict(self, index, keep=None):
+        '''
+            removes least recently used entries (but not 'keep' and
+            entries held by running uploads) until total size fits
+            into max_size.
+        '''
+        for key in list(index):
+            if not os.path.isfile(self.path(key)):
+                del index[key]
+        total = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_used']):
+            if total <= self.max_size:
+                break
+            if key == keep or self.in_use(key):
+                continue
+            print("Removing cached preprocessing result %s" % self.path(key))
+            os.remove(self.path(key))
+            if os.path.exists(self.path(key) + USE_LOCK_SUFFIX):
+                os.remove(self.path(key) + USE_LOCK_SUFFIX)
+            total -= index.pop(key)['size']
+
+
 class Preprocess(object):
     def __init__(self, input_filename, glance_data, preprocessing_settings):
         self.input_filename = input_filename
@@ -15,6 +169,20 @@ class Preprocess(object):
         self.preprocessing_settings = preprocessing_settings
         self.delete_after = self.preprocessing_settings.get('delete_processed_after_upload', True)
         self.use_existing = self.preprocessing_settings.get('use_existing', False)
+        self.streaming = self.preprocessing_settings.get('streaming', False)
+        self.use_cache = self.preprocessing_settings.get('cache', False) and not self.streaming
+        self.cache_dir = self.preprocessing_settings.get('cache_dir')
+        self.cache_max_size = self.preprocessing_settings.get(
+            'cache_max_size_mb', DEFAULT_CACHE_MAX_SIZE_MB
+        ) * MB
+        self.cached_filename = None
+        self.store = None  # PreprocessCache holding cached_filename
+        self.process = None
+        self.stream = None
+        self.writer_fd = None
+        self.watcher = None
+        self.lock = threading.Lock()
+        self.source = None  # opener of the stream for upload in streaming mode
 
     def prep_output_name(self, allowed_vars):
         try:
@@ -38,13 +206,15 @@ class Preprocess(object):
                     )
                 )
 
-    def interpolate(self):
-        allowed_vars = {
-            'input_filename': self.input_filename,
+    def allowed_vars(self, input_filename):
+        return {
+            'input_filename': input_filename,
             'disk_format': self.glance_data.get('disk_format', 'qcow2'),
             'container_format': self.glance_data.get('container_format', 'bare')
         }
 
+    def interpolate(self):
+        allowed_vars = self.allowed_vars(self.input_filename)
         self.output_filename = self.prep_output_name(allowed_vars)
         allowed_vars['output_filename'] = self.output_filename
         self.command_line = self.prep_cmdline(allowed_vars)
@@ -54,11 +224,22 @@ class Preprocess(object):
             return self.input_filename
 
         self.interpolate()
-        self.run()
+        if self.streaming:
+            self.start_stream()
+        elif self.use_cache:
+            self.cached_filename = self.run_cached()
+            return self.cached_filename
+        else:
+            self.run()
         return self.output_filename
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self.preprocessing_settings:
+        if self.process:
+            self.stop_stream()
+            os.remove(self.output_filename)
+        elif self.cached_filename:
+            self.store.release()  # file is owned by the cache
+        elif self.preprocessing_settings:
             if self.delete_after and not self.use_existing:
                 os.remove(self.output_filename)
 
@@ -68,13 +249,142 @@ class Preprocess(object):
                 return self.output_filename
             else:
                 os.remove(self.output_filename)
+        self.execute(self.command_line, self.output_filename)
+
+    def execute(self, command_line, output_filename):
         sys.stdout.flush()
         try:
             print("Preprocessing...")
-            subprocess.check_call(self.command_line, shell=True, stdout=sys.stdout, stderr=sys.stderr, stdin=None)
+            subprocess.check_call(command_line, shell=True, stdout=sys.stdout, stderr=sys.stderr, stdin=None)
         except subprocess.CalledProcessError as e:
             raise PreprocessError('Preprocessing failed with code %s' % e.returncode)
-        if not os.path.isfile(self.output_filename):
-            raise PreprocessError('There is no output file %s after preprocess had finished')
+        if not os.path.isfile(output_filename):
+            raise PreprocessError('There is no output file %s after preprocess had finished' % output_filename)
+        print("Preprocessing done.")
+        sys.stdout.flush()
+
+    def cache_key(self):
+        '''
+            identifies result of preprocessing by content of the input
+            file, command line (with placeholders instead of file names)
+            and image formats
+        '''
+        allowed_vars = self.allowed_vars('<input>')
+        allowed_vars['output_filename'] = '<output>'
+        return hashlib.sha256(json.dumps([
+            image_upload.HashCache().sha256(self.input_filename),
+            self.prep_cmdline(allowed_vars),
+            allowed_vars['disk_format'],
+            allowed_vars['container_format']
+        ])).hexdigest()
+
+    def run_cached(self):
+        '''
+            Cache mode: returns result of the same preprocessing of the
+            same image from the cache, or runs command with output into
+            the cache (instead of output_filename)
+        '''
+        store = self.store = PreprocessCache(self.cache_dir, self.cache_max_size)
+        key = self.cache_key()
+        filename = store.lookup(key)
+        if filename:
+            print("Using cached preprocessing result %s" % filename)
+            return filename
+        allowed_vars = self.allowed_vars(self.input_filename)
+        allowed_vars['output_filename'] = store.temp_name()
+        try:
+            self.execute(self.prep_cmdline(allowed_vars), allowed_vars['output_filename'])
+            return store.publish(key, allowed_vars['output_filename'])
+        finally:
+            if os.path.exists(allowed_vars['output_filename']):
+                os.remove(allowed_vars['output_filename'])
+
+    def start_stream(self):
+        '''
+            Streaming mode: output_filename is a FIFO, preprocessing
+            command writes into it while upload reads from it (via
+            self.source), so converted image never touches the disk.
+            Command should write output sequentially. We keep our
+            own write end of the FIFO open until the command exits:
+            reader never blocks on open and gets end of data only
+            after the command has finished.
+        '''
+        if os.path.isfile(self.output_filename):
+            if self.use_existing:
+                return
+            os.remove(self.output_filename)
+        elif os.path.exists(self.output_filename):
+            os.remove(self.output_filename)  # FIFO left by crashed run
+        os.mkfifo(self.output_filename, 0o600)
+        try:
+            read_fd = os.open(self.output_filename, os.O_RDONLY | os.O_NONBLOCK)
+            flags = fcntl.fcntl(read_fd, fcntl.F_GETFL)
+            fcntl.fcntl(read_fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            self.stream = os.fdopen(read_fd, 'rb')
+            self.writer_fd = os.open(self.output_filename, os.O_WRONLY)
+            sys.stdout.flush()
+            print("Preprocessing (streaming into upload)...")
+            self.process = subprocess.Popen(
+                self.command_line,
+                shell=True,
+                stdout=sys.stdout,
+                stderr=sys.stderr,
+                stdin=None,
+                close_fds=True
+            )
+        except BaseException:
+            self._close_stream()
+            os.remove(self.output_filename)
+            raise
+        self.watcher = threading.Thread(target=self._watch)
+        self.watcher.daemon = True
+        self.watcher.start()
+        self.source = self.open_stream
+
+    def _watch(self):
+        self.process.wait()
+        self._close_writer()
+
+    def _close_writer(self):
+        with self.lock:
+            if self.writer_fd is not None:
+                os.close(self.writer_fd)
+                self.writer_fd = None
+
+    def _close_stream(self):
+        self._close_writer()
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+    def open_stream(self):
+        '''returns file-like object with output of the command (once)'''
+        with self.lock:
+            stream, self.stream = self.stream, None
+        if not stream:
+            raise PreprocessError('Preprocessing output stream can be read only once')
+        return PreprocessStream(self, stream)
+
+    def check_stream_result(self):
+        '''called at the end of stream, when command has exited'''
+        self.watcher.join()
+        if self.process.returncode:
+            raise PreprocessError(
+                'Preprocessing failed with code %s' % self.process.returncode
+            )
         print("Preprocessing done.")
         sys.stdout.flush()
+
+    def stop_stream(self):
+        '''stops command if upload didn't read all of it's output'''
+        with self.lock:
+            stream, self.stream = self.stream, None
+        if stream:
+            stream.close()
+        if self.watcher.is_alive():  # only watcher waits for process
+            print("Stopping preprocessing.")
+            try:
+                self.process.terminate()
+            except OSError:
+                pass  # has just exited
+        self.watcher.join()
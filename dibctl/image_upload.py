@@ -0,0 +1,666 @@
+import os
+import sys
+import stat
+import mmap
+import time
+import hashlib
+import threading
+import cache
+import waiter
+import timeout
+try:
+    import Queue as queue
+except ImportError:  # python3
+    import queue
+
+'''Chunked, resumable image upload to Glance'''
+
+MB = 1024 * 1024
+CHUNK_SIZE = 16 * MB
+READAHEAD_CHUNKS = 2
+UPLOAD_RETRIES = 2
+PROGRESS_INTERVAL = 10
+IMPORT_POLL_DELAY = 2
+STATE_FILE_NAME = 'upload_state.json'
+HASH_CACHE_FILE_NAME = 'hash_cache.json'
+HASH_ALGOS = ('md5', 'sha256')
+HASH_PROPERTY = 'dibctl_sha256'  # glance property with sha256 of image data
+
+_state_lock = threading.Lock()  # shared by all uploads in the process
+
+try:
+    _buffer = buffer  # python2: mmap has only old-style buffer interface
+except NameError:  # python3
+    def _buffer(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
+
+
+class ImageUploadError(EnvironmentError):
+    pass
+
+
+class ImportFailedError(ImageUploadError):
+    pass
+
+
+class ChecksumMismatchError(ImageUploadError):
+    pass
+
+
+class Checksum(object):
+    '''
+        Hashes of the uploaded data, calculated in the same pass
+        as upload. md5 is compared with glance 'checksum',
+        other hashes - with 'os_hash_value' if glance uses
+        the same algorithm ('os_hash_algo')
+    '''
+
+    def __init__(self, algos=HASH_ALGOS):
+        self.hashes = dict((algo, hashlib.new(algo)) for algo in algos)
+        self.complete = False
+
+    def update(self, data):
+        if data:
+            for h in self.hashes.values():
+                h.update(data)
+        else:
+            self.complete = True
+
+    def hexdigest(self, algo):
+        return self.hashes[algo].hexdigest()
+
+    def verify(self, img):
+        '''
+            raises ChecksumMismatchError if glance reports different
+            checksum. Does nothing for incomplete (not read till the end)
+            data or if glance reports no checksum
+        '''
+        if not self.complete:
+            return
+        expected = []
+        if 'md5' in self.hashes:
+            expected.append(('md5', getattr(img, 'checksum', None)))
+        algo = getattr(img, 'os_hash_algo', None)
+        if algo in self.hashes:
+            expected.append((algo, getattr(img, 'os_hash_value', None)))
+        for algo, value in expected:
+            if value and value != self.hexdigest(algo):
+                raise ChecksumMismatchError(
+                    "Image %s is corrupted: %s is %s in glance, %s locally" % (
+                        img.id, algo, value, self.hexdigest(algo)
+                    )
+                )
+
+
+class MmapFile(object):
+    '''
+        Read-only file-like object backed by mmap: data is
+        taken directly from the page cache without going through
+        buffered file reads. read() returns memoryview of the
+        mapped pages instead of a copy, so returned data is valid
+        only until close().
+    '''
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        except BaseException:
+            self.file.close()
+            raise
+        self.offset = 0
+
+    def read(self, size=-1):
+        left = len(self.map) - self.offset
+        if size is None or size < 0 or size > left:
+            size = left
+        if size <= 0:
+            return b''
+        data = memoryview(_buffer(self.map, self.offset, size))
+        self.offset += size
+        return data
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def open_source(filename):
+    '''
+        opens file for upload. Uses mmap for regular files,
+        falls back to normal read for files which can't be
+        mapped (empty files, pipes, etc)
+    '''
+    try:
+        return MmapFile(filename)
+    except (ValueError, EnvironmentError):
+        return open(filename, 'rb', buffering=65536)
+
+
+class UploadProgress(object):
+    '''
+        Tracks amount of uploaded data and prints
+        progress with upload speed (MB/s)
+    '''
+
+    def __init__(self, name, total=None, interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done_bytes = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def speed(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        if elapsed <= 0:
+            return 0.0
+        return self.done_bytes / float(MB) / elapsed
+
+    def update(self, size):
+        self.done_bytes += size
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now=None):
+        if self.total:
+            percent = " (%.1f%%)" % (100.0 * self.done_bytes / self.total)
+        else:
+            percent = ""
+        print("Uploading %s: %.1f MB%s, %.1f MB/s" % (
+            self.name,
+            self.done_bytes / float(MB),
+            percent,
+            self.speed(now)
+        ))
+        sys.stdout.flush()
+
+    def finish(self):
+        now = time.time()
+        print("Uploaded %.1f MB in %.1f s (%.1f MB/s)" % (
+            self.done_bytes / float(MB),
+            now - self.start,
+            self.speed(now)
+        ))
+        sys.stdout.flush()
+
+
+class ChunkedReader(object):
+    '''
+        File-like object which reads source file in large
+        fixed-size chunks (in a separate read-ahead thread,
+        to overlap disk reads with network transfer) and
+        serves read() calls of the http library from them.
+        Chunks of MmapFile are memoryviews, so they are sliced
+        without copying.
+    '''
+
+    def __init__(
+        self,
+        fileobj,
+        chunk_size=CHUNK_SIZE,
+        progress=None,
+        readahead=READAHEAD_CHUNKS
+    ):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.queue = queue.Queue(maxsize=readahead)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.buffer = b''
+        self.offset = 0
+        self.eof = False
+        self.checksum = Checksum()
+
+    def _read_chunks(self):
+        try:
+            while not self.stopped.is_set():
+                chunk = self.fileobj.read(self.chunk_size)
+                self.checksum.update(chunk)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def _next_chunk(self):
+        timeout.check()
+        if not self.thread:
+            self.thread = threading.Thread(target=self._read_chunks)
+            self.thread.daemon = True
+            self.thread.start()
+        item = self.queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def read(self, size=-1):
+        if self.eof:
+            return b''
+        if self.offset >= len(self.buffer):
+            self.buffer = self._next_chunk()
+            self.offset = 0
+            if not self.buffer:
+                self.eof = True
+                return b''
+        if size is None or size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(self.offset + size, len(self.buffer))
+        data = self.buffer[self.offset:end]
+        self.offset = end
+        if self.progress:
+            self.progress.update(len(data))
+        return data
+
+    def close(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        close = getattr(self.fileobj, 'close', None)
+        if close:
+            close()
+
+
+class TeeReader(object):
+    '''
+        Reads source file once and feeds the same chunks to
+        a few consumers (one per upload). Each consumer
+        is a file-like object. Closed (or never opened) consumers
+        are detached and do not hold others. Slowest active
+        consumer limits speed for all of them. Chunks may point
+        into source (MmapFile), so source is closed only after
+        all consumers are closed.
+    '''
+
+    def __init__(
+        self,
+        fileobj,
+        count,
+        chunk_size=CHUNK_SIZE,
+        readahead=READAHEAD_CHUNKS
+    ):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.checksum = Checksum()
+        self.consumers = [
+            TeeConsumer(self, readahead) for num in range(count)
+        ]
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def start(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self._read_chunks)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _active(self):
+        return [c for c in self.consumers if not c.stopped.is_set()]
+
+    def _read_chunks(self):
+        try:
+            while self._active():
+                chunk = self.fileobj.read(self.chunk_size)
+                self.checksum.update(chunk)
+                for consumer in self._active():
+                    consumer._put(chunk)
+                if not chunk:
+                    break
+        except BaseException as e:
+            for consumer in self._active():
+                consumer._put(e)
+
+    def release(self):
+        '''closes source when the last consumer is closed'''
+        with self.lock:
+            if self.closed or self._active():
+                return
+            self.closed = True
+            if self.thread:
+                self.thread.join()
+            close = getattr(self.fileobj, 'close', None)
+            if close:
+                close()
+
+
+class TeeConsumer(ChunkedReader):
+
+    def __init__(self, tee, readahead):
+        super(TeeConsumer, self).__init__(
+            None, tee.chunk_size, readahead=readahead
+        )
+        self.tee = tee
+        self.checksum = tee.checksum
+
+    def _next_chunk(self):
+        self.tee.start()
+        item = self.queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def close(self):
+        self.stopped.set()
+        self.buffer = b''
+        self.tee.release()
+
+
+def file_key(filename):
+    '''
+        identifies content of the file by it's path, size and mtime.
+        Returns None if file is not accessible or is not a regular
+        file (content of pipes can't be identified, so uploads from
+        them are not resumed and their hashes are not cached).
+    '''
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return "%s|%s|%s" % (os.path.abspath(filename), st.st_size, st.st_mtime)
+
+
+class HashCache(object):
+    '''
+        Persistent (json file) cache of sha256 of local files.
+        Cached value is used only if size and mtime of the
+        file are unchanged.
+    '''
+
+    def __init__(self, cache_file=None):
+        if not cache_file:
+            cache_file = os.path.join(cache.cache_dir(), HASH_CACHE_FILE_NAME)
+        self.cache_file = cache_file
+
+    def get(self, filename):
+        key = file_key(filename)
+        if not key:
+            return None
+        record = cache.load_json(self.cache_file, {}).get(
+            os.path.abspath(filename), {}
+        )
+        if record.get('key') == key:
+            return record.get('sha256')
+        return None
+
+    def put(self, filename, sha256):
+        key = file_key(filename)
+        if not key:
+            return
+        with _state_lock:
+            hashes = cache.load_json(self.cache_file, {})
+            for path in list(hashes):
+                if not os.path.exists(path):
+                    del hashes[path]
+            hashes[os.path.abspath(filename)] = {'key': key, 'sha256': sha256}
+            cache.save_json(self.cache_file, hashes)
+
+    def sha256(self, filename):
+        '''returns sha256 of the file, reading it only if not cached'''
+        value = self.get(filename)
+        if not value:
+            print("Calculating sha256 for %s" % filename)
+            checksum = Checksum(('sha256',))
+            f = open_source(filename)
+            try:
+                while not checksum.complete:
+                    checksum.update(f.read(CHUNK_SIZE))
+            finally:
+                f.close()
+            value = checksum.hexdigest('sha256')
+            self.put(filename, value)
+        return value
+
+
+class UploadState(object):
+    '''
+        Persistent (json file) record of unfinished uploads.
+        Each record is keyed by location (cloud) and by
+        path, size and mtime of the uploaded file, so changed
+        file would never be resumed into an old image.
+    '''
+
+    def __init__(self, state_file=None):
+        if not state_file:
+            state_file = os.path.join(cache.cache_dir(), STATE_FILE_NAME)
+        self.state_file = state_file
+
+    @staticmethod
+    def key(location, filename):
+        key = file_key(filename)
+        if not key:
+            return None
+        return "%s|%s" % (location, key)
+
+    def get(self, key):
+        if not key:
+            return None
+        return cache.load_json(self.state_file, {}).get(key)
+
+    def update(self, key, **values):
+        if not key:
+            return
+        with _state_lock:
+            state = cache.load_json(self.state_file, {})
+            state.setdefault(key, {}).update(values)
+            cache.save_json(self.state_file, state)
+
+    def forget(self, key):
+        if not key:
+            return
+        with _state_lock:
+            state = cache.load_json(self.state_file, {})
+            if state.pop(key, None) is not None:
+                cache.save_json(self.state_file, state)
+
+
+class ImageUploader(object):
+    '''
+        Uploads image data into Glance in chunks.
+        Uses import (stage + glance-direct) if endpoint supports it,
+        falls back to the plain data upload otherwise.
+        Glance can't accept partial data, so resume is done
+        on a stage granularity: existing image record is reused,
+        and staged data is imported without re-uploading it.
+        Failed transfer is retried up to 'retries' times, each
+        retry goes into a new image record (glance kills image
+        or leaves it in 'saving' state after failed upload).
+        sha256 of uploaded data is stored in the image
+        property (HASH_PROPERTY) and in hash_cache.
+    '''
+
+    def __init__(
+        self,
+        glance,
+        state=None,
+        location=None,
+        chunk_size=CHUNK_SIZE,
+        retries=UPLOAD_RETRIES,
+        hash_cache=None
+    ):
+        self.glance = glance
+        self.state = state
+        self.location = location
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.hash_cache = hash_cache
+
+    def supports_import(self):
+        try:
+            info = self.glance.images.get_import_info()
+            methods = info.get('import-methods', {}).get('value', [])
+            return 'glance-direct' in methods
+        except Exception:
+            return False
+
+    def _resume(self, key):
+        record = self.state and self.state.get(key)
+        if not record:
+            return None, None
+        try:
+            img = self.glance.images.get(record['image_id'])
+        except Exception:
+            img = None
+        if img and img.status == 'active':
+            print("Image %s has been uploaded already" % img.id)
+            return img, 'active'
+        if img and img.status == 'uploading' and record.get('staged'):
+            print("Resuming upload: data for %s is already staged" % img.id)
+            return img, 'staged'
+        if img and img.status == 'queued':
+            print("Resuming upload: reusing image record %s" % img.id)
+            return img, 'queued'
+        self.state.forget(key)
+        return None, None
+
+    def _create(self, key, create_args, meta):
+        img = self.glance.images.create(**create_args)
+        self.glance.images.update(img.id, **dict(meta))
+        if self.state:
+            self.state.update(key, image_id=img.id, staged=False)
+        return img
+
+    def _recreate(self, img, key, create_args, meta):
+        '''replaces image record broken by failed transfer with a new one'''
+        if self.state:
+            self.state.forget(key)
+        try:
+            self.glance.images.delete(img.id)
+        except Exception as e:
+            print("Unable to remove image %s after failed upload: %s" % (img.id, e))
+        return self._create(key, create_args, meta)
+
+    def _wait_for_import(self, image_id):
+        def imported():
+            img = self.glance.images.get(image_id)
+            if img.status in ('killed', 'deleted', 'deactivated'):
+                raise ImportFailedError(
+                    "Import of image %s failed, status is '%s'" % (
+                        image_id, img.status
+                    )
+                )
+            if img.status == 'active':
+                return img
+        return waiter.Waiter(
+            'import', max_delay=IMPORT_POLL_DELAY
+        ).wait(imported)
+
+    def _verify(self, img, key, checksum):
+        try:
+            checksum.verify(img)
+        except ChecksumMismatchError:
+            if self.state:
+                self.state.forget(key)
+            try:
+                self.glance.images.delete(img.id)
+            except Exception as e:
+                print("Unable to remove corrupted image %s: %s" % (img.id, e))
+            raise
+
+    def _save_hash(self, img, filename, checksum):
+        sha256 = checksum.hexdigest('sha256')
+        if self.hash_cache:
+            self.hash_cache.put(filename, sha256)
+        if getattr(img, HASH_PROPERTY, None) != sha256:
+            self.glance.images.update(img.id, **{HASH_PROPERTY: sha256})
+
+    def _send(self, img, key, opener, size, use_import, create_args, meta):
+        '''
+            returns image (new one if transfer was retried) and
+            Checksum of the sent data (None if data wasn't
+            a file-like object)
+        '''
+        for attempt in range(self.retries + 1):
+            data = opener()
+            progress = None
+            if isinstance(data, ChunkedReader):
+                progress = UploadProgress(img.id, size)
+                data.progress = progress
+            elif hasattr(data, 'read'):
+                progress = UploadProgress(img.id, size)
+                data = ChunkedReader(data, self.chunk_size, progress)
+            try:
+                if use_import:
+                    self.glance.images.stage(img.id, data)
+                    if self.state:
+                        self.state.update(key, staged=True)
+                else:
+                    self.glance.images.upload(img.id, data)
+                if progress:
+                    progress.finish()
+                return img, getattr(data, 'checksum', None)
+            except timeout.TimeoutError:
+                raise
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                print("Upload of %s failed: %s, retrying (%s of %s)" % (
+                    img.id, e, attempt + 1, self.retries
+                ))
+            finally:
+                close = getattr(data, 'close', None)
+                if close:
+                    close()
+            img = self._recreate(img, key, create_args, meta)
+
+    def upload(self, filename, opener, create_args, meta):
+        '''
+            - filename - name of the file to upload (used for resume)
+            - opener - callable, returns a file-like object (or data)
+              to upload, called once per attempt
+            - create_args - arguments for glance images.create
+            - meta - image properties
+            returns glance image
+            Checksums of the sent data are verified against
+            checksums reported by glance after upload.
+        '''
+        key = None
+        if self.state:
+            key = self.state.key(self.location, filename)
+        img, stage = self._resume(key)
+        if stage == 'active':
+            self.state.forget(key)
+            return img
+        use_import = self.supports_import()
+        known_hash = self.hash_cache and self.hash_cache.get(filename)
+        if known_hash:
+            meta = dict(meta, **{HASH_PROPERTY: known_hash})
+        if not img:
+            img = self._create(key, create_args, meta)
+        checksum = None
+        if stage != 'staged':
+            size = None
+            if os.path.isfile(filename):
+                size = os.path.getsize(filename)
+            img, checksum = self._send(
+                img, key, opener, size, use_import, create_args, meta
+            )
+        if use_import or stage == 'staged':
+            self.glance.images.image_import(img.id, method='glance-direct')
+            img = self._wait_for_import(img.id)
+        elif checksum:
+            img = self.glance.images.get(img.id)
+        if checksum:
+            self._verify(img, key, checksum)
+            if checksum.complete:
+                self._save_hash(img, filename, checksum)
+        if self.state:
+            self.state.forget(key)
+        return img
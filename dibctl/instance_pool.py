@@ -0,0 +1,315 @@
+import os
+import time
+import cache
+import parallel
+import prepare_os
+import image_upload
+
+'''Pool of pre-booted test instances for 'test' and 'shell' commands'''
+
+POOL_FILE_NAME = 'instance_pool.json'
+KEYS_DIR = 'pool_keys'
+IDLE_TTL = 3600
+LEASE_TTL = 6 * 3600
+
+
+class InstancePool(object):
+    '''
+        Persistent list of pre-booted instances in the dibctl cache
+        directory. Each instance belongs to a pool (image label and
+        test environment label) and is either idle or leased by
+        a running 'test' or 'shell'. Private keys are kept near
+        the list (readable only by owner). All changes are done
+        under exclusive lock, so concurrent dibctl runs never get
+        the same instance. Instances booted from uploaded image
+        keep sha256 of the image file, so they are not used after
+        the file is rebuilt.
+    '''
+
+    def __init__(self, pool_file=None, ttl=IDLE_TTL):
+        if not pool_file:
+            pool_file = os.path.join(cache.cache_dir(), POOL_FILE_NAME)
+        self.pool_file = pool_file
+        self.ttl = ttl
+
+    @staticmethod
+    def pool_name(image_label, env_label):
+        return '%s@%s' % (image_label, env_label)
+
+    def _change(self, func):
+        '''calls func(records) under lock and saves changed records'''
+        with cache.locked_json(self.pool_file, {}) as data:
+            result = func(data.setdefault('instances', []))
+            cache.save_json(self.pool_file, data)
+            return result
+
+    def records(self, pool_name=None):
+        with cache.locked_json(self.pool_file, {}) as data:
+            return [
+                record for record in data.get('instances', [])
+                if pool_name in (None, record['pool'])
+            ]
+
+    def add(
+        self,
+        pool_name,
+        environment,
+        instance_id,
+        keypair,
+        private_key,
+        image_uuid,
+        owns_image=False,
+        image_sha256=None
+    ):
+        key_file = os.path.join(cache.cache_dir(KEYS_DIR), instance_id)
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(private_key)
+        record = {
+            'pool': pool_name,
+            'environment': environment,
+            'instance_id': instance_id,
+            'keypair': keypair,
+            'key_file': key_file,
+            'image_uuid': image_uuid,
+            'image_sha256': image_sha256,
+            'owns_image': owns_image,
+            'leased': False,
+            'last_used': time.time()
+        }
+        self._change(lambda records: records.append(record))
+        return record
+
+    def acquire(self, pool_name, image_uuid=None, image_sha256=None):
+        '''leases idle instance, returns it's record or None'''
+        now = time.time()
+
+        def lease(records):
+            for record in records:
+                if record['pool'] != pool_name or record['leased']:
+                    continue
+                if image_uuid and record['image_uuid'] != image_uuid:
+                    continue
+                if image_sha256 and record.get('image_sha256') != image_sha256:
+                    continue
+                if now - record['last_used'] > self.ttl:
+                    continue  # waits for reap
+                record['leased'] = True
+                record['last_used'] = now
+                return record
+            return None
+        return self._change(lease)
+
+    def release(self, record):
+        '''returns leased instance to the pool'''
+        def unlease(records):
+            for r in records:
+                if r['instance_id'] == record['instance_id']:
+                    r['leased'] = False
+                    r['last_used'] = time.time()
+        self._change(unlease)
+
+    def update(self, record, **changes):
+        '''changes stored record of the instance, returns it (or None)'''
+        def change(records):
+            for r in records:
+                if r['instance_id'] == record['instance_id']:
+                    r.update(changes)
+                    return r
+            return None
+        return self._change(change)
+
+    def last_for_image(self, record):
+        '''True if no other instance uses image of this one'''
+        return not any(
+            r['image_uuid'] == record['image_uuid']
+            and r['instance_id'] != record['instance_id']
+            for r in self.records()
+        )
+
+    def remove(self, record):
+        '''
+            forgets instance (without removing it from Openstack),
+            returns True if it was the last record for it's image
+        '''
+        def drop(records):
+            records[:] = [
+                r for r in records if r['instance_id'] != record['instance_id']
+            ]
+            return not any(
+                r['image_uuid'] == record['image_uuid'] for r in records
+            )
+        last_for_image = self._change(drop)
+        if os.path.exists(record['key_file']):
+            os.remove(record['key_file'])
+        return last_for_image
+
+    def expired(self, everything=False):
+        '''
+            idle instances unused for ttl, leases older than LEASE_TTL
+            and instances with failed deletion
+        '''
+        now = time.time()
+
+        def is_expired(record):
+            if record.get('deleting'):
+                return True
+            age = now - record['last_used']
+            if record['leased']:
+                return age > LEASE_TTL
+            return everything or age > self.ttl
+        return [record for record in self.records() if is_expired(record)]
+
+
+def delete(pool, record, os_client):
+    '''
+        removes instance (and image, if pool has uploaded it and no
+        other instance uses it) from Openstack. Record is kept (leased,
+        so it's not used) until everything is removed, with the list
+        of removed parts, so failed deletion is finished by next reap.
+    '''
+    record = pool.update(record, leased=True, deleting=True) or record
+    deleted = record.get('deleted', [])
+    print("Removing pool instance %s" % record['instance_id'])
+    steps = [
+        ('instance', os_client.delete_instance, record['instance_id']),
+        ('keypair', os_client.delete_keypair, record['keypair'])
+    ]
+    if record['owns_image'] and pool.last_for_image(record):
+        steps.append(('image', os_client.delete_image, record['image_uuid']))
+    for part, call, argument in steps:
+        if part in deleted:
+            continue
+        if part == 'image':
+            print("Removing pool image %s" % record['image_uuid'])
+        call(argument)
+        deleted.append(part)
+        pool.update(record, deleted=deleted)
+    pool.remove(record)
+
+
+def reap(pool, test_env_config, everything=False):
+    '''
+        removes expired instances, returns list of parallel.Result
+        for them
+    '''
+    clients = {}
+
+    def reap_one(record):
+        env = record['environment']
+        if env not in clients:
+            clients[env] = prepare_os.connect(test_env_config[env])
+        delete(pool, record, clients[env])
+    return parallel.run_parallel(reap_one, pool.expired(everything), workers=1)
+
+
+def image_sha256(image):
+    '''sha256 of the image file, None if there is no file'''
+    filename = image.get('filename', None)
+    if not filename or not os.path.isfile(filename):
+        return None
+    return image_upload.HashCache().sha256(filename)
+
+
+def fill(
+    pool,
+    image_label,
+    image,
+    env_label,
+    test_env,
+    size,
+    image_uuid=None,
+    workers=parallel.DEFAULT_WORKERS
+):
+    '''
+        boots 'size' instances into the pool (concurrently).
+        Image is uploaded once if image_uuid is not given, and
+        removed with the last instance of the pool which uses it
+        (or at once, if no instance has booted).
+        Returns list of parallel.Result with pool records.
+    '''
+    uploader = None
+    sha256 = None
+    if not image_uuid:
+        uploader = prepare_os.PrepOS(image, test_env, delete_image=False)
+        uploader.connect()
+        uploader.upload_image(uploader.upload_timeout)
+        image_uuid = uploader.os_image.id
+        sha256 = image_sha256(image)
+    pool_name = pool.pool_name(image_label, env_label)
+
+    def boot(number):
+        prep = prepare_os.PrepOS(image, test_env, override_image=image_uuid)
+        prep.connect()
+        try:
+            prep.prepare()
+        except BaseException:
+            prep.cleanup()
+            raise
+        return pool.add(
+            pool_name,
+            env_label,
+            prep.os_instance.id,
+            prep.os_key.name,
+            prep.os_key.private_key,
+            image_uuid,
+            owns_image=bool(uploader),
+            image_sha256=sha256
+        )
+    results = parallel.run_parallel(boot, range(size), workers)
+    if uploader and all(result.error for result in results):
+        print("No instances were booted, removing pool image %s" % image_uuid)
+        try:
+            uploader.os.delete_image(image_uuid)
+        except Exception as e:
+            print("Error while removing image %s: %s" % (image_uuid, e))
+    return results
+
+
+def lease(pool, pool_name, dt, image_uuid=None, image=None):
+    '''
+        reconfigures DoTests to use idle instance from the pool,
+        returns leased record or None if pool has no idle instances.
+        Instance should be booted from image_uuid if it's given,
+        otherwise from the current content of the image file.
+    '''
+    sha256 = None
+    if not image_uuid:
+        sha256 = image_sha256(image or {})
+        if not sha256:
+            print("No image file to compare with pool %s, will boot a new instance" % pool_name)
+            return None
+    record = pool.acquire(pool_name, image_uuid, sha256)
+    if not record:
+        print("No idle instances in pool %s, will boot a new one" % pool_name)
+        return None
+    print("Using instance %s from pool %s" % (record['instance_id'], pool_name))
+    dt.reconfigure_for_existing_instance(
+        record['instance_id'],
+        record['key_file']
+    )
+    return record
+
+
+def give_back(pool, record, success, test_env, keep=False):
+    '''
+        returns instance to the pool after successful use, otherwise
+        removes it from the pool (and from Openstack unless keep is set).
+        Errors are reported, not raised (it's called after tests, and
+        shouldn't hide their errors).
+    '''
+    try:
+        if success:
+            pool.release(record)
+            print("Instance %s is returned to the pool" % record['instance_id'])
+        elif keep:
+            pool.remove(record)
+            print("Instance %s is removed from the pool and kept for debugging" % (
+                record['instance_id']
+            ))
+        else:
+            delete(pool, record, prepare_os.connect(test_env))
+    except Exception as e:
+        print("Error while giving back pool instance %s: %s" % (
+            record['instance_id'], e
+        ))
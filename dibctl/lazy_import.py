@@ -0,0 +1,78 @@
+import sys
+
+'''Modules imported on first use, to keep startup of dibctl fast'''
+
+
+class LazyModule(object):
+    '''
+        Stands for a module until one of it's attributes is used.
+        Module is imported the same way as 'import name' does it in
+        the module with caller_globals (so implicit relative imports
+        of dibctl modules work). Setting and deleting of attributes
+        (f.e. by mock.patch.object) is passed to the module.
+    '''
+
+    def __init__(self, name, caller_globals):
+        object.__setattr__(self, '_lazy_name', name)
+        object.__setattr__(self, '_lazy_globals', caller_globals)
+        object.__setattr__(self, '_lazy_module', None)
+
+    def _load(self):
+        module = object.__getattribute__(self, '_lazy_module')
+        if module is None:
+            module = __import__(
+                self._lazy_name,
+                self._lazy_globals,
+                {},
+                ['__name__']  # returns a.b for 'a.b', not a
+            )
+            object.__setattr__(self, '_lazy_module', module)
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._load(), name)
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self._lazy_name
+
+
+def module(name, caller_globals):
+    return LazyModule(name, caller_globals)
+
+
+def loaded(name, caller_globals):
+    '''
+        returns module if it is already imported
+        (as 'import name' in caller module would find it), or None
+    '''
+    package = caller_globals.get('__package__')
+    if package is None:
+        package = caller_globals.get('__name__', '').rpartition('.')[0]
+    if package and sys.modules.get(package + '.' + name) is not None:
+        return sys.modules[package + '.' + name]
+    return sys.modules.get(name)
+
+
+def find_loaded(dotted_name, caller_globals):
+    '''
+        returns object by it's full name ('module.Class') if
+        it's module is already imported, or None. Nothing is imported.
+    '''
+    parts = dotted_name.split('.')
+    for split in range(len(parts) - 1, 0, -1):
+        obj = loaded('.'.join(parts[:split]), caller_globals)
+        if obj is None:
+            continue
+        try:
+            for part in parts[split:]:
+                obj = getattr(obj, part)
+        except AttributeError:
+            return None
+        return obj
+    return None
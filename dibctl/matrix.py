@@ -0,0 +1,285 @@
+import sys
+import copy
+import json
+import time
+import tempfile
+import itertools
+import collections
+import config
+import parallel
+import prepare_os
+import do_tests
+
+'''Test one image in many test environments (flavors, zones) at once'''
+
+DEFAULT_WORKERS = 8
+POLL_INTERVAL = 0.1
+PASSED = 'passed'
+FAILED = 'failed'
+ERROR = 'error'
+
+
+def _raw(item):
+    return getattr(item, 'config', item)
+
+
+class Cell(object):
+    '''
+        One test run of the matrix: test environment with optional
+        flavor and availability zone overrides.
+    '''
+
+    def __init__(self, env_label, test_env, flavor=None, availability_zone=None):
+        self.env_label = env_label
+        self.flavor = flavor
+        self.availability_zone = availability_zone
+        self.test_env = self.override(test_env, flavor, availability_zone)
+        self.result = None
+        self.error = None
+        self.duration = None
+
+    @property
+    def name(self):
+        return '/'.join(
+            filter(None, [self.env_label, self.flavor, self.availability_zone])
+        )
+
+    @staticmethod
+    def override(test_env, flavor, availability_zone):
+        if not flavor and not availability_zone:
+            return test_env
+        raw = copy.deepcopy(_raw(test_env))
+        nova = raw.setdefault('nova', {})
+        if flavor:
+            nova.pop('flavor_id', None)
+            nova['flavor'] = flavor
+        if availability_zone:
+            nova['availability_zone'] = availability_zone
+        return config.Config(raw)
+
+    def cloud(self):
+        '''
+            Key of the cloud (credentials and glance endpoint),
+            cells with the same key share uploaded image.
+        '''
+        return json.dumps([
+            _raw(self.test_env.get('keystone', {})),
+            self.test_env.get('glance.endpoint')
+        ], sort_keys=True)
+
+
+def make_cells(test_env_config, env_labels, flavors=None, zones=None):
+    '''all combinations of environments, flavors and zones'''
+    return [
+        Cell(label, test_env_config[label], flavor, zone)
+        for label, flavor, zone in itertools.product(
+            env_labels, flavors or [None], zones or [None]
+        )
+    ]
+
+
+class CellProcess(do_tests.EntryProcess):
+    '''
+        Cell tested in a forked process. Error message of the cell
+        is passed to us through 'errors' file.
+    '''
+
+    def __init__(self, cell, uploader):
+        super(CellProcess, self).__init__(None, None)
+        self.cell = cell
+        self.uploader = uploader
+        self.errors = tempfile.TemporaryFile(prefix='dibctl_matrix_')
+        self.started = None
+
+    def start(self, run):
+        self.started = time.time()
+        super(CellProcess, self).start(run)
+
+    def finish(self):
+        '''sets result of the cell and prints it's output'''
+        cell = self.cell
+        cell.duration = time.time() - self.started
+        if self.returncode == do_tests.EXIT_PASSED:
+            cell.result = PASSED
+        elif self.returncode == do_tests.EXIT_FAILED:
+            cell.result = FAILED
+        else:
+            cell.result = ERROR
+            self.errors.seek(0)
+            cell.error = self.errors.read().strip() or (
+                'cancelled' if self.cancel_time else 'crashed'
+            )
+        self.errors.close()
+        self.report()
+
+    def report(self):
+        if self.output:
+            print("Output of %s:" % self.cell.name)
+            sys.stdout.flush()
+            self.output.seek(0)
+            sys.stdout.write(self.output.read())
+            self.output.close()
+            self.output = None
+        sys.stdout.flush()
+
+
+class TestMatrix(object):
+    '''
+        Uploads image once per cloud, then runs DoTests for all
+        cells of this cloud concurrently (up to 'workers' at once),
+        removes uploaded image and prints summary table.
+        Cells are tested in processes forked from the main thread
+        after uploads are done (pytest runs in-process and is not
+        thread-safe, and forking is safe only without other threads).
+    '''
+
+    def __init__(
+        self,
+        image,
+        cells,
+        workers=DEFAULT_WORKERS,
+        keep_failed_image=False,
+        keep_failed_instance=False,
+        continue_on_fail=False
+    ):
+        self.image = image
+        self.cells = cells
+        self.workers = workers
+        self.keep_failed_image = keep_failed_image
+        self.keep_failed_instance = keep_failed_instance
+        self.continue_on_fail = continue_on_fail
+
+    def clouds(self):
+        result = collections.OrderedDict()
+        for cell in self.cells:
+            result.setdefault(cell.cloud(), []).append(cell)
+        return list(result.values())
+
+    def upload(self, cells):
+        '''returns PrepOS which owns uploaded image'''
+        uploader = prepare_os.PrepOS(self.image, cells[0].test_env)
+        uploader.connect()
+        uploader.upload_image(uploader.upload_timeout)
+        return uploader
+
+    def run_cell(self, cell, image_uuid, errors):
+        '''
+            tests cell (in the forked process), returns exit code,
+            error message is written into errors file
+        '''
+        dt = do_tests.DoTests(
+            self.image,
+            cell.test_env,
+            image_uuid=image_uuid,
+            continue_on_fail=self.continue_on_fail,
+            keep_failed_instance=self.keep_failed_instance
+        )
+        try:
+            if dt.process(shell_only=False, shell_on_errors=False):
+                return do_tests.EXIT_PASSED
+            return do_tests.EXIT_FAILED
+        except Exception as e:
+            print("Error: %s" % e)
+            errors.write(str(e))
+            errors.flush()
+            return do_tests.EXIT_ERROR
+        finally:
+            sys.stdout.flush()
+
+    def upload_cloud(self, cells):
+        '''returns uploader, or None (cells are marked as failed)'''
+        try:
+            return self.upload(cells)
+        except Exception as e:
+            print("Unable to upload image for %s: %s" % (cells[0].name, e))
+            for cell in cells:
+                cell.result = ERROR
+                cell.error = e
+            return None
+
+    def cleanup_cloud(self, cloud):
+        cells, uploader = cloud
+        failed = any(cell.result != PASSED for cell in cells)
+        if self.keep_failed_image and failed:
+            uploader.update_image_delete_status(delete=False)
+        uploader.cleanup_image()
+
+    def run_cells(self, clouds):
+        '''
+            tests cells of each (cells, uploader) cloud, up to
+            'workers' per cloud at once
+        '''
+        queues = [
+            [CellProcess(cell, uploader) for cell in cells]
+            for cells, uploader in clouds
+        ]
+        active = []
+        try:
+            while True:
+                for process in list(active):
+                    if process.poll():
+                        active.remove(process)
+                        process.finish()
+                for queue in queues:
+                    while queue and len([
+                        p for p in active if p.uploader is queue[0].uploader
+                    ]) < self.workers:
+                        process = queue.pop(0)
+                        process.start(lambda process=process: self.run_cell(
+                            process.cell,
+                            process.uploader.os_image.id,
+                            process.errors
+                        ))
+                        active.append(process)
+                if not active and not any(queues):
+                    break
+                time.sleep(POLL_INTERVAL)
+        finally:
+            while active:  # interrupted
+                for process in list(active):
+                    if process.poll():
+                        active.remove(process)
+                        process.finish()
+                    else:
+                        process.cancel()
+                time.sleep(POLL_INTERVAL)
+
+    def run(self):
+        '''returns True if all cells passed'''
+        clouds = self.clouds()
+        uploads = parallel.run_parallel(self.upload_cloud, clouds, len(clouds))
+        uploaded = [
+            (cells, result.value)
+            for cells, result in zip(clouds, uploads) if result.value
+        ]
+        try:
+            self.run_cells(uploaded)
+        finally:
+            cleanups = parallel.run_parallel(
+                self.cleanup_cloud, uploaded, len(uploaded)
+            )
+            for result in cleanups:
+                if result.error:
+                    print("Unable to remove image for %s: %s" % (
+                        result.item[0][0].name, result.error
+                    ))
+        self.report()
+        return all(cell.result == PASSED for cell in self.cells)
+
+    def report(self):
+        width = max([len(cell.name) for cell in self.cells] + [11])
+        print("\nTest matrix results:")
+        print("%-*s %-7s %8s" % (width, "Environment", "Result", "Time"))
+        for cell in self.cells:
+            duration = '-'
+            if cell.duration is not None:
+                duration = '%.1f s' % cell.duration
+            line = "%-*s %-7s %8s" % (
+                width, cell.name, cell.result or ERROR, duration
+            )
+            if cell.error:
+                line += "  %s" % cell.error
+            print(line)
+        passed = len([c for c in self.cells if c.result == PASSED])
+        print("%s of %s passed" % (passed, len(self.cells)))
+        sys.stdout.flush()
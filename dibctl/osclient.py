@@ -1,9 +1,13 @@
 import glanceclient
 import logging
+import atexit
+import weakref
 from keystoneauth1 import identity
 from keystoneauth1 import session
 import novaclient.client
 import re
+import time
+import calendar
 from functools import partial
 import requests
 import urllib3
@@ -11,6 +15,9 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import simplejson
 import copy
 import config
+import image_upload
+import auth_cache
+import parallel
 
 
 class UnknownPolicy(ValueError):
@@ -61,6 +68,22 @@ class MultipleIPError(IPError):
     pass
 
 
+_auth_clients = weakref.WeakSet()  # clients with auth state to save at exit
+
+
+@atexit.register
+def save_auth_states():
+    '''
+        stores auth state of live clients, once per auth cache id
+        (clients with the same credentials share the state)
+    '''
+    latest = {}
+    for client in list(_auth_clients):
+        latest[client.auth_cache_id] = client
+    for client in latest.values():
+        client.save_auth_state()
+
+
 # all those '_smart' functions should be somewhere in config part...
 def _smart_merge(target, key, orig1, orig2, policy='second'):
     if policy == 'first':  # orig1 have priority over orig2
@@ -118,6 +141,10 @@ def smart_join_glance_config(img_conf, env_conf):
 class OSClient(object):
     OS_CACERT = '/etc/ssl/certs'
     OBSOLETE_PREFIX = "Obsolete"
+    IMAGE_REF_PREFIX = "dibctl_ref_"
+    IMAGE_REF_TTL = 24 * 3600  # refs of crashed runs expire
+    auth_cache = None
+    LIST_PAGE_SIZE = 1000
     SUPPORTED_VERSIONS = set(('v2', 'v3'))
     OPTION_NAMINGS = {
         'username': {
@@ -190,8 +217,13 @@ class OSClient(object):
         ca_path='/etc/ssl/certs',
         insecure=False,
         disable_warnings=False,
-        debug=False
+        debug=False,
+        use_auth_cache=False
     ):
+        '''
+            use_auth_cache - reuse discovered keystone version and
+            token (with service catalog) from previous runs
+        '''
         self.debug = debug
         if debug:
             logging.basicConfig(level=logging.DEBUG)
@@ -206,6 +238,8 @@ class OSClient(object):
         if disable_warnings:
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
             urllib3.disable_warnings()
+        if use_auth_cache:
+            self.auth_cache = auth_cache.AuthCache()
         self._set_api_version(dict(keystone_data), insecure)
         self.auth = self._prepare_auth(dict(keystone_data), overrides)
         self.session = self.create_session(
@@ -213,6 +247,8 @@ class OSClient(object):
             self.auth,
             insecure
         )
+        if self.auth_cache:
+            self._restore_auth_state()
         self.nova = self.get_nova(self.session)
         self.glance = self.get_glance(self.session)
 
@@ -236,6 +272,55 @@ class OSClient(object):
             timeout=timeout
         )
 
+    def _use_auth_cache(self, method, *args):
+        '''
+            calls method of auth cache, disables cache
+            (with a warning) if it's unusable
+        '''
+        if not self.auth_cache:
+            return None
+        try:
+            return getattr(self.auth_cache, method)(*args)
+        except EnvironmentError as e:
+            print("Auth cache is disabled: %s" % e)
+            self.auth_cache = None
+            return None
+
+    def _restore_auth_state(self):
+        auth = self.session.auth
+        self.auth_cache_id = auth.get_cache_id()
+        self.cached_auth_state = self._use_auth_cache(
+            'get_auth_state', self.auth_cache_id
+        )
+        if self.cached_auth_state:
+            auth.set_auth_state(self.cached_auth_state)
+        _auth_clients.add(self)
+
+    def save_auth_state(self):
+        '''
+            stores current token (if it was changed) for the next runs
+        '''
+        if not self.auth_cache:
+            return
+        state = self.session.auth.get_auth_state()
+        if state and state != self.cached_auth_state:
+            self._use_auth_cache('set_auth_state', self.auth_cache_id, state)
+            self.cached_auth_state = state
+
+    def set_connection_pool(self, size):
+        '''
+            limits number of http connections per host to 'size',
+            concurrent requests beyond that wait for a free connection
+            instead of opening (and dropping) extra ones
+        '''
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=size,
+            pool_maxsize=size,
+            pool_block=True
+        )
+        for prefix in ('https://', 'http://'):
+            self.session.session.mount(prefix, adapter)
+
     @staticmethod
     def get_nova(session):
         return novaclient.client.Client('2', session=session)
@@ -296,12 +381,18 @@ class OSClient(object):
                     force_api_version
                 )
         else:
+            auth_url = keystone_data.get('auth_url')
+            cached_version = self._use_auth_cache('get_version', auth_url)
+            if self._issupported_version(cached_version, local_versions):
+                self.api_version = cached_version
+                return
             try:
                 self.api_version = self._ask_for_version(
                     keystone_data,
                     local_versions,
                     insecure
                 )
+                self._use_auth_cache('set_version', auth_url, self.api_version)
             except DiscoveryError as e:
                 message = 'Unable to discover keystone version.' \
                           'Try to use "version" variable to force' \
@@ -368,7 +459,7 @@ class OSClient(object):
         # there is a bug in vcrpy with fileobject, this is a workaround
         # to make monkeypatching easier (patched version do open().read())
         # see https://github.com/kevin1024/vcrpy/issues/218
-        return open(filename, 'rb', buffering=65536)
+        return image_upload.open_source(filename)
 
     def upload_image(
         self,
@@ -381,13 +472,20 @@ class OSClient(object):
         disk_format="qcow2",
         container_format="bare",
         share_with_tenants=[],
-        meta={}
+        meta={},
+        resume=True,
+        source=None
     ):
+        '''
+            source - callable, which returns file-like object with
+            image data. By default 'filename' is read. Custom sources
+            (streams) can't be reread, so failed upload is not retried.
+        '''
         if public:
             visibility = "public"
         else:
             visibility = "shared"
-        img = self.glance.images.create(
+        create_args = dict(
             name=name,
             visibility=visibility,
             disk_format=disk_format,
@@ -395,18 +493,39 @@ class OSClient(object):
             min_disk=min_disk,
             min_ram=min_ram,
             protected=protected,
-
         )
-        cleanup_meta = dict((str(k),str(v)) for (k,v) in meta.items())  # force everything to stringify
-        self.glance.images.update(img.id, **dict(cleanup_meta))
-        self.glance.images.upload(img.id, self._file_to_upload(filename))
-
+        cleanup_meta = dict((str(k), str(v)) for (k, v) in meta.items())  # force everything to stringify
+        if resume:
+            state = image_upload.UploadState()
+        else:
+            state = None
+        if source:
+            retries = 0
+        else:
+            source = partial(self._file_to_upload, filename)
+            retries = image_upload.UPLOAD_RETRIES
+        uploader = image_upload.ImageUploader(
+            self.glance,
+            state=state,
+            location=self.location(),
+            retries=retries,
+            hash_cache=image_upload.HashCache()
+        )
+        img = uploader.upload(filename, source, create_args, cleanup_meta)
 
         if share_with_tenants:
             self.share_image(img, share_with_tenants)
 
         return img
 
+    def location(self):
+        'identifies cloud and project we are working with'
+        auth = getattr(self, 'auth', {})
+        return "%s/%s" % (
+            auth.get('auth_url'),
+            auth.get('project_name', auth.get('tenant_name'))
+        )
+
     def share_image(self, img, tenant_name_list):
         raise NotImplementedError("Image sharing not implemented!")
 
@@ -430,6 +549,60 @@ class OSClient(object):
     def delete_image(self, image_id):
         self.glance.images.delete(image_id)
 
+    def find_images_by_hash(self, sha256):
+        'active images with the same content (uploaded by dibctl)'
+        return list(self.glance.images.list(filters={
+            image_upload.HASH_PROPERTY: sha256,
+            'status': 'active'
+        }))
+
+    def find_images_by_property(self, name, value):
+        return list(self.glance.images.list(filters={name: value}))
+
+    @classmethod
+    def image_ref_property(cls, ref):
+        '''
+            property which marks image as used by 'ref'. Each user
+            has own property, so concurrent users do not overwrite
+            each other
+        '''
+        return {cls.IMAGE_REF_PREFIX + ref: str(int(time.time()))}
+
+    def add_image_ref(self, image_id, ref):
+        self.glance.images.update(image_id, **self.image_ref_property(ref))
+
+    def remove_image_ref(self, image_id, ref):
+        self.glance.images.update(
+            image_id,
+            remove_props=[self.IMAGE_REF_PREFIX + ref]
+        )
+
+    def image_refs(self, img):
+        'returns list of not expired refs of the image'
+        refs = []
+        now = time.time()
+        for key, value in dict(img).items():
+            if not key.startswith(self.IMAGE_REF_PREFIX):
+                continue
+            try:
+                expired = now - int(value) > self.IMAGE_REF_TTL
+            except ValueError:
+                expired = False
+            if not expired:
+                refs.append(key[len(self.IMAGE_REF_PREFIX):])
+        return refs
+
+    @staticmethod
+    def image_age(img):
+        'seconds since image creation, None if unknown'
+        try:
+            created = calendar.timegm(time.strptime(
+                img.created_at, '%Y-%m-%dT%H:%M:%SZ'
+            ))
+        except (AttributeError, TypeError, ValueError):
+            return None
+        return time.time() - created
+
     def new_keypair(self, name):
         return self.nova.keypairs.create(name)
 
@@ -458,30 +631,123 @@ class OSClient(object):
     def get_instance(self, instance_uuid):
         return self.nova.servers.get(instance_uuid)
 
-    def _all_used_images(self):
-        all_instances = self.nova.servers.list(search_opts={'all_tenants': 1})
-        for instance in all_instances:
-            if instance.image:
-                yield instance.image["id"]
-            # else:
-                # print("Image for instance %s has been deleted" % instance)
-
-    def find_obsolete_unused_candidates(self, namefilter=None):
-        if namefilter:
-            all_obsolete_images = self.glance.images.list(
-                filters={
-                    'obsolete': 'true',
-                    'name': self.OBSOLETE_PREFIX + " " + namefilter
-                }
+    def rebuild_instance(self, instance_uuid, image):
+        return self.nova.servers.rebuild(instance_uuid, image)
+
+    def _all_used_images(self, page_size=LIST_PAGE_SIZE):
+        '''
+            yields ids of images used by instances in all tenants.
+            Instances are listed page by page, only image ids
+            are kept from each page.
+        '''
+        marker = None
+        while True:
+            page = self.nova.servers.list(
+                search_opts={'all_tenants': 1},
+                marker=marker,
+                limit=page_size
             )
-        else:
-            all_obsolete_images = self.glance.images.list(
-                filters={'obsolete': 'true'}
+            if not page:
+                return
+            for instance in page:
+                if instance.image:
+                    yield instance.image["id"]
+                # else:
+                    # print("Image for instance %s has been deleted" % instance)
+            marker = page[-1].id
+
+    def _obsolete_images(self, namefilter=None, page_size=LIST_PAGE_SIZE):
+        filters = {'obsolete': 'true'}
+        if namefilter:
+            filters['name'] = self.OBSOLETE_PREFIX + " " + namefilter
+        return set(
+            image.id for image in self.glance.images.list(
+                filters=filters,
+                page_size=page_size
             )
-        used_images_set = set(self._all_used_images())
-        obsolete_images_set = set(image.id for image in all_obsolete_images)
+        )
+
+    def _obsolete_images_by_name(self, page_size=LIST_PAGE_SIZE):
+        'returns dict of original name: set of obsolete images ids'
+        prefix = self.OBSOLETE_PREFIX + " "
+        result = {}
+        for image in self.glance.images.list(
+            filters={'obsolete': 'true'},
+            page_size=page_size
+        ):
+            name = getattr(image, 'name', None) or ''
+            if name.startswith(prefix):
+                result.setdefault(name[len(prefix):], set()).add(image.id)
+        return result
+
+    def _list_with_used_images(self, list_images, page_size):
+        '''
+            Lists instances and images (by calling list_images())
+            concurrently, returns images and set of used images ids
+        '''
+        results = parallel.run_parallel(
+            lambda task: task(),
+            [list_images, lambda: set(self._all_used_images(page_size))],
+            workers=2
+        )
+        for result in results:
+            if result.error:
+                raise result.error
+        return [r.value for r in results]
+
+    def find_obsolete_unused_candidates(
+        self,
+        namefilter=None,
+        page_size=LIST_PAGE_SIZE
+    ):
+        '''
+            returns set of ids of obsolete images which are not
+            used by any instance.
+        '''
+        obsolete_images_set, used_images_set = self._list_with_used_images(
+            partial(self._obsolete_images, namefilter, page_size),
+            page_size
+        )
         return obsolete_images_set - used_images_set
 
+    def find_obsolete_unused_candidates_by_name(
+        self,
+        names,
+        page_size=LIST_PAGE_SIZE
+    ):
+        '''
+            same as find_obsolete_unused_candidates for a few names,
+            but instances and images are listed only once for all
+            of them. Returns dict of name: set of images ids
+        '''
+        obsolete_by_name, used_images_set = self._list_with_used_images(
+            partial(self._obsolete_images_by_name, page_size),
+            page_size
+        )
+        return dict(
+            (name, obsolete_by_name.get(name, set()) - used_images_set)
+            for name in names
+        )
+
+    @staticmethod
+    def _transient_error(error):
+        'client errors (4xx, like image in use or protected) are permanent'
+        code = getattr(error, 'code', None)
+        return not isinstance(code, int) or code >= 500
+
+    def delete_images(self, image_ids, workers=parallel.DEFAULT_WORKERS):
+        '''
+            deletes images using up to 'workers' threads, retrying
+            failed (not due to client errors) deletions with backoff.
+            Returns list of parallel.Result for each image id.
+        '''
+        def delete(image_id):
+            parallel.retry(
+                partial(self.delete_image, image_id),
+                should_retry=self._transient_error
+            )
+        return parallel.run_parallel(delete, image_ids, workers)
+
     def delete_instance(self, uuid):
         self.nova.servers.delete(uuid)
 
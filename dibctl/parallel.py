@@ -0,0 +1,75 @@
+import time
+import random
+import collections
+from multiprocessing.pool import ThreadPool
+
+'''Helpers to run independent operations concurrently'''
+
+DEFAULT_WORKERS = 4
+WAIT_FOREVER = 365 * 24 * 3600
+RETRY_ATTEMPTS = 3
+RETRY_DELAY = 1
+
+
+Result = collections.namedtuple('Result', ['item', 'value', 'error'])
+
+
+def _call(func, item):
+    try:
+        return Result(item, func(item), None)
+    except Exception as e:
+        return Result(item, None, e)
+
+
+def run_parallel(func, items, workers=DEFAULT_WORKERS):
+    '''
+        calls func(item) for each item, using up to 'workers'
+        threads. Never raises for errors in func, instead returns
+        list of Result(item, value, error) in the same order as items.
+    '''
+    items = list(items)
+    if not items:
+        return []
+    workers = max(1, min(workers, len(items)))
+    if workers == 1:
+        return [_call(func, item) for item in items]
+    pool = ThreadPool(workers)
+    try:
+        async_results = [
+            pool.apply_async(_call, (func, item)) for item in items
+        ]
+        # get() with a timeout keeps main thread interruptable by Ctrl-C
+        return [r.get(WAIT_FOREVER) for r in async_results]
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def batches(items, size):
+    '''splits items into lists of at most 'size' elements'''
+    items = list(items)
+    size = max(1, size)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def retry(
+    func,
+    attempts=RETRY_ATTEMPTS,
+    delay=RETRY_DELAY,
+    backoff=2,
+    should_retry=lambda e: True
+):
+    '''
+        calls func() up to 'attempts' times until it succeed.
+        Delay between attempts grows 'backoff' times after
+        each attempt (with a small random jitter).
+        Errors for which should_retry(error) is False are
+        raised immediately.
+    '''
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            if attempt + 1 >= attempts or not should_retry(e):
+                raise
+        time.sleep(delay * (backoff ** attempt) * random.uniform(1, 1.25))
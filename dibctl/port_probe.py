@@ -0,0 +1,85 @@
+import time
+import errno
+import select
+import socket
+
+'''Non-blocking TCP port probe for a few addresses at once'''
+
+CONNECT_TIMEOUT = 3
+BANNER_SIZE = 256
+IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def _family(address):
+    if ':' in address:
+        return socket.AF_INET6
+    return socket.AF_INET
+
+
+def _start_connect(address, port):
+    '''returns non-blocking socket with connection in progress or None'''
+    try:
+        sock = socket.socket(_family(address), socket.SOCK_STREAM)
+    except socket.error:
+        return None
+    sock.setblocking(0)
+    if sock.connect_ex((address, port)) in IN_PROGRESS:
+        return sock
+    sock.close()
+    return None
+
+
+def _has_banner(sock, banner, deadline):
+    '''waits (up to deadline) for data starting with banner'''
+    data = b''
+    while len(data) < len(banner):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        readable = select.select([sock], [], [], remaining)[0]
+        if not readable:
+            return False
+        try:
+            chunk = sock.recv(BANNER_SIZE)
+        except socket.error:
+            return False
+        if not chunk:
+            return False
+        data += chunk
+    return data.startswith(banner)
+
+
+def probe(addresses, port, timeout=CONNECT_TIMEOUT, banner=None):
+    '''
+        Connects to port on all addresses concurrently.
+        Returns first address which accepted connection
+        (and sent data starting with banner, if banner is given),
+        or None if none of them did within timeout.
+        All sockets are closed before return.
+    '''
+    deadline = time.time() + timeout
+    pending = {}
+    try:
+        for address in addresses:
+            sock = _start_connect(address, port)
+            if sock:
+                pending[sock] = address
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            writable = select.select([], list(pending), [], remaining)[1]
+            for sock in writable:
+                address = pending.pop(sock)
+                try:
+                    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error == 0 and (
+                        banner is None or _has_banner(sock, banner, deadline)
+                    ):
+                        return address
+                finally:
+                    sock.close()
+        return None
+    finally:
+        for sock in pending:
+            sock.close()
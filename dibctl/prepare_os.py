@@ -2,13 +2,21 @@ import osclient
 import timeout
 import sys
 import uuid
-import socket
+import collections
 import time
 import os
 import json
+import hashlib
+import threading
+import cache
+import parallel
 import config
 import ssh
 import ipaddress
+import image_upload
+import waiter
+import port_probe
+import async_osclient
 
 
 class TimeoutError(EnvironmentError):
@@ -27,6 +35,91 @@ class FlavorError(EnvironmentError):
     pass
 
 
+ExistingKeypair = collections.namedtuple(
+    'ExistingKeypair', ['id', 'name', 'private_key']
+)
+
+REUSE_FILE_NAME = 'reusable_instances.json'
+REUSE_KEYS_DIR = 'reusable_instance_keys'
+
+
+def _raw(item):
+    return getattr(item, 'config', item)
+
+
+class InstanceMetadata(object):
+    '''
+        Snapshot of instance data which doesn't change while tests
+        run: network interfaces, flavor extra specs, image of the
+        instance and environment for shell tests built from them.
+        API values are fetched at once (concurrently) after instance
+        become active, so tests don't repeat the same requests.
+        Missing values are fetched on first use, refresh() fetches
+        everything again.
+    '''
+
+    API_VALUES = ('interfaces', 'flavor_keys', 'image_info')
+
+    def __init__(self, prep_os):
+        self.prep_os = prep_os
+        self.values = {}
+        self.lock = threading.RLock()
+
+    def fetchers(self):
+        p = self.prep_os
+        return {
+            'interfaces': lambda: p.os_instance.interface_list(),
+            'flavor_keys': lambda: p.flavor.get_keys(),
+            'image_info': lambda: p.get_image(p.os_instance.image['id']),
+            'env_config': p.build_env_config
+        }
+
+    def fetch(self):
+        '''fetches API values, failed ones are left for get()'''
+        fetchers = self.fetchers()
+        results = parallel.run_parallel(
+            lambda name: fetchers[name](),
+            self.API_VALUES,
+            len(self.API_VALUES)
+        )
+        with self.lock:
+            for result in results:
+                if result.error:
+                    print("Unable to get instance %s: %s" % (
+                        result.item, result.error
+                    ))
+                else:
+                    self.values[result.item] = result.value
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.values:
+                self.values[name] = self.fetchers()[name]()
+            return self.values[name]
+
+    def refresh(self):
+        with self.lock:
+            self.values = {}
+        self.fetch()
+
+
+def connect(test_environment, glance_data=None):
+    return osclient.OSClient(
+        keystone_data=test_environment['keystone'],
+        nova_data=test_environment['nova'],
+        glance_data=glance_data,
+        neutron_data=test_environment.get('neutron'),
+        overrides=os.environ,
+        ca_path=test_environment.get(
+            'ssl_ca_path',
+            '/etc/ssl/certs'
+        ),
+        insecure=test_environment.get('ssl_insecure', False),
+        disable_warnings=test_environment.get('disable_warnings'),
+        use_auth_cache=test_environment.get('auth_cache', False)
+    )
+
+
 class PrepOS(object):
     '''
         Provides test-specific image/instance/keypair
@@ -35,10 +128,14 @@ class PrepOS(object):
     LONG_OS_TIMEOUT = 360
     SHORT_OS_TIMEOUT = 10
     SLEEP_DELAY = 3
+    TEST_IMAGE_PROPERTY = 'dibctl_test_image'
+    TEST_IMAGE_MIN_AGE = 3600  # younger unused test images are not removed
 
     def __init__(self, image, test_environment, override_image=None,
-                 delete_image=True, delete_instance=True):
+                 delete_image=True, delete_instance=True,
+                 override_instance=None, private_key_file=None):
         self.os = None
+        self.timings = waiter.Timings()
         self.set_timeouts(image, test_environment)
         self.test_environment = test_environment
         self.report = True  # refactor me!
@@ -49,7 +146,15 @@ class PrepOS(object):
 
         self.prepare_key()
         self.prepare_instance(test_environment, delete_instance)
+        self.reuse_instance = image.get('tests.reuse_instance', False)
+        if self.reuse_instance and self.userdata:
+            print("Test instance is not reused: rebuild doesn't apply userdata")
+            self.reuse_instance = False
+        self.tests_passed = False  # only instances which passed tests are reused
+        if override_instance:
+            self.prepare_override_instance(override_instance, private_key_file)
         self.ssh = None
+        self.metadata = InstanceMetadata(self)
         self.combined_glance_section = osclient.smart_join_glance_config(
             image.get('glance', {}),
             test_environment.get('glance', {})
@@ -94,6 +199,7 @@ class PrepOS(object):
         self.os_image = None
         self.override_image = False
         self.image_was_removed = False
+        self.reuse_image = image_item.get('tests.reuse_identical_image', False)
 
     def prepare_override_image(self, image_item, override_image_uuid):
         self.image = image_item
@@ -103,6 +209,7 @@ class PrepOS(object):
         self.delete_image = False
         self.override_image = True  # refactor me
         self.image_was_removed = False
+        self.reuse_image = False
 
     def get_image(self, image):
         self.connect()
@@ -114,6 +221,7 @@ class PrepOS(object):
         self.delete_keypair = True
         self.override_keypair = None
         self.keypair_was_removed = False
+        self.private_key_file = None
 
     def guess_flavor(self, tenv_item):
         self.connect()
@@ -143,6 +251,20 @@ class PrepOS(object):
         self.main_nic_regexp = tenv_item['nova'].get('main_nic_regexp', None)
         self.override_instance = None
         self.instance_was_removed = False
+        self.flavor = None
+
+    def prepare_override_instance(self, instance_uuid, private_key_file):
+        '''
+            use existing instance (and it's keypair) instead of
+            creating new one. Nothing of it will be removed.
+        '''
+        self.override_instance = instance_uuid
+        self.override_keypair = True
+        self.private_key_file = private_key_file
+        self.delete_instance = False
+        self.delete_keypair = False
+        self.delete_image = False
+        self.reuse_instance = False
 
     def _userdata(self, tenv_item):
         if 'nova.userdata' in tenv_item:
@@ -155,19 +277,7 @@ class PrepOS(object):
     def connect(self):
         if not self.os:
             print("Connecting to Openstack")
-            self.os = osclient.OSClient(
-                keystone_data=self.test_environment['keystone'],
-                nova_data=self.test_environment['nova'],
-                glance_data=self.image.get('glance'),
-                neutron_data=self.test_environment.get('neutron'),
-                overrides=os.environ,
-                ca_path=self.test_environment.get(
-                    'ssl_ca_path',
-                    '/etc/ssl/certs'
-                ),
-                insecure=self.test_environment.get('ssl_insecure', False),
-                disable_warnings=self.test_environment.get('disable_warnings')
-            )
+            self.os = connect(self.test_environment, self.image.get('glance'))
 
     @staticmethod
     def prepare_nics(env):
@@ -208,25 +318,74 @@ class PrepOS(object):
                 protected = self.combined_glance_section.get(
                     'protected', False
                 )
-                print("Uploading image from %s (time limit is %s s)" % (
-                    filename, timeout_s
-                ))
-                self.os_image = self.os.upload_image(
-                    self.image_name,
-                    filename,
-                    disk_format=disk_format,
-                    container_format=container_format,
-                    min_disk=min_disk,
-                    min_ram=min_ram,
-                    protected=protected,
-                    meta=self.image['glance'].get('properties', {})
-                )
-                print("Image %s uploaded." % self.os_image.id)
+                meta = self.image['glance'].get('properties', {})
+                identical_image = None
+                if self.reuse_image:
+                    identical_image = self.find_identical_image(
+                        filename, disk_format, container_format, meta
+                    )
+                    meta = dict(meta)
+                    meta[self.TEST_IMAGE_PROPERTY] = self.image['glance']['name']
+                    # ref is set together with TEST_IMAGE_PROPERTY, so image
+                    # is never seen as unused by concurrent runs while uploading
+                    meta.update(osclient.OSClient.image_ref_property(self.image_name))
+                if identical_image:
+                    self.os_image = identical_image
+                    self.add_image_ref()
+                else:
+                    print("Uploading image from %s (time limit is %s s)" % (
+                        filename, timeout_s
+                    ))
+                    self.os_image = self.os.upload_image(
+                        self.image_name,
+                        filename,
+                        disk_format=disk_format,
+                        container_format=container_format,
+                        min_disk=min_disk,
+                        min_ram=min_ram,
+                        protected=protected,
+                        meta=meta
+                    )
+                    print("Image %s uploaded." % self.os_image.id)
+
+    def find_identical_image(self, filename, disk_format, container_format, meta):
+        '''
+            Looks for active image with the same content, formats
+            and properties (uploaded by previous test or upload)
+        '''
+        sha256 = image_upload.HashCache().sha256(filename)
+        for img in self.os.find_images_by_hash(sha256):
+            if getattr(img, 'disk_format', None) != disk_format:
+                continue
+            if getattr(img, 'container_format', None) != container_format:
+                continue
+            if any(
+                str(getattr(img, key, None)) != str(value)
+                for key, value in meta.items()
+            ):
+                continue
+            print("Found identical image %s (%s), will use it" % (
+                img.id, img.name
+            ))
+            return img
+        return None
+
+    def add_image_ref(self):
+        try:
+            self.os.add_image_ref(self.os_image.id, self.image_name)
+        except Exception as e:
+            print("Unable to mark image %s as used: %s" % (
+                self.os_image.id, e
+            ))
+
+    def resolve_flavor(self):
+        if not self.flavor:
+            self.flavor = self.guess_flavor(self.test_environment)
+        return self.flavor
 
     def spawn_instance(self, timeout_s):
         print("Creating test instance (time limit is %s s)" % timeout_s)
-        flavor = self.guess_flavor(self.test_environment)
-        self.flavor = flavor
+        flavor = self.resolve_flavor()
         with timeout.timeout(timeout_s):
             self.os_instance = self.os.boot_instance(
                 name=self.instance_name,
@@ -248,29 +407,54 @@ class PrepOS(object):
         return self.ip
 
     def get_image_info(self):
-        self.image_info = self.get_image(
-            self.os_instance.image['id']
-        )
+        self.image_info = self.metadata.get('image_info')
         return self.image_info
 
+    def refresh_metadata(self):
+        '''re-reads instance and it's metadata (f.e. after reboot)'''
+        self.os_instance = self.os.get_instance(self.os_instance.id)
+        self.metadata.refresh()
+
+    def waiter(self, name, timeout_s=None):
+        return waiter.Waiter(
+            name,
+            timeout=timeout_s,
+            max_delay=self.SLEEP_DELAY,
+            timings=self.timings,
+            clock=time.time,
+            sleep=time.sleep
+        )
+
+    def instance_is_active(self):
+        if self.os_instance.status in ('ERROR', 'DELETED'):
+            raise InstanceError(
+                "Instance %s state is '%s' (expected 'ACTIVE'). "
+                "Error message is: %s" % (
+                    self.os_instance.id,
+                    self.os_instance.status,
+                    self.os_instance.fault.get('message', 'no message')
+                )
+            )
+        return self.os_instance.status == 'ACTIVE'
+
     def wait_for_instance(self, timeout_s):
         print(
             "Waiting for instance to become active (time limit is %s s)" %
             timeout_s
         )
+
+        def refresh():
+            self.os_instance = self.os.get_instance(self.os_instance.id)
+            return self.instance_is_active()
+
         with timeout.timeout(timeout_s):
-            while self.os_instance.status != 'ACTIVE':
-                if self.os_instance.status in ('ERROR', 'DELETED'):
-                    raise InstanceError(
-                        "Instance %s state is '%s' (expected 'ACTIVE'). "
-                        "Error message is: %s" % (
-                            self.os_instance.id,
-                            self.os_instance.status,
-                            self.os_instance.fault.get('message', 'no message')
-                        )
-                    )
-                time.sleep(self.SLEEP_DELAY)
-                self.os_instance = self.os.get_instance(self.os_instance.id)
+            if not self.instance_is_active():
+                w = self.waiter('instance become active')
+                w.wait(refresh)
+                print("Instance become active in %.1f s (%s status checks)." % (
+                    w.elapsed, w.attempts
+                ))
+                return
         print("Instance become active.")
 
     def prepare_ssh(self):
@@ -280,21 +464,259 @@ class PrepOS(object):
                 ip=self.ip,
                 username=ssh_item['username'],
                 private_key=self.os_key.private_key,
-                port=ssh_item.get('port', 22)
+                port=ssh_item.get('port', 22),
+                override_ssh_key_filename=self.private_key_file,
+                multiplexing=ssh_item.get('multiplexing', True)
             )
 
-    def prepare(self):
-        self.init_keypair()
-        sys.stdout.flush()
-        self.upload_image(self.upload_timeout)
-        sys.stdout.flush()
-        self.spawn_instance(self.create_timeout)
+    def timed(self, name, func, *args):
+        '''calls func(*args), adds its duration to timings'''
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.timings.add(name, time.time() - start)
+            sys.stdout.flush()
+
+    def prepare_in_background(self, background):
+        '''
+            starts steps which are independent from image upload,
+            returns their AsyncResults with time limits. SIGALRM
+            can't interrupt other threads, so limits are enforced
+            by waiting for results.
+        '''
+        return [
+            (
+                background.submit(self.timed, 'keypair', self.init_keypair),
+                self.keypair_timeout
+            ),
+            (
+                background.submit(self.timed, 'flavor lookup', self.resolve_flavor),
+                self.create_timeout
+            )
+        ]
+
+    def prepare_existing_instance(self):
+        self.os_instance = self.os.get_instance(self.override_instance)
+        self.instance_name = self.os_instance.name
+        print("Using existing instance %s (%s)" % (
+            self.os_instance.id, self.instance_name
+        ))
+        private_key = None
+        if self.private_key_file:
+            with open(self.private_key_file, 'r') as f:
+                private_key = f.read()
+        self.os_key = ExistingKeypair(
+            self.os_instance.key_name,
+            self.os_instance.key_name,
+            private_key
+        )
+        if not self.os_image:
+            self.os_image = self.os.get_image(self.os_instance.image['id'])
+            self.image_name = self.os_image.name
+            self.override_image = True
+        self.flavor = self.os.get_flavor(self.os_instance.flavor['id'])
+        self.wait_for_instance(self.active_timeout)
+        self.get_instance_main_ip()
+        self.prepare_ssh()
+        self.timed('instance metadata', self.metadata.fetch)
         sys.stdout.flush()
+
+    def reuse_store(self):
+        return os.path.join(cache.cache_dir(), REUSE_FILE_NAME)
+
+    def reuse_key(self):
+        '''
+            instance is reused only by tests of the same image
+            with the same credentials and nova settings
+        '''
+        return hashlib.sha1(json.dumps([
+            self.image.get('glance.name'),
+            _raw(self.test_environment.get('keystone', {})),
+            _raw(self.test_environment.get('nova', {}))
+        ], sort_keys=True)).hexdigest()
+
+    def take_reusable_instance(self):
+        '''
+            removes instance kept by previous test from the store
+            (so concurrent tests never get the same instance),
+            returns it's record (with private key) or None
+        '''
+        filename = self.reuse_store()
+        with cache.locked_json(filename, {}) as data:
+            record = data.pop(self.reuse_key(), None)
+            if record:
+                cache.save_json(filename, data)
+        if not record:
+            return None
+        try:
+            with open(record['key_file'], 'r') as f:
+                record['private_key'] = f.read()
+            os.remove(record['key_file'])
+        except (IOError, OSError) as e:
+            print("Unable to read key for instance %s: %s" % (
+                record['instance_id'], e
+            ))
+            self.discard_reusable_instance(record)
+            return None
+        return record
+
+    def store_reusable_instance(self):
+        '''
+            stores instance and it's private key for the next test,
+            returns False if other test has already stored one
+        '''
+        key_file = os.path.join(
+            cache.cache_dir(REUSE_KEYS_DIR),
+            str(self.os_instance.id)
+        )
+        record = {
+            'instance_id': self.os_instance.id,
+            'keypair': self.os_key.name,
+            'key_file': key_file,
+            'image_id': self.os_image and self.os_image.id,
+            # shared image: our ref is kept, otherwise image is removed
+            'image_ref': self.reuse_image and self.image_name or None,
+            'delete_image': bool(self.delete_image and not self.reuse_image)
+        }
+        filename = self.reuse_store()
+        with cache.locked_json(filename, {}) as data:
+            if self.reuse_key() in data:
+                return False
+            fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.os_key.private_key)
+            data[self.reuse_key()] = record
+            cache.save_json(filename, data)
+        return True
+
+    def discard_reusable_instance(self, record):
+        self._cleanup(
+            'old instance %s' % record['instance_id'],
+            obj=record['instance_id'],
+            flag=True,
+            call=self.os.delete_instance
+        )
+        self._cleanup(
+            'old ssh key %s' % record['keypair'],
+            obj=record['keypair'],
+            flag=True,
+            call=self.os.delete_keypair
+        )
+        self.release_previous_image(record)
+
+    def release_previous_image(self, record):
+        '''
+            Image of the kept instance is kept too (some storage
+            backends can't remove images of existing instances),
+            until instance is rebuilt with a new image or removed.
+        '''
+        image_id = record.get('image_id')
+        if not image_id:
+            return
+        if record.get('image_ref'):
+            try:
+                self.os.remove_image_ref(image_id, record['image_ref'])
+            except Exception as e:
+                print("Unable to unmark image %s as used: %s" % (image_id, e))
+        elif self.os_image and image_id == self.os_image.id:
+            return
+        else:
+            self._cleanup(
+                'image %s of the old instance' % image_id,
+                obj=image_id,
+                flag=record.get('delete_image'),
+                call=self.os.delete_image
+            )
+
+    def rebuild_instance(self, record):
+        '''
+            rebuilds instance kept by previous test with the new image
+            (keypair, flavor, ports and volumes are kept).
+            If rebuild fails, instance is removed and False is returned.
+        '''
+        print("Rebuilding instance %s (time limit is %s s)" % (
+            record['instance_id'], self.create_timeout
+        ))
+        try:
+            with timeout.timeout(self.create_timeout):
+                self.os_instance = self.os.rebuild_instance(
+                    record['instance_id'],
+                    self.os_image
+                )
+            self.os_key = ExistingKeypair(
+                record['keypair'],
+                record['keypair'],
+                record['private_key']
+            )
+            self.wait_for_instance(self.active_timeout)
+            self.instance_name = self.os_instance.name
+            self.flavor = self.os.get_flavor(self.os_instance.flavor['id'])
+        except Exception as e:
+            print("Unable to rebuild instance %s: %s" % (
+                record['instance_id'], e
+            ))
+            print("Will create new instance")
+            self.os_instance = None
+            self.os_key = None
+            self.discard_reusable_instance(record)
+            return False
+        print("Instance %s rebuilt." % self.os_instance.id)
+        self.release_previous_image(record)
+        return True
+
+    def create_instance(self, upload):
+        '''
+            Keypair and flavor are prepared while image is uploading
+            (upload stays in the main thread), all of them are finished
+            before boot. Background steps are always waited for (up to
+            their time limits, counted from their start), so cleanup
+            after failure sees everything they have created.
+        '''
+        with async_osclient.AsyncOSClient(
+            self.os, workers=2, limit_pool=False
+        ) as background:
+            started = time.time()
+            pending = self.prepare_in_background(background)
+            try:
+                if upload:
+                    self.timed(
+                        'image upload', self.upload_image, self.upload_timeout
+                    )
+            finally:
+                results = [
+                    background.wait([step], limit, started)[0]
+                    for step, limit in pending
+                ]
+            for result in results:
+                if result.error:
+                    raise result.error
+        self.timed('instance boot', self.spawn_instance, self.create_timeout)
         self.wait_for_instance(self.active_timeout)
+
+    def prepare(self):
+        '''
+            In reuse_instance mode instance kept by previous test
+            is rebuilt with the new image, new instance is created
+            if there is no such instance or rebuild has failed.
+        '''
+        if self.override_instance:
+            return self.prepare_existing_instance()
+        record = None
+        if self.reuse_instance:
+            record = self.take_reusable_instance()
+        if record:
+            self.timed('image upload', self.upload_image, self.upload_timeout)
+            rebuilt = self.timed('instance rebuild', self.rebuild_instance, record)
+            if not rebuilt:
+                self.create_instance(upload=False)
+        else:
+            self.create_instance(upload=True)
         sys.stdout.flush()
         self.get_instance_main_ip()
         sys.stdout.flush()
         self.prepare_ssh()
+        self.timed('instance metadata', self.metadata.fetch)
         sys.stdout.flush()
 
     @staticmethod
@@ -317,7 +739,46 @@ class PrepOS(object):
             call=self.os.delete_instance
         )
 
+    def release_shared_image(self):
+        '''
+            Image is kept for reuse by next tests, older test
+            images for the same glance name are removed if
+            nobody uses them. Only active images older than
+            TEST_IMAGE_MIN_AGE are removed.
+        '''
+        print("Keeping image %s for reuse." % self.os_image.id)
+        try:
+            self.os.remove_image_ref(self.os_image.id, self.image_name)
+        except Exception as e:
+            print("Unable to unmark image %s as used: %s" % (
+                self.os_image.id, e
+            ))
+        try:
+            candidates = self.os.find_images_by_property(
+                self.TEST_IMAGE_PROPERTY,
+                self.image['glance']['name']
+            )
+        except Exception as e:
+            print("Error while looking for unused test images: %s" % e)
+            return
+        for img in candidates:
+            if img.id == self.os_image.id or getattr(img, 'status', None) != 'active':
+                continue
+            age = self.os.image_age(img)
+            if age is None or age < self.TEST_IMAGE_MIN_AGE:
+                continue
+            if not self.os.image_refs(img):
+                self._cleanup(
+                    'unused test image %s' % img.id,
+                    obj=img.id,
+                    flag=True,
+                    call=self.os.delete_image
+                )
+
     def cleanup_image(self):
+        if self.reuse_image and self.os_image:
+            self.release_shared_image()
+            return
         self._cleanup(
             'image',
             obj=self.os_image.id,
@@ -340,11 +801,48 @@ class PrepOS(object):
                 name = self.ssh.keep_key_file()
                 print("SSH private key is in %s" % name)
 
+    def keep_for_reuse(self):
+        '''
+            keeps active instance which has passed tests (and it's
+            keypair and image) for rebuild by the next test instead
+            of removing it
+        '''
+        if not (
+            self.reuse_instance
+            and self.tests_passed
+            and self.os_instance
+            and self.os_key
+            and self.delete_instance
+            and self.delete_keypair
+        ):
+            return False
+        try:
+            instance = self.os.get_instance(self.os_instance.id)
+            if instance.status != 'ACTIVE':
+                return False
+            if not self.store_reusable_instance():
+                return False
+        except Exception as e:
+            print("Unable to keep instance for reuse: %s" % e)
+            return False
+        print("Keeping instance %s for reuse by the next test." % (
+            self.os_instance.id
+        ))
+        self.ssh = None
+        return True
+
     def cleanup(self):
         print("\nClearing up...")
-        self.cleanup_instance()
-        self.cleanup_ssh_key()
-        self.cleanup_image()
+        if self.ssh:
+            self.ssh.stop_master()
+        if self.keep_for_reuse():
+            print("Keeping image %s until reused instance is rebuilt." % (
+                self.os_image.id
+            ))
+        else:
+            self.cleanup_instance()
+            self.cleanup_ssh_key()
+            self.cleanup_image()
         print("\nClearing done\n")
 
     def report_if_fail(self):
@@ -386,6 +884,9 @@ class PrepOS(object):
         # self.report_if_fail()
 
     def get_env_config(self):
+        return dict(self.metadata.get('env_config'))
+
+    def build_env_config(self):
         env = {
             'instance_uuid': str(self.os_instance.id),
             'instance_name': str(self.instance_name).lower(),
@@ -403,7 +904,7 @@ class PrepOS(object):
             env.update(
                 {'iface_' + str(num + 1) + '_info': json.dumps(iface._info)}
             )
-        for meta_name, meta_value in self.flavor.get_keys().items():
+        for meta_name, meta_value in self.flavor_keys().items():
             env.update({'flavor_meta_' + str(meta_name): str(meta_value)})
         return env
 
@@ -425,30 +926,47 @@ class PrepOS(object):
         return result
 
     def network(self):
-        return self.os_instance.interface_list()
+        return self.metadata.get('interfaces')
 
-    def wait_for_port(self, port=22, timeout=60):
+    def flavor_keys(self):
+        return self.metadata.get('flavor_keys')
+
+    def wait_for_port(self, port=22, timeout=60, banner=None):
         '''check if we can connect to given port. Wait for port
-           up to timeout and then return error
+           up to timeout and then return error.
+           All instance addresses are probed at once (main ip first),
+           each attempt uses non-blocking connect limited by
+           CONNECT_TIMEOUT and closes it's sockets. If banner is given,
+           port is considered ready only after service sent data
+           starting with banner (f.e. 'SSH-').
         '''
+        addresses = [self.ip] + [ip for ip in self.ips() if ip != self.ip]
         print(
             "Waiting for instance to accept connections on %s:%s "
             "(time limit is %s s)" % (self.ip, port, timeout)
         )
-        start = time.time()
-        while (start + timeout > time.time()):
-            # add source IP support here
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            result = sock.connect_ex((self.ip, port))
-            if result == 0:
-                # time.sleep(1)   # in many cases there is a race between port
-                # become availabe and actual service been available
-                print("Instance accepts connections on port %s" % port)
-                return True
-            time.sleep(3)
+        attempt_timeout = min(port_probe.CONNECT_TIMEOUT, timeout)
+
+        def port_is_open():
+            return port_probe.probe(
+                addresses, port, attempt_timeout, banner
+            )
+
+        w = self.waiter('port %s accepts connections' % port, timeout)
+        address = w.wait(port_is_open)
+        if address:
+            # in many cases there is a race between port
+            # become availabe and actual service been available
+            print(
+                "Instance accepts connections on %s:%s "
+                "(after %.1f s, %s probes)" % (
+                    address, port, w.elapsed, w.attempts
+                )
+            )
+            return True
         print(
             "Instance is not accepting connection on ip %s port %s." % (
-                self.ip, port
+                ', '.join(map(str, addresses)), port
             )
         )
         return False
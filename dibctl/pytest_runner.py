@@ -1,7 +1,15 @@
+import os
 import sys
+import time
+import signal
+import tempfile
 import pytest
 import paramiko
 
+EXIT_OK = 0
+EXIT_NO_TESTS_COLLECTED = 5
+WORKER_POLL_INTERVAL = 0.1
+
 
 class DibCtlPlugin(object):
     def __init__(self, ssh, tos, environment_variables):
@@ -9,7 +17,6 @@ class DibCtlPlugin(object):
         self.env_vars = environment_variables
         self.tos = tos
         self.ssh_data = ssh
-        self.enable_control_master = False  # I wasn't able to make it stable enough, so it's disabled
         try:
             import testinfra
             self.testinfra = testinfra
@@ -22,8 +29,9 @@ class DibCtlPlugin(object):
     def flavor(self, request):
         return self.tos.flavor
 
+    @pytest.fixture
     def flavor_meta(self, request):
-        return self.tos.flavor().get_keys()
+        return self.tos.flavor_keys()
 
     @pytest.fixture
     def ips(self, request):
@@ -43,7 +51,7 @@ class DibCtlPlugin(object):
 
     @pytest.fixture
     def network(self, request):
-        return self.tos.os_instance.interface_list()
+        return self.tos.network()
 
     @pytest.fixture
     def instance(self, request):
@@ -51,16 +59,17 @@ class DibCtlPlugin(object):
 
     @pytest.fixture
     def ssh(self, request):
+        self.ssh_data.ensure_master()
         return self.ssh_data.info()
 
     @pytest.fixture
     def wait_for_port(self, request):
-        def wfp(port=None, timeout=None):
+        def wfp(port=None, timeout=None, banner=None):
             if port is None:
                 port = 22  # FIXME From image configuration!!!!
             if timeout is None:
                 timeout = 60  # FIXME from image configuration!!!!
-            return self.tos.wait_for_port(port, timeout)
+            return self.tos.wait_for_port(port, timeout, banner)
         return wfp
 
     @pytest.fixture
@@ -77,6 +86,7 @@ class DibCtlPlugin(object):
                 self.ssh_data.connector(),
                 ssh_config=self.ssh_data.config()
                 )
+        self.ssh_data.ensure_master()  # restarts shared connection if it died
         return self.cached_ssh_backend
 
     @pytest.fixture
@@ -104,6 +114,11 @@ class DibCtlPlugin(object):
     def image_config(self, request):
         return self.tos.image
 
+    @pytest.fixture
+    def refresh_metadata(self, request):
+        '''function to re-read cached instance data (f.e. after reboot)'''
+        return self.tos.refresh_metadata
+
     @pytest.fixture
     def console_output(self, request):
         return self.tos.os_instance.get_console_output()
@@ -113,13 +128,143 @@ class DibCtlPlugin(object):
         self.sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         return self.sshclient
 
+    def forked(self):
+        '''
+            drops connections inherited from parent process,
+            so worker opens it's own ssh channels and http connections
+        '''
+        self.cached_ssh_backend = None
+        self.sshclient = paramiko.SSHClient()
+        os_client = getattr(self.tos, 'os', None)
+        if os_client:
+            os_client.set_connection_pool(1)  # new pool, not parent's sockets
+
+
+class ShardPlugin(object):
+    '''keeps every workers-th collected test, starting from number'''
+
+    def __init__(self, number, workers):
+        self.number = number
+        self.workers = workers
+
+    def pytest_collection_modifyitems(self, session, config, items):
+        selected = items[self.number::self.workers]
+        deselected = [item for item in items if item not in selected]
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+        items[:] = selected
+
+
+def run_worker(cmdline, dibctl_plugin, number, workers, output):
+    '''body of forked worker process, never returns'''
+    code = 1
+    try:
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        sys.stdout = os.fdopen(1, 'w', 0)
+        sys.stderr = os.fdopen(2, 'w', 0)
+        dibctl_plugin.forked()
+        code = pytest.main(
+            cmdline,
+            plugins=[dibctl_plugin, ShardPlugin(number, workers)]
+        )
+    finally:
+        os._exit(code)
+
+
+def exit_code(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return 1  # killed
+
+
+def stop_workers(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass  # has just exited
+
+
+def wait_workers(pids, continue_on_fail):
+    '''
+        waits for workers (only for them: other children of dibctl
+        are left for their owners), returns {number: exit code}.
+        Without continue_on_fail remaining workers are stopped after
+        the first failure.
+    '''
+    codes = {}
+    try:
+        while pids:
+            for pid in list(pids):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    codes[pids.pop(pid)] = exit_code(status)
+            failed = any(
+                code not in (EXIT_OK, EXIT_NO_TESTS_COLLECTED)
+                for code in codes.values()
+            )
+            if failed and not continue_on_fail:
+                stop_workers(pids)
+            if pids:
+                time.sleep(WORKER_POLL_INTERVAL)
+    finally:
+        if pids:
+            stop_workers(pids)
+            for pid in pids:
+                os.waitpid(pid, 0)
+    return codes
+
+
+def parallel_runner(cmdline, dibctl_plugin, workers, continue_on_fail):
+    '''
+        Runs tests from cmdline in 'workers' forked processes, each of
+        them runs it's share of collected tests with a copy of
+        dibctl_plugin (module and session fixtures are set up by
+        each worker). Output of workers is printed one after another.
+        Returns True if all tests passed.
+    '''
+    if dibctl_plugin.ssh_data:
+        dibctl_plugin.ssh_data.ensure_master()  # workers share it
+    outputs = [tempfile.TemporaryFile(prefix='dibctl_pytest_') for n in range(workers)]
+    print("Running tests in %s workers" % workers)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pids = {}
+    try:
+        for number, output in enumerate(outputs):
+            pid = os.fork()
+            if pid == 0:
+                run_worker(cmdline, dibctl_plugin, number, workers, output)
+            pids[pid] = number
+    finally:
+        codes = wait_workers(pids, continue_on_fail)
+    for number, output in enumerate(outputs):
+        print("Output of worker %s of %s (exit code %s):" % (
+            number + 1, workers, codes[number]
+        ))
+        output.seek(0)
+        sys.stdout.write(output.read())
+        output.close()
+    sys.stdout.flush()
+    if all(code == EXIT_NO_TESTS_COLLECTED for code in codes.values()):
+        return False
+    return all(
+        code in (EXIT_OK, EXIT_NO_TESTS_COLLECTED) for code in codes.values()
+    )
+
 
-def runner(path, ssh, tos, environment_variables, timeout_val, continue_on_fail):
+def runner(path, ssh, tos, environment_variables, timeout_val, continue_on_fail, workers=1, test_timeout=None):
     cmdline = [path, '-v', '-s']
     dibctl_plugin = DibCtlPlugin(ssh, tos, environment_variables)
     sys.stdout.flush()
     if not continue_on_fail:
         cmdline.append('-x')
+    if test_timeout is not None:
+        cmdline += ['--timeout', str(test_timeout)]  # pytest-timeout
+    if workers > 1:
+        cmdline += ['-p', 'no:cacheprovider']  # workers would race on it
+        return parallel_runner(cmdline, dibctl_plugin, workers, continue_on_fail)
     result = pytest.main(cmdline, plugins=[dibctl_plugin])
     sys.stdout.flush()
     if result == 0:
@@ -1,9 +1,16 @@
 import subprocess
+import collections
+import itertools
+import tempfile
+import signal
+import time
 import os
 import sys
-import itertools
 
 ENV_PREFIX = 'DIBCTL'
+SERIAL_MARKER = 'serial'  # tests from directory with this file run one by one
+POLL_INTERVAL = 0.05
+KILL_GRACE_PERIOD = 5
 
 
 class BadRunnerError(EnvironmentError):
@@ -42,37 +49,190 @@ def gather_tests(path):
         return None
 
 
-def run_shell_test(path, env):
-    print("Running %s" % path)
-    try:
+def chains(tests):
+    '''
+        splits tests into lists which are run one by one: all tests
+        from a directory with SERIAL_MARKER file form one list (in
+        name order), every other test is a list on it's own
+    '''
+    result = collections.OrderedDict()
+    for test in tests:
+        directory = os.path.dirname(test)
+        if os.path.isfile(os.path.join(directory, SERIAL_MARKER)):
+            result.setdefault(directory, []).append(test)
+        else:
+            result[test] = [test]
+    return list(result.values())
+
+
+class ShellTest(object):
+    '''
+        One shell test running in it's own process group (so it's
+        children are killed with it). Output goes directly into
+        our stdout and stderr, or (if capture is set) into a temporary
+        file which is printed by report().
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.process = None
+        self.output = None
+        self.started = None
+        self.killed = None  # reason why test was killed
+        self.kill_time = None
+        self.returncode = None
+
+    def start(self, env, capture):
+        print("Running %s" % self.path)
+        sys.stdout.flush()
+        if capture:
+            self.output = tempfile.TemporaryFile(prefix='dibctl_shell_')
+        self.started = time.time()
+        self.process = subprocess.Popen(
+            self.path,
+            stdout=self.output,  # None: our stdout and stderr
+            stderr=self.output,
+            env=env,
+            preexec_fn=os.setsid
+        )
+
+    def poll(self):
+        '''returns True if test has finished'''
+        if self.returncode is None and self.process:
+            self.returncode = self.process.poll()
+            if self.returncode is not None and self.killed:
+                self._signal(signal.SIGKILL)  # leftovers of the process group
+        return self.returncode is not None
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.process.pid, sig)
+        except OSError:
+            pass  # has just exited
+
+    def kill(self, reason):
+        '''
+            terminates process group of the test, kills it if it's
+            still running after KILL_GRACE_PERIOD
+        '''
+        now = time.time()
+        sig = signal.SIGTERM
+        if self.killed:
+            if now - self.kill_time < KILL_GRACE_PERIOD:
+                return
+            sig = signal.SIGKILL
+        else:
+            self.killed = reason
+            print("Test %s %s, killing it" % (self.path, reason))
+            sys.stdout.flush()
+        self.kill_time = now
+        self._signal(sig)
+
+    @property
+    def success(self):
+        return self.returncode == 0 and not self.killed
+
+    def report(self):
+        if self.output:
+            print("Output of %s:" % self.path)
+            sys.stdout.flush()
+            self.output.seek(0)
+            sys.stdout.write(self.output.read())
+            self.output.close()
+            self.output = None
+        if self.success:
+            print("Test %s succeeded" % self.path)
+        elif self.process is None:
+            print("Test %s skipped" % self.path)
+        elif self.killed:
+            print("Test %s failed: %s" % (self.path, self.killed))
+        else:
+            print("Test %s failed with code %s" % (self.path, self.returncode))
         sys.stdout.flush()
-        subprocess.check_call(path, stdout=sys.stdout, stderr=sys.stderr, env=env)
-        return True
-    except subprocess.CalledProcessError:
-        return False
 
 
-def runner(path, ssh, tos, vars, timeout_val, continue_on_fail):
-    result = True
+def terminate(tests, reason):
+    '''kills running tests (escalating to SIGKILL) and waits for them'''
+    running = [test for test in tests if not test.poll()]
+    while running:
+        for test in running:
+            test.kill(reason)
+        time.sleep(POLL_INTERVAL)
+        running = [test for test in running if not test.poll()]
+
+
+def run_tests(tests, env, workers=1, timeout_val=None, test_timeout=None, continue_on_fail=False):
+    '''
+        Runs up to 'workers' tests at once (tests of the same chain
+        one after another), kills tests running longer than
+        test_timeout and everything still running after timeout_val
+        (tests which were not started by then are skipped).
+        Without continue_on_fail no new tests are started after the
+        first failure. Results (and output, if tests run concurrently)
+        are printed in order of tests. Returns list of ShellTest.
+    '''
+    all_tests = [ShellTest(path) for path in tests]
+    by_path = dict((test.path, test) for test in all_tests)
+    queues = [[by_path[path] for path in chain] for chain in chains(tests)]
+    capture = workers > 1
+    deadline = None
+    if timeout_val is not None:
+        deadline = time.time() + timeout_val
+    active = {}  # queue number -> running test
+    reported = 0
+    stop = False
+    try:
+        while True:
+            for number, test in list(active.items()):
+                if test.poll():
+                    del active[number]
+                    if not test.success and not continue_on_fail:
+                        stop = True
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                stop = True
+                for test in active.values():
+                    test.kill('timed out (limit for all tests is %s s)' % timeout_val)
+            if test_timeout is not None:
+                for test in active.values():
+                    if now - test.started >= test_timeout:
+                        test.kill('timed out after %s s' % test_timeout)
+            for number, queue in enumerate(queues):
+                if stop or len(active) >= workers:
+                    break
+                if queue and number not in active:
+                    queue[0].start(env, capture)
+                    active[number] = queue.pop(0)
+            while reported < len(all_tests) and all_tests[reported].poll():
+                all_tests[reported].report()
+                reported += 1
+            if not active and (stop or not any(queues)):
+                break
+            time.sleep(POLL_INTERVAL)
+    except BaseException:
+        terminate(active.values(), 'interrupted')
+        raise
+    for test in all_tests[reported:]:
+        test.report()
+    return all_tests
+
+
+def runner(path, ssh, tos, vars, timeout_val, continue_on_fail, workers=1, test_timeout=None):
     tests = gather_tests(path)
     if tests is None:
         raise BadRunnerError('Path %s is not a test file or a dir' % path)
     config = dict(os.environ)
     config.update(unwrap_config(ENV_PREFIX, tos.get_env_config()))
     if ssh:
+        ssh.ensure_master()
         config.update(ssh.env_vars('DIBCTL_'))
     config.update(unwrap_config(ENV_PREFIX, vars))
-    for test in tests:
-        test_successfull = run_shell_test(test, config)
-        if test_successfull:
-            print("Test %s succeeded" % test)
-            continue
-        elif continue_on_fail:
-                print("Test %s failed, continue other tests" % test)
-                result = False
-                continue
-        else:
-            print("Test %s failed, skipping all other tests" % test)
-            result = False
-            break
-    return result
+    results = run_tests(
+        tests,
+        config,
+        workers,
+        timeout_val=timeout_val,
+        test_timeout=test_timeout,
+        continue_on_fail=continue_on_fail
+    )
+    return all(test.success for test in results)
@@ -1,13 +1,18 @@
 import tempfile
 import subprocess
+import shutil
 import sys
+import os
+
+CONTROL_PERSIST = 300  # master exits if unused (f.e. after crash of dibctl)
+MASTER_CONNECT_TIMEOUT = 15
 
 
 class SSH(object):
 
     COMMAND_NAME = 'ssh'
 
-    def __init__(self, ip, username, private_key, port=22, override_ssh_key_filename=None):
+    def __init__(self, ip, username, private_key, port=22, override_ssh_key_filename=None, multiplexing=False):
         self.ip = ip
         self.username = username
         self.private_key = private_key
@@ -15,6 +20,8 @@ class SSH(object):
         self.private_key_file = None
         self.config_file = None
         self.override_ssh_key_filename = override_ssh_key_filename
+        self.multiplexing = multiplexing
+        self.control_dir = None
 
     def user_host_and_port(self):
         if self.port == 22:
@@ -63,10 +70,103 @@ class SSH(object):
             "-o", "UpdateHostKeys=no",
             "-o", "PasswordAuthentication=no",
             "-i", self.key_file(),
-            self.user_host_and_port()
         ]
+        if self.multiplexing:
+            command_line += [
+                "-o", "ControlMaster=no",
+                "-o", "ControlPath=%s" % self.control_path()
+            ]
+        command_line.append(self.user_host_and_port())
         return command_line
 
+    def control_path(self):
+        '''
+            path to the socket of the shared (master) connection,
+            in a private temporary directory
+        '''
+        if not self.control_dir:
+            self.control_dir = tempfile.mkdtemp(prefix='dibctl_ssh_')
+        return os.path.join(self.control_dir, 'master')
+
+    def _control(self, *options):
+        '''runs ssh with given options for the master connection'''
+        command_line = [
+            self.COMMAND_NAME,
+            "-o", "ControlPath=%s" % self.control_path(),
+        ] + list(options) + [
+            "-p", str(self.port),
+            "%s@%s" % (self.username, self.ip)
+        ]
+        with open(os.devnull, 'r+') as devnull:
+            # master stays in background, it shouldn't hold our stdout
+            return subprocess.call(
+                command_line,
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull,
+                close_fds=True
+            )
+
+    def master_alive(self):
+        return self._control("-O", "check") == 0
+
+    def start_master(self):
+        '''
+            starts shared connection in background,
+            returns True if it's started
+        '''
+        if os.path.exists(self.control_path()):
+            os.remove(self.control_path())  # stale socket of dead master
+        code = self._control(
+            "-o", "ControlMaster=yes",
+            "-o", "ControlPersist=%s" % CONTROL_PERSIST,
+            "-o", "ConnectTimeout=%s" % MASTER_CONNECT_TIMEOUT,
+            "-o", "BatchMode=yes",
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", "UpdateHostKeys=no",
+            "-o", "PasswordAuthentication=no",
+            "-i", self.key_file(),
+            "-N", "-f"
+        )
+        return code == 0
+
+    def ensure_master(self):
+        '''
+            Health check of the shared connection: (re)starts master
+            if it's not running. Returns True if commands go through
+            the master. Commands (with ControlMaster=no) never become
+            masters themselves and fall back to own connections if
+            master is unavailable, so failed master only costs speed.
+        '''
+        if not self.multiplexing:
+            return False
+        if self.master_alive():
+            return True
+        if self.start_master():
+            return True
+        print("Unable to start shared ssh connection to %s, using separate connections" % self.ip)
+        return False
+
+    def share(self):
+        '''
+            creates key and config files and starts shared connection,
+            so forked processes use them (and the master owned by
+            this process) instead of creating copies they can't
+            clean up
+        '''
+        self.key_file()
+        self.config()
+        self.ensure_master()
+
+    def stop_master(self):
+        if not self.control_dir:
+            return
+        if os.path.exists(self.control_path()):
+            self._control("-O", "exit")
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.control_dir = None
+
     def connector(self):
         return 'ssh://%s' % self.ip
 
@@ -88,6 +188,9 @@ class SSH(object):
             self.config_file.write('\tPasswordAuthentication no\n')
             self.config_file.write('\tIdentityFile %s\n' % self.key_file())
             self.config_file.write('\tPort %s\n' % self.port)
+            if self.multiplexing:
+                self.config_file.write('\tControlMaster no\n')
+                self.config_file.write('\tControlPath %s\n' % self.control_path())
             self.config_file.flush()
         return self.config_file.name
 
@@ -108,6 +211,7 @@ class SSH(object):
 
     def shell(self, env, message):
         '''Opens a user-accessible shell to machine'''
+        self.ensure_master()
         command_line = self.command_line()
         print(message)
         print("Executing shell: %s" % " ".join(command_line))
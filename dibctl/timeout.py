@@ -1,13 +1,70 @@
+import time
 import signal
+import threading
+
+'''
+    Per-thread deadlines for long operations.
+
+    Timeouts nest: inner timeout can only shorten the time left
+    by the outer one, and outer timeout is restored (not cancelled)
+    when inner block exits. Deadlines are kept per thread, so
+    operations in different threads have independent budgets.
+
+    In the main thread deadline is enforced by ITIMER_REAL (SIGALRM,
+    sub-second resolution), which interrupts blocking calls.
+    Signals can't be delivered to other threads, so there code should
+    call check() (or use remaining()) between blocking operations;
+    waiter.Waiter and image upload do this.
+'''
+
+_now = time.time  # not affected by tests mocking time.time
+_local = threading.local()
 
 
 class TimeoutError(EnvironmentError):
     pass
 
 
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _in_main_thread():
+    return isinstance(threading.current_thread(), threading._MainThread)
+
+
+def current():
+    '''innermost active timeout of the current thread or None'''
+    stack = _stack()
+    if stack:
+        return stack[-1]
+    return None
+
+
+def remaining(default=None):
+    '''seconds left before deadline of the current thread'''
+    t = current()
+    if t is None:
+        return default
+    return t.remaining()
+
+
+def check():
+    '''raises TimeoutError if deadline of the current thread passed'''
+    t = current()
+    if t is not None:
+        t.check()
+
+
 class timeout(object):
+
     def __init__(self, timeout):
         self.timeout = timeout
+        self.deadline = None
+        self.outer = None
+        self.armed = False
 
     def raise_timeout(self, signum, frame):
         if signum == signal.SIGALRM:
@@ -15,9 +72,36 @@ class timeout(object):
         else:
             raise RuntimeError("Signal %s, have no idea what to do" % signum)
 
-    def __enter__(self):
+    def remaining(self):
+        return max(0, self.deadline - _now())
+
+    def check(self):
+        if self.deadline is not None and _now() >= self.deadline:
+            raise TimeoutError("Timed out after %s" % self.timeout)
+
+    def _arm(self):
         signal.signal(signal.SIGALRM, self.raise_timeout)
-        signal.alarm(self.timeout)
+        # zero would disarm timer, expired deadline should fire at once
+        signal.setitimer(signal.ITIMER_REAL, max(self.remaining(), 0.001))
+        self.armed = True
+
+    def __enter__(self):
+        self.outer = current()
+        self.deadline = _now() + self.timeout
+        if self.outer and self.outer.deadline < self.deadline:
+            self.deadline = self.outer.deadline
+            self.timeout = self.outer.timeout
+        _stack().append(self)
+        if _in_main_thread():
+            self._arm()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        signal.alarm(0)
+        stack = _stack()
+        if self in stack:
+            stack.remove(self)
+        if self.armed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            self.armed = False
+            if self.outer and self.outer.armed:
+                self.outer._arm()
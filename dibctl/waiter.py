@@ -0,0 +1,105 @@
+import sys
+import time
+import random
+import timeout
+
+'''Adaptive polling with exponential backoff and phase timings'''
+
+INITIAL_DELAY = 0.5
+MAX_DELAY = 5
+BACKOFF = 1.5
+JITTER = 0.2
+
+
+class Timings(object):
+    '''
+        Collects durations of named phases (boot, port wait, etc)
+        to show where time goes.
+    '''
+
+    def __init__(self):
+        self.phases = []
+
+    def add(self, name, seconds):
+        self.phases.append((name, seconds))
+
+    def report(self):
+        if not self.phases:
+            return
+        print("Timings:")
+        for name, seconds in self.phases:
+            print("  %-30s %8.1f s" % (name, seconds))
+        sys.stdout.flush()
+
+
+class Waiter(object):
+    '''
+        Calls check() until it returns true value or timeout passes.
+        First checks are done quickly, then delay between them grows
+        exponentially (up to max_delay), with random jitter, so
+        fast events are noticed quickly and long waits do not
+        flood API with requests.
+        clock and sleep may be replaced (for tests or custom time
+        sources).
+    '''
+
+    def __init__(
+        self,
+        name,
+        timeout=None,
+        initial_delay=INITIAL_DELAY,
+        max_delay=MAX_DELAY,
+        backoff=BACKOFF,
+        jitter=JITTER,
+        timings=None,
+        clock=time.time,
+        sleep=time.sleep
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.timings = timings
+        self.clock = clock
+        self.sleep = sleep
+        self.attempts = 0
+        self.elapsed = None
+
+    def delays(self):
+        delay = self.initial_delay
+        while True:
+            yield min(
+                delay * random.uniform(1 - self.jitter, 1 + self.jitter),
+                self.max_delay
+            )
+            delay = min(delay * self.backoff, self.max_delay)
+
+    def wait(self, check):
+        '''
+            returns result of the first successful check(), or
+            None if timeout passed.
+        '''
+        start = self.clock()
+        result = None
+        delays = self.delays()
+        while True:
+            now = self.clock()
+            if self.timeout is not None and now >= start + self.timeout:
+                result = None
+                break
+            timeout.check()  # deadline of enclosing timeout.timeout()
+            self.attempts += 1
+            result = check()
+            if result:
+                now = self.clock()
+                break
+            delay = next(delays)
+            if self.timeout is not None:
+                delay = max(0, min(delay, start + self.timeout - now))
+            self.sleep(min(delay, timeout.remaining(delay)))
+        self.elapsed = now - start
+        if self.timings is not None:
+            self.timings.add(self.name, self.elapsed)
+        return result
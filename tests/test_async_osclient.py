@@ -0,0 +1,117 @@
+#!/usr/bin/python
+import os
+import inspect
+import sys
+import threading
+import time
+import pytest
+import mock
+from mock import sentinel
+
+
+@pytest.fixture
+def async_osclient():
+    from dibctl import async_osclient
+    return async_osclient
+
+
+@pytest.fixture
+def os_client():
+    return mock.MagicMock()
+
+
+def test_init_limits_connection_pool(async_osclient, os_client):
+    async_osclient.AsyncOSClient(os_client, workers=5)
+    assert os_client.set_connection_pool.call_args == mock.call(5)
+
+
+def test_async_call(async_osclient, os_client):
+    os_client.get_instance.return_value = sentinel.instance
+    with async_osclient.AsyncOSClient(os_client) as client:
+        result = client.get_instance(sentinel.uuid)
+        assert result.get(1) == sentinel.instance
+    assert os_client.get_instance.call_args == mock.call(sentinel.uuid)
+
+
+def test_async_call_kwargs(async_osclient, os_client):
+    with async_osclient.AsyncOSClient(os_client) as client:
+        client.boot_instance(name=sentinel.name).get(1)
+    assert os_client.boot_instance.call_args == mock.call(name=sentinel.name)
+
+
+def test_async_call_error(async_osclient, os_client):
+    os_client.delete_image.side_effect = EnvironmentError('in use')
+    with async_osclient.AsyncOSClient(os_client) as client:
+        with pytest.raises(EnvironmentError):
+            client.delete_image(sentinel.uuid).get(1)
+
+
+def test_unknown_method(async_osclient, os_client):
+    client = async_osclient.AsyncOSClient(os_client)
+    with pytest.raises(AttributeError):
+        client.find_obsolete_unused_candidates
+
+
+def test_calls_are_concurrent(async_osclient, os_client):
+    barrier = threading.Event()
+    started = []
+
+    def slow(uuid):
+        started.append(uuid)
+        if len(started) == 3:
+            barrier.set()
+        assert barrier.wait(2)
+        return uuid
+
+    os_client.get_instance.side_effect = slow
+    with async_osclient.AsyncOSClient(os_client, workers=3) as client:
+        results = [client.get_instance(i) for i in range(3)]
+        assert [r.get(5) for r in results] == [0, 1, 2]
+
+
+def test_wait(async_osclient, os_client):
+    os_client.get_image.side_effect = [sentinel.img, IOError('network')]
+    with async_osclient.AsyncOSClient(os_client, workers=1) as client:
+        results = client.wait([
+            client.get_image(sentinel.uuid1),
+            client.get_image(sentinel.uuid2)
+        ])
+    assert results[0].value == sentinel.img
+    assert results[0].error is None
+    assert isinstance(results[1].error, IOError)
+
+
+def test_wait_timeout(async_osclient, os_client):
+    release = threading.Event()
+    os_client.get_image.side_effect = lambda uuid: release.wait(5)
+    start = time.time()
+    with pytest.raises(EnvironmentError):
+        with async_osclient.AsyncOSClient(os_client, workers=1) as client:
+            results = client.wait([client.get_image(sentinel.uuid)], 0.2)
+            raise results[0].error
+    assert time.time() - start < 2
+    assert isinstance(results[0].error, async_osclient.timeout.TimeoutError)
+    assert str(results[0].error) == 'Timed out after 0.2'
+    release.set()
+
+
+def test_close_without_calls(async_osclient, os_client):
+    client = async_osclient.AsyncOSClient(os_client)
+    client.close()
+    assert client.pool is None
+
+
+if __name__ == "__main__":
+    ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
+    currentdir = os.path.dirname(ourfilename)
+    parentdir = os.path.dirname(currentdir)
+    file_to_test = os.path.join(
+        parentdir,
+        os.path.basename(parentdir),
+        os.path.basename(ourfilename).replace("test_", '', 1)
+    )
+    pytest.main([
+     "-vv",
+     "--cov", file_to_test,
+     "--cov-report", "term-missing"
+     ] + sys.argv)
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+import os
+import inspect
+import sys
+import pytest
+import mock
+
+
+@pytest.fixture
+def auth_cache():
+    from dibctl import auth_cache
+    return auth_cache
+
+
+@pytest.fixture
+def cache(auth_cache, tmpdir):
+    return auth_cache.AuthCache(str(tmpdir.join('auth.json')))
+
+
+def test_default_location(auth_cache, dibctl_cache_dir):
+    assert auth_cache.AuthCache().cache_file.startswith(str(dibctl_cache_dir))
+
+
+def test_version(cache):
+    assert cache.get_version('http://keystone') is None
+    cache.set_version('http://keystone', 'v3')
+    assert cache.get_version('http://keystone') == 'v3'
+    assert cache.get_version('http://other') is None
+
+
+def test_version_expired(auth_cache, cache):
+    with mock.patch.object(auth_cache.time, 'time', return_value=0):
+        cache.set_version('http://keystone', 'v3')
+    with mock.patch.object(auth_cache.time, 'time', return_value=auth_cache.VERSION_TTL + 1):
+        assert cache.get_version('http://keystone') is None
+
+
+def test_auth_state(auth_cache, cache):
+    cache.set_auth_state('id', 'state')
+    assert auth_cache.AuthCache(cache.cache_file).get_auth_state('id') == 'state'
+    assert cache.get_auth_state('other') is None
+
+
+def test_file_permissions(cache):
+    cache.set_auth_state('id', 'state')
+    assert os.stat(cache.cache_file).st_mode & 0o777 == 0o600
+    assert os.stat(cache.lock_file).st_mode & 0o777 == 0o600
+
+
+def test_insecure_file(auth_cache, cache):
+    cache.set_auth_state('id', 'state')
+    os.chmod(cache.cache_file, 0o644)
+    with pytest.raises(auth_cache.InsecureCacheError):
+        cache.get_auth_state('id')
+
+
+def test_insecure_dir(auth_cache, tmpdir):
+    tmpdir.chmod(0o777)
+    cache = auth_cache.AuthCache(str(tmpdir.join('auth.json')))
+    with pytest.raises(auth_cache.InsecureCacheError):
+        cache.get_version('http://keystone')
+
+
+if __name__ == "__main__":
+    ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
+    currentdir = os.path.dirname(ourfilename)
+    parentdir = os.path.dirname(currentdir)
+    file_to_test = os.path.join(
+        parentdir,
+        os.path.basename(parentdir),
+        os.path.basename(ourfilename).replace("test_", '', 1)
+    )
+    pytest.main([
+     "-vv",
+     "--cov", file_to_test,
+     "--cov-report", "term-missing"
+     ] + sys.argv)
@@ -6,6 +6,7 @@ import pytest
 import mock
 from mock import sentinel
 import argparse
+import importlib
 
 
 @pytest.fixture
@@ -103,6 +104,38 @@ def test_BuildCommand_actual(commands):
             assert obj.image
 
 
+def test_BuildCommand_lazy_config(commands):
+    parser, obj = create_subparser(commands.BuildCommand)
+    args = parser.parse_args(['build', 'label'])
+    with mock.patch.object(obj, "_command"):
+        with mock.patch.object(commands.config, "ImageConfig") as ic:
+            args.command(args)
+    assert ic.call_args[1]['lazy'] is True
+
+
+@pytest.mark.parametrize('command_line, option, expected', [
+    [['test', 'label'], 'workers', ('matrix', 'DEFAULT_WORKERS')],
+    [['pool', 'list'], 'ttl', ('instance_pool', 'IDLE_TTL')],
+    [['rotate', 'label'], 'page_size', ('osclient', 'OSClient', 'LIST_PAGE_SIZE')],
+])
+def test_literal_defaults_match_modules(commands, command_line, option, expected):
+    value = importlib.import_module('dibctl.' + expected[0])
+    for name in expected[1:]:
+        value = getattr(value, name)
+    assert getattr(commands.Main(command_line).args, option) == value
+
+
+def test_ValidateCommand_full_config(commands):
+    parser, obj = create_subparser(commands.ValidateCommand)
+    args = parser.parse_args(['validate'])
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        with mock.patch.object(commands.config, "UploadEnvConfig") as uc:
+            with mock.patch.object(commands.config, "TestEnvConfig") as tc:
+                assert args.command(args) == 0
+    for mock_config in (ic, uc, tc):
+        assert mock_config.call_args[1]['lazy'] is False
+
+
 def test_BuildCommand_output(commands):
     parser = create_subparser(commands.BuildCommand)[0]
     args = parser.parse_args(['build', 'label', '--output', 'foo'])
@@ -232,6 +265,16 @@ def test_TestCommand_keep_instance(commands):
                 assert args.keep_failed_instance is True
 
 
+def test_TestCommand_continue_on_fail(commands):
+    parser = create_subparser(commands.TestCommand)[0]
+    args = parser.parse_args(['test', 'label', '--continue-on-fail'])
+    with mock.patch.object(commands.config, "TestEnvConfig"):
+        with mock.patch.object(commands.config, "ImageConfig"):
+            with mock.patch.object(commands.do_tests, "DoTests") as dt:
+                args.command(args)
+    assert dt.call_args[1]['continue_on_fail'] is True
+
+
 def test_TestCommand_actual_no_tests(commands):
     parser, obj = create_subparser(commands.TestCommand)
     args = parser.parse_args(['test', 'label'])
@@ -267,6 +310,197 @@ def test_TestCommand_actual_proper_env_override(commands):
             assert obj.test_env == 'bar'
 
 
+@pytest.mark.parametrize('status, exit_code', [
+    [True, 0],
+    [False, 80]
+])
+def test_TestCommand_matrix(commands, status, exit_code):
+    parser, obj = create_subparser(commands.TestCommand)
+    args = parser.parse_args(['test', 'label', '--matrix', '--workers', '3'])
+    image = {'tests': {'matrix': {
+        'environments': ['env1', 'env2'],
+        'flavors': ['small', 'large']
+    }}}
+    envs = {'env1': {'nova': {}}, 'env2': {'nova': {}}}
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        ic.return_value.__getitem__.return_value = image
+        with mock.patch.object(commands.config, "TestEnvConfig", return_value=envs):
+            with mock.patch.object(commands.matrix, "TestMatrix") as tm:
+                tm.return_value.run.return_value = status
+                assert args.command(args) == exit_code
+    cells = tm.call_args[0][1]
+    assert [c.name for c in cells] == [
+        'env1/small', 'env1/large', 'env2/small', 'env2/large'
+    ]
+    assert tm.call_args[1]['workers'] == 3
+    assert tm.call_args[1]['continue_on_fail'] is False
+
+
+def test_TestCommand_matrix_environments(commands):
+    parser, obj = create_subparser(commands.TestCommand)
+    args = parser.parse_args(['test', 'label', '--environments', 'env2'])
+    image = {'tests': {'matrix': {'environments': ['env1']}}}
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        ic.return_value.__getitem__.return_value = image
+        with mock.patch.object(commands.config, "TestEnvConfig", return_value={'env2': {}}):
+            with mock.patch.object(commands.matrix, "TestMatrix") as tm:
+                args.command(args)
+    assert [c.name for c in tm.call_args[0][1]] == ['env2']
+
+
+def test_TestCommand_matrix_no_envs(commands):
+    parser, obj = create_subparser(commands.TestCommand)
+    args = parser.parse_args(['test', 'label', '--matrix'])
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        ic.return_value.__getitem__.return_value = {'tests': {'environment_name': 'env'}}
+        with mock.patch.object(commands.config, "TestEnvConfig"):
+            with pytest.raises(commands.TestEnvironmentNotFoundError):
+                args.command(args)
+
+
+def test_TestCommand_matrix_no_tests(commands):
+    parser, obj = create_subparser(commands.TestCommand)
+    args = parser.parse_args(['test', 'label', '--matrix'])
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        ic.return_value.__getitem__.return_value = {}
+        with mock.patch.object(commands.config, "TestEnvConfig"):
+            with pytest.raises(commands.NoTestsError):
+                args.command(args)
+
+
+def test_TestCommand_matrix_incompatible_options(commands):
+    parser, obj = create_subparser(commands.TestCommand)
+    args = parser.parse_args(['test', 'label', '--matrix', '--shell'])
+    with mock.patch.object(commands.config, "ImageConfig"):
+        with mock.patch.object(commands.config, "TestEnvConfig"):
+            with pytest.raises(SystemExit):
+                args.command(args)
+
+
+def test_ShellCommand_actual(commands):
+    parser, obj = create_subparser(commands.ShellCommand)
+    args = parser.parse_args(['shell', 'label', '--environment', 'env'])
+    with mock.patch.object(commands.config, "ImageConfig"):
+        with mock.patch.object(commands.config, "TestEnvConfig"):
+            with mock.patch.object(commands.do_tests, "DoTests") as dt:
+                dt.return_value.process.return_value = 0
+                assert args.command(args) == 0
+    assert dt.return_value.process.call_args == mock.call(
+        shell_only=True, shell_on_errors=False
+    )
+
+
+@pytest.mark.parametrize('status, exit_code, released', [
+    [True, 0, True],
+    [False, 80, False]
+])
+def test_TestCommand_from_pool(commands, status, exit_code, released):
+    parser, obj = create_subparser(commands.TestCommand)
+    args = parser.parse_args(['test', 'label', '--from-pool'])
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        ic.return_value.__getitem__.return_value = {'tests': {'environment_name': 'env'}}
+        with mock.patch.object(commands.config, "TestEnvConfig", return_value={'env': sentinel.env}):
+            with mock.patch.object(commands.do_tests, "DoTests") as dt:
+                dt.return_value.process.return_value = status
+                with mock.patch.object(commands.instance_pool, "lease") as lease:
+                    with mock.patch.object(commands.instance_pool, "give_back") as give_back:
+                        assert args.command(args) == exit_code
+    assert lease.call_args[0][1] == 'label@env'
+    assert lease.call_args[0][2] == dt.return_value
+    assert lease.call_args[0][4] == {'tests': {'environment_name': 'env'}}
+    assert give_back.call_args[0][1] == lease.return_value
+    assert give_back.call_args[0][2] is released
+    assert give_back.call_args[0][3] == sentinel.env
+
+
+def test_TestCommand_from_pool_empty(commands):
+    parser, obj = create_subparser(commands.TestCommand)
+    args = parser.parse_args(['test', 'label', '--from-pool'])
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        ic.return_value.__getitem__.return_value = {'tests': {'environment_name': 'env'}}
+        with mock.patch.object(commands.config, "TestEnvConfig", return_value={'env': sentinel.env}):
+            with mock.patch.object(commands.do_tests, "DoTests") as dt:
+                with mock.patch.object(commands.instance_pool, "lease", return_value=None):
+                    with mock.patch.object(commands.instance_pool, "give_back") as give_back:
+                        args.command(args)
+    assert dt.return_value.process.called
+    assert not give_back.called
+
+
+def test_ShellCommand_from_pool_error(commands):
+    parser, obj = create_subparser(commands.ShellCommand)
+    args = parser.parse_args(['shell', 'label', '--environment', 'env', '--from-pool'])
+    with mock.patch.object(commands.config, "ImageConfig"):
+        with mock.patch.object(commands.config, "TestEnvConfig"):
+            with mock.patch.object(commands.do_tests, "DoTests") as dt:
+                dt.return_value.process.side_effect = commands.do_tests.TestError
+                with mock.patch.object(commands.instance_pool, "lease"):
+                    with mock.patch.object(commands.instance_pool, "give_back") as give_back:
+                        assert args.command(args) == 1
+    assert give_back.call_args[0][2] is False
+
+
+def test_PoolCommand_fill(commands):
+    parser, obj = create_subparser(commands.PoolCommand)
+    args = parser.parse_args(['pool', 'fill', 'label', '--size', '2'])
+    result = commands.parallel.Result(0, {'instance_id': 'i1', 'pool': 'label@env'}, None)
+    image = commands.config.Config({'tests': {'environment_name': 'env'}})
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        ic.return_value.__getitem__.return_value = image
+        with mock.patch.object(commands.config, "TestEnvConfig", return_value={'env': sentinel.env}):
+            with mock.patch.object(commands.instance_pool, "fill", return_value=[result]) as fill:
+                assert args.command(args) == 0
+    assert fill.call_args[0][1:] == ('label', image, 'env', sentinel.env, 2)
+
+
+def test_PoolCommand_fill_error(commands, capsys):
+    parser, obj = create_subparser(commands.PoolCommand)
+    args = parser.parse_args(['pool', 'fill', 'label', '--environment', 'env'])
+    result = commands.parallel.Result(0, None, EnvironmentError('no quota'))
+    with mock.patch.object(commands.config, "ImageConfig"):
+        with mock.patch.object(commands.config, "TestEnvConfig"):
+            with mock.patch.object(commands.instance_pool, "fill", return_value=[result]):
+                assert args.command(args) == 1
+    assert 'no quota' in capsys.readouterr()[0]
+
+
+def test_PoolCommand_fill_no_label(commands):
+    parser, obj = create_subparser(commands.PoolCommand)
+    args = parser.parse_args(['pool', 'fill'])
+    with mock.patch.object(commands.config, "ImageConfig"):
+        with mock.patch.object(commands.config, "TestEnvConfig"):
+            with pytest.raises(SystemExit):
+                args.command(args)
+
+
+def test_PoolCommand_list(commands, capsys):
+    parser, obj = create_subparser(commands.PoolCommand)
+    args = parser.parse_args(['pool', 'list'])
+    pool = commands.instance_pool.InstancePool()
+    pool.add('label@env', 'env', 'i1', 'key', 'PRIVATE', 'img')
+    with mock.patch.object(commands.config, "ImageConfig"):
+        with mock.patch.object(commands.config, "TestEnvConfig"):
+            assert args.command(args) == 0
+    out = capsys.readouterr()[0]
+    assert 'label@env' in out
+    assert 'i1' in out
+
+
+def test_PoolCommand_reap(commands, capsys):
+    parser, obj = create_subparser(commands.PoolCommand)
+    args = parser.parse_args(['pool', 'reap', '--all'])
+    results = [
+        commands.parallel.Result({'instance_id': 'i1'}, None, None),
+        commands.parallel.Result({'instance_id': 'i2'}, None, IOError('network'))
+    ]
+    with mock.patch.object(commands.config, "ImageConfig"):
+        with mock.patch.object(commands.config, "TestEnvConfig"):
+            with mock.patch.object(commands.instance_pool, "reap", return_value=results) as reap:
+                assert args.command(args) == 1
+    assert reap.call_args[0][2] is True
+    assert 'i2' in capsys.readouterr()[0]
+
+
 def test_UploadCommand_actual_with_obsolete(commands, cred, mock_env_cfg, mock_image_cfg, config):
     parser, obj = create_subparser(commands.UploadCommand)
     args = parser.parse_args(['upload', 'label', 'uploadlabel'])
@@ -303,6 +537,108 @@ def test_UploadCommand_obsolete(commands):
     assert args.no_obsolete is True
 
 
+def test_UploadCommand_many_labels(commands, mock_env_cfg, mock_image_cfg, config, tmpdir, capsys):
+    image_file = tmpdir.join('image')
+    image_file.write('data' * 1000)
+    mock_image_cfg['filename'] = str(image_file)
+    parser, obj = create_subparser(commands.UploadCommand)
+    args = parser.parse_args(['upload', 'label', 'region1', 'region2', 'region3', '--parallel', '2'])
+    assert args.envlabels == ['region1', 'region2', 'region3']
+    assert args.parallel == 2
+    uploaded = []
+
+    def upload_image(name, filename, public, source=None, **kwargs):
+        if source:
+            uploaded.append(memoryview(source().read(-1)).tobytes())
+        else:
+            uploaded.append(open(filename, 'rb').read())
+        return mock.MagicMock(id=sentinel.uuid)
+
+    with mock.patch.object(commands.config, "UploadEnvConfig") as uec:
+        uec.return_value = config.Config({
+            'region1': mock_env_cfg, 'region2': mock_env_cfg, 'region3': mock_env_cfg
+        })
+        with mock.patch.object(commands.osclient, "OSClient") as mock_os:
+            mock_os.return_value.upload_image.side_effect = upload_image
+            mock_os.return_value.older_images.return_value = [sentinel.old]
+            obsoleted = []
+
+            def mark_image_obsolete(name, img):
+                obsoleted.append(img)
+                return mock.MagicMock(id=img)
+            mock_os.return_value.mark_image_obsolete.side_effect = mark_image_obsolete
+            with mock.patch.object(commands.config, "ImageConfig") as ic:
+                ic.return_value = config.Config({'label': mock_image_cfg})
+                assert args.command(args) == 0
+    # mock call counters are not thread-safe, so count calls manually
+    assert len(uploaded) == 3
+    assert obsoleted == [sentinel.old] * 3
+    assert all(data == b'data' * 1000 for data in uploaded)
+    assert 'region3: uploaded as sentinel.uuid' in capsys.readouterr()[0]
+
+
+@pytest.mark.parametrize('labels', [
+    ['region1'],
+    ['region1', 'region2', 'region3'],
+])
+def test_UploadCommand_streaming_preprocessing(commands, mock_env_cfg, mock_image_cfg, config, tmpdir, labels):
+    image_file = tmpdir.join('image')
+    image_file.write('data' * 1000)
+    mock_image_cfg['filename'] = str(image_file)
+    env = dict(mock_env_cfg, preprocessing={
+        'cmdline': 'cat %(input_filename)s > %(output_filename)s',
+        'output_filename': '%(input_filename)s.raw',
+        'streaming': True
+    })
+    parser, obj = create_subparser(commands.UploadCommand)
+    args = parser.parse_args(['upload', 'label'] + labels + ['--parallel', '2'])
+    uploaded = []
+
+    def upload_image(name, filename, public, source=None, **kwargs):
+        assert filename == str(image_file) + '.raw'
+        uploaded.append(memoryview(source().read(-1)).tobytes())
+        return mock.MagicMock(id=sentinel.uuid)
+
+    with mock.patch.object(commands.config, "UploadEnvConfig") as uec:
+        uec.return_value = config.Config(dict((label, env) for label in labels))
+        with mock.patch.object(commands.osclient, "OSClient") as mock_os:
+            mock_os.return_value.upload_image.side_effect = upload_image
+            mock_os.return_value.older_images.return_value = []
+            with mock.patch.object(commands.config, "ImageConfig") as ic:
+                ic.return_value = config.Config({'label': mock_image_cfg})
+                assert args.command(args) == 0
+    assert uploaded == [b'data' * 1000] * len(labels)
+    assert not os.path.exists(str(image_file) + '.raw')
+
+
+def test_UploadCommand_many_labels_partial_failure(commands, mock_env_cfg, mock_image_cfg, config, tmpdir):
+    image_file = tmpdir.join('image')
+    image_file.write('data')
+    mock_image_cfg['filename'] = str(image_file)
+    parser, obj = create_subparser(commands.UploadCommand)
+    args = parser.parse_args(['upload', 'label', 'region1', 'region2'])
+    with mock.patch.object(commands.config, "UploadEnvConfig") as uec:
+        uec.return_value = config.Config({'region1': mock_env_cfg, 'region2': mock_env_cfg})
+        with mock.patch.object(commands.osclient, "OSClient") as mock_os:
+            mock_os.return_value.upload_image.side_effect = [IOError('fail'), mock.MagicMock()]
+            with mock.patch.object(commands.config, "ImageConfig") as ic:
+                ic.return_value = config.Config({'label': mock_image_cfg})
+                with pytest.raises(commands.UploadFailedError):
+                    args.command(args)
+
+
+def test_UploadCommand_group_targets(commands, mock_env_cfg, mock_image_cfg, config):
+    raw_env = dict(mock_env_cfg, glance={'disk_format': 'raw'})
+    parser, obj = create_subparser(commands.UploadCommand)
+    obj.targets = [
+        commands.UploadTarget('qcow1', config.Config(mock_env_cfg), mock_image_cfg),
+        commands.UploadTarget('raw', config.Config(raw_env), mock_image_cfg),
+        commands.UploadTarget('qcow2', config.Config(mock_env_cfg), mock_image_cfg),
+    ]
+    groups = obj.group_targets()
+    assert [[t.label for t in g] for g in groups] == [['qcow1', 'qcow2'], ['raw']]
+
+
 def test_RotateCommand_actual(commands, mock_env_cfg, config):
     parser, obj = create_subparser(commands.RotateCommand)
     args = parser.parse_args(['rotate', 'uploadlabel'])
@@ -313,6 +649,110 @@ def test_RotateCommand_actual(commands, mock_env_cfg, config):
     assert obj.upload_env
 
 
+@pytest.fixture
+def rotate(commands, mock_env_cfg, config):
+    def run(cmd, cmdline, candidates, results=None):
+        parser, obj = create_subparser(cmd)
+        args = parser.parse_args(cmdline)
+        with mock.patch.object(commands.config, "UploadEnvConfig") as uec:
+            uec.return_value = config.Config({"uploadlabel": mock_env_cfg})
+            with mock.patch.object(commands.osclient, "OSClient") as mock_os:
+                mock_os.return_value.find_obsolete_unused_candidates.return_value = candidates
+                mock_os.return_value.delete_images.return_value = results or []
+                try:
+                    args.command(args)
+                finally:
+                    obj.mock_os = mock_os.return_value
+        return obj
+    return run
+
+
+def test_RotateCommand_options(commands, rotate):
+    obj = rotate(
+        commands.RotateCommand,
+        ['rotate', 'uploadlabel', '--page-size', '10', '--workers', '3'],
+        set(['img']),
+        [commands.parallel.Result('img', None, None)]
+    )
+    assert obj.mock_os.find_obsolete_unused_candidates.call_args == mock.call(None, page_size=10)
+    assert obj.mock_os.delete_images.call_args == mock.call(set(['img']), 3)
+
+
+def test_RotateCommand_dry_run(commands, rotate):
+    obj = rotate(commands.RotateCommand, ['rotate', 'uploadlabel', '--dry-run'], set(['img']))
+    assert not obj.mock_os.delete_images.called
+
+
+def test_RotateCommand_delete_failed(commands, rotate, capsys):
+    with pytest.raises(commands.RotateFailedError):
+        rotate(
+            commands.RotateCommand,
+            ['rotate', 'uploadlabel'],
+            set(['img1', 'img2']),
+            [
+                commands.parallel.Result('img1', None, None),
+                commands.parallel.Result('img2', None, ValueError('in use'))
+            ]
+        )
+    out = capsys.readouterr()[0]
+    assert 'Unable to remove img2: in use' in out
+    assert 'Removed 1 of 2 images' in out
+
+
+def test_RotateSingleCommand(commands, rotate, mock_image_cfg, config):
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        ic.return_value = config.Config({"imagelabel": mock_image_cfg})
+        obj = rotate(
+            commands.RotateSingleCommand,
+            ['rotate-single', 'imagelabel', 'uploadlabel'],
+            set()
+        )
+    assert obj.mock_os.find_obsolete_unused_candidates.call_args[0][0] == mock_image_cfg['glance']['name']
+    assert not obj.mock_os.delete_images.called
+
+
+@pytest.fixture
+def many_images(commands, config, mock_image_cfg):
+    images = {
+        'img1': dict(mock_image_cfg, glance={'name': 'foo'}),
+        'img2': dict(mock_image_cfg, glance={'name': 'bar'}),
+        'img3': dict(mock_image_cfg, glance={'name': 'foo'}),
+    }
+    with mock.patch.object(commands.config, "ImageConfig") as ic:
+        ic.return_value = config.Config(images)
+        yield
+
+
+@pytest.mark.parametrize('cmdline', [
+    ['rotate-single', 'img1', 'img2', 'img3', 'uploadlabel'],
+    ['rotate-single', '--all', 'uploadlabel'],
+])
+def test_RotateSingleCommand_many(commands, many_images, cmdline):
+    with mock.patch.object(commands.osclient, "OSClient") as mock_os:
+        mock_os.return_value.find_obsolete_unused_candidates_by_name.return_value = {
+            'foo': set(['foo1']),
+            'bar': set(['bar1', 'bar2'])
+        }
+        mock_os.return_value.delete_images.return_value = []
+        parser, obj = create_subparser(commands.RotateSingleCommand)
+        args = parser.parse_args(cmdline)
+        with mock.patch.object(commands.config, "UploadEnvConfig") as uec:
+            uec.return_value = {"uploadlabel": {'keystone': {}}}
+            args.command(args)
+    find = mock_os.return_value.find_obsolete_unused_candidates_by_name
+    assert sorted(find.call_args[0][0]) == ['bar', 'foo']
+    assert mock_os.return_value.delete_images.call_args[0][0] == set(['foo1', 'bar1', 'bar2'])
+
+
+@pytest.mark.parametrize('cmdline', [
+    ['rotate-single', 'uploadlabel'],
+    ['rotate-single', '--all', 'img1', 'uploadlabel'],
+])
+def test_RotateSingleCommand_bad_labels(commands, rotate, many_images, cmdline):
+    with pytest.raises(SystemExit):
+        rotate(commands.RotateSingleCommand, cmdline, set())
+
+
 def test_ObsoleteCommand_actual(commands, mock_env_cfg, config):
     parser, obj = create_subparser(commands.ObsoleteCommand)
     args = parser.parse_args(['mark-obsolete', 'uploadlabel', 'myuuid'])
@@ -410,6 +850,51 @@ def test_main_test_command_with_exceptions(commands, mock_image_cfg, mock_env_cf
                 commands.main(['test', 'label']) == 1
 
 
+def test_error_code_by_name(commands):
+    from keystoneauth1 import exceptions
+    assert commands.error_code(
+        exceptions.http.Unauthorized(), commands.SAD_TABLE
+    ) == 20
+
+
+def test_error_code_most_specific(commands):
+    assert commands.error_code(
+        commands.UploadFailedError(), commands.SAD_TABLE
+    ) == 19
+    assert commands.error_code(
+        commands.UploadFailedError(), commands.KNOWN_ERRORS
+    ) == 1
+
+
+def test_error_code_not_found(commands):
+    assert commands.error_code(ValueError(), commands.SAD_TABLE) is None
+
+
+def test_error_code_not_imported(commands):
+    assert commands.error_code(ValueError(), (
+        ('no_such_module_for_dibctl.Error', 1),
+    )) is None
+
+
+def test_main_exit_code(commands):
+    with mock.patch.object(commands.config, "ImageConfig") as m:
+        m.side_effect = commands.config.NotFoundInConfigError
+        assert commands.main(['build', 'label']) == 11
+
+
+def test_main_known_error(commands):
+    with mock.patch.object(commands.config, "ImageConfig") as m:
+        m.side_effect = IOError('no file')
+        assert commands.main(['build', 'label']) == 1
+
+
+def test_main_bad_exception(commands):
+    with mock.patch.object(commands.config, "ImageConfig") as m:
+        m.side_effect = ValueError('bad')
+        with pytest.raises(ValueError):
+            commands.main(['build', 'label'])
+
+
 def test_init(commands):
     with mock.patch.object(commands, "Main") as m:
         m.return_value.run.return_value = 42
@@ -471,6 +471,181 @@ def test_len(config, data):
     assert len(config.Config(data)) == len(data)
 
 
+def test_compiled_validator_once(config):
+    schema = {'type': 'object'}
+    with mock.patch.object(config.jsonschema.validators, 'validator_for') as v:
+        first = config.compiled_validator(schema)
+        second = config.compiled_validator(schema)
+    assert first == second
+    assert v.call_count == 1
+
+
+def test_entry_schema_keeps_draft(config):
+    cfg = config.ImageConfig.__new__(config.ImageConfig)
+    schema = cfg.entry_schema()
+    assert schema['$schema'] == config.ImageConfig.SCHEMA['$schema']
+    assert cfg.entry_schema() is schema
+    validator, schema_hash = config.compiled_validator(schema)
+    assert isinstance(validator, config.jsonschema.Draft4Validator)
+
+
+def test_load_yaml_fallback(config):
+    assert config.load_yaml('{foo: {properties:[foo, bar]}}') == {
+        'foo': {'properties': ['foo', 'bar']}
+    }
+
+
+def test_load_yaml_error(config):
+    with pytest.raises(config.yaml.YAMLError):
+        config.load_yaml('{foo: [}')
+
+
+def test_imageconfig_uses_snapshot(config, tmpdir):
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('image1: {filename: ok}')
+    assert config.ImageConfig(str(cfg)).get('image1.filename') == 'ok'
+    with mock.patch.object(config, 'load_yaml') as mock_load:
+        assert config.ImageConfig(str(cfg)).get('image1.filename') == 'ok'
+    assert not mock_load.called
+
+
+def test_imageconfig_snapshot_changed_file(config, tmpdir):
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('image1: {filename: ok}')
+    config.ImageConfig(str(cfg))
+    cfg.write('image1: {filename: changed}')
+    assert config.ImageConfig(str(cfg)).get('image1.filename') == 'changed'
+
+
+def test_snapshot_per_schema(config, tmpdir):
+    cfg = tmpdir.join('test.yaml')
+    cfg.write('env: {keystone: {}, nova: {flavor: x}}')
+    config.TestEnvConfig(str(cfg))
+    with pytest.raises(config.InvaidConfigError):
+        config.UploadEnvConfig(str(cfg))
+
+
+def test_snapshot_not_saved_for_invalid(config, tmpdir):
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('image1: {}')
+    with pytest.raises(config.InvaidConfigError):
+        config.ImageConfig(str(cfg))
+    with pytest.raises(config.InvaidConfigError):
+        config.ImageConfig(str(cfg))
+
+
+def test_snapshot_cache_forgets_removed_files(config, tmpdir):
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('a: b')
+    snapshots = config.SnapshotCache(str(tmpdir.join('snapshots')))
+    snapshots.put(str(cfg), {'a': 'b'}, 'hash')
+    snapshots.put(str(tmpdir.join('removed.yaml')), {}, 'hash')
+    cfg.remove()
+    snapshots.put(str(tmpdir.join('other.yaml')), {}, 'hash')
+    snapshots.save()
+    assert config.SnapshotCache(str(tmpdir.join('snapshots')))._load() == {}
+
+
+def test_snapshot_cache_unusable_file(config, tmpdir):
+    cache_file = tmpdir.join('snapshots')
+    cache_file.write('junk')
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('a: b')
+    snapshots = config.SnapshotCache(str(cache_file))
+    assert snapshots.get(str(cfg)) is None
+    snapshots.put(str(cfg), {'a': 'b'})
+    snapshots.put(str(cfg), {'a': 'b'}, 'hash')
+    snapshots.save()
+    restored = config.SnapshotCache(str(cache_file))
+    assert restored.get(str(cfg)) == ({'a': 'b'}, set(['hash']))
+
+
+@pytest.mark.parametrize('path, mode', [
+    ('snapshots', 0o644),
+    ('.', 0o777),
+])
+def test_snapshot_cache_insecure_file_ignored(config, tmpdir, path, mode):
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('a: b')
+    snapshots = config.SnapshotCache(str(tmpdir.join('snapshots')))
+    snapshots.put(str(cfg), {'a': 'b'}, 'hash')
+    snapshots.save()
+    tmpdir.join(path).chmod(mode)
+    assert config.SnapshotCache(str(tmpdir.join('snapshots'))).get(str(cfg)) is None
+
+
+def test_snapshot_cache_changed_file_loses_hashes(config, tmpdir):
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('a: b')
+    snapshots = config.SnapshotCache(str(tmpdir.join('snapshots')))
+    snapshots.put(str(cfg), {'a': 'b'}, 'hash')
+    cfg.write('a: changed')
+    assert snapshots.get(str(cfg)) is None
+    snapshots.put(str(cfg), {'a': 'changed'})
+    assert snapshots.get(str(cfg)) == ({'a': 'changed'}, set())
+
+
+@pytest.fixture
+def lazy_images(tmpdir):
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('good: {filename: ok}\nbad: {glance: {name: 1}}\n')
+    return str(cfg)
+
+
+def test_lazy_config_validates_used_entries(config, lazy_images):
+    conf = config.ImageConfig(lazy_images, lazy=True)
+    assert conf['good'] == {'filename': 'ok'}
+    assert conf.get('good.filename') == 'ok'
+    assert conf.pending == {'bad': lazy_images}
+    with pytest.raises(config.InvaidConfigError) as e:
+        conf['bad']
+    assert lazy_images in str(e.value)
+    with pytest.raises(config.InvaidConfigError):
+        conf.get('bad.glance.name')
+
+
+def test_lazy_config_items_validate_everything(config, lazy_images):
+    conf = config.ImageConfig(lazy_images, lazy=True)
+    with pytest.raises(config.InvaidConfigError):
+        conf.items()
+
+
+def test_full_config_after_lazy(config, lazy_images):
+    config.ImageConfig(lazy_images, lazy=True)
+    with pytest.raises(config.InvaidConfigError):
+        config.ImageConfig(lazy_images)
+
+
+def test_lazy_config_uses_validated_snapshot(config, tmpdir):
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('image1: {filename: ok}')
+    config.ImageConfig(str(cfg))
+    conf = config.ImageConfig(str(cfg), lazy=True)
+    assert conf.pending == {}
+
+
+def test_lazy_config_redefined_label(config, tmpdir):
+    cfg1 = tmpdir.join('images1.yaml')
+    cfg1.write('image1: {}')
+    cfg2 = tmpdir.join('images2.yaml')
+    cfg2.write('image1: {filename: ok}')
+    conf = config.ImageConfig(str(cfg1), lazy=True)
+    conf.add_config(str(cfg2), lazy=True)
+    assert conf['image1'] == {'filename': 'ok'}
+
+
+def test_lazy_config_override_filename(config, lazy_images):
+    conf = config.ImageConfig(lazy_images, override_filename='new', lazy=True)
+    assert conf['good'] == {'filename': 'new'}
+
+
+def test_lazy_config_not_an_object(config, tmpdir):
+    cfg = tmpdir.join('images.yaml')
+    cfg.write('[1, 2]')
+    with pytest.raises(config.InvaidConfigError):
+        config.ImageConfig(str(cfg), lazy=True)
+
+
 if __name__ == "__main__":
     file_to_test = os.path.join(
         parentdir,
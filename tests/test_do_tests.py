@@ -2,6 +2,8 @@
 import mock
 import pytest
 import os
+import time
+import subprocess
 import inspect
 import sys
 from mock import sentinel
@@ -115,6 +117,18 @@ def test_run_test_matrix(do_tests, runner, continue_on_fail, result, expected):
         assert mock_r.runner.called
 
 
+@pytest.mark.parametrize('test, workers, test_timeout', [
+    [{'pytest': 'path'}, 1, None],
+    [{'pytest': 'path', 'parallel': 4, 'test_timeout': 30}, 4, 30],
+])
+def test_run_test_parallel(do_tests, test, workers, test_timeout):
+    dt = do_tests.DoTests({}, {})
+    with mock.patch.object(do_tests, 'pytest_runner') as mock_r:
+        dt.run_test(sentinel.ssh, test, sentinel.config, sentinel.var)
+        assert mock_r.runner.call_args[1]['workers'] == workers
+        assert mock_r.runner.call_args[1]['test_timeout'] == test_timeout
+
+
 def test_init_ssh_with_data(do_tests):
     env = {
         'nova': {
@@ -325,6 +339,18 @@ def test_wait_port_timeout(do_tests):
         dt.wait_port(mock_prep_os)
 
 
+def test_reconfigure_for_existing_instance(do_tests, mock_image, mock_env):
+    dt = do_tests.DoTests(mock_image, mock_env)
+    dt.reconfigure_for_existing_instance(sentinel.instance, sentinel.key_file)
+    with mock.patch.object(do_tests.prepare_os, "PrepOS") as mock_prep_os:
+        mock_prep_os.return_value.__enter__.side_effect = ValueError
+        with pytest.raises(ValueError):
+            dt.process(False, False)
+    assert mock_prep_os.call_args[1]['override_instance'] == sentinel.instance
+    assert mock_prep_os.call_args[1]['private_key_file'] == sentinel.key_file
+    assert mock_prep_os.call_args[1]['delete_image'] is False
+
+
 @pytest.mark.parametrize('port', [False, 22])
 def test_process_minimal(do_tests, port, capsys):
     env = {
@@ -432,6 +458,24 @@ def test_process_all_tests_fail(do_tests, capsys, Config):
             assert runner.call_count == 1
 
 
+@pytest.mark.parametrize('results, tests_passed', [
+    [[True, True], True],
+    [[False, True], False],
+])
+def test_process_sets_tests_passed(do_tests, Config, results, tests_passed):
+    image = {
+        'tests': {
+            'tests_list': [{'pytest': sentinel.path1}, {'pytest': sentinel.path2}]
+        }
+    }
+    dt = do_tests.DoTests(Config(image), Config({}), continue_on_fail=True)
+    dt.ssh = mock.MagicMock()
+    with mock.patch.object(do_tests.pytest_runner, "runner", side_effect=results):
+        with mock.patch.object(do_tests.prepare_os, "PrepOS") as mock_prep_os_class:
+            assert dt.process(False, False) is True
+    assert mock_prep_os_class.return_value.tests_passed is tests_passed
+
+
 def test_process_all_tests_fail_open_shell(do_tests, Config):
     env = {
         'nova': {
@@ -477,6 +521,129 @@ def test_run_all_tests(do_tests, result, Config):
         assert dt.run_all_tests(mock.MagicMock()) is result
 
 
+def concurrent_dt(do_tests, Config, tests_list, concurrency=4, continue_on_fail=False):
+    image = {'tests': {'tests_list': tests_list, 'concurrency': concurrency}}
+    dt = do_tests.DoTests(Config(image), Config({}), continue_on_fail=continue_on_fail)
+    dt.ssh = None
+    return dt
+
+
+def fake_run_test(ssh, test, prep_os, vars):
+    '''test entry: {'pytest': name, 'sleep': seconds, 'result': bool, 'log': file}'''
+    if 'log' in test:
+        with open(test['log'], 'a') as f:
+            f.write('start %s\n' % test['pytest'])
+    if 'spawn' in test:
+        child = subprocess.Popen(['sh', '-c', 'trap "" TERM; sleep 60'])
+        with open(test['spawn'], 'w') as f:
+            f.write(str(child.pid))
+    time.sleep(test.get('sleep', 0))
+    print("tests %s done" % test['pytest'])
+    if 'log' in test:
+        with open(test['log'], 'a') as f:
+            f.write('end %s\n' % test['pytest'])
+    return test.get('result', True)
+
+
+@pytest.mark.parametrize('results, expected', [
+    [[True, True, True], True],
+    [[True, False, True], False],
+])
+def test_run_tests_concurrently(do_tests, Config, capsys, results, expected):
+    tests_list = [
+        {'pytest': 'suite%s' % n, 'sleep': 1, 'result': r}
+        for n, r in enumerate(results)
+    ]
+    dt = concurrent_dt(do_tests, Config, tests_list, continue_on_fail=True)
+    prep_os = mock.MagicMock()
+    with mock.patch.object(dt, 'run_test', side_effect=fake_run_test):
+        start = time.time()
+        assert dt.run_all_tests(prep_os) is expected
+        assert time.time() - start < 2.5
+    out = capsys.readouterr()[0]
+    assert out.index('suite0 done') < out.index('suite1 done') < out.index('suite2 done')
+
+
+def test_run_tests_concurrently_groups(do_tests, Config, tmpdir):
+    log = str(tmpdir.join('log'))
+    tests_list = [
+        {'pytest': 'a', 'group': 'net', 'sleep': 0.3, 'log': log},
+        {'pytest': 'b', 'group': 'net', 'log': log},
+    ]
+    dt = concurrent_dt(do_tests, Config, tests_list)
+    with mock.patch.object(dt, 'run_test', side_effect=fake_run_test):
+        assert dt.run_all_tests(mock.MagicMock()) is True
+    assert open(log).read().split('\n')[:4] == ['start a', 'end a', 'start b', 'end b']
+
+
+def test_run_tests_concurrently_limit(do_tests, Config):
+    tests_list = [{'pytest': str(n), 'sleep': 0.5} for n in range(4)]
+    dt = concurrent_dt(do_tests, Config, tests_list, concurrency=2)
+    with mock.patch.object(dt, 'run_test', side_effect=fake_run_test):
+        start = time.time()
+        assert dt.run_all_tests(mock.MagicMock()) is True
+        assert time.time() - start >= 1
+
+
+def test_run_tests_concurrently_cancels_on_failure(do_tests, Config, capsys):
+    tests_list = [
+        {'pytest': 'slow', 'sleep': 60},
+        {'pytest': 'failing', 'result': False},
+        {'pytest': 'not_started'},
+    ]
+    dt = concurrent_dt(do_tests, Config, tests_list, concurrency=2)
+    with mock.patch.object(dt, 'run_test', side_effect=fake_run_test):
+        start = time.time()
+        assert dt.run_all_tests(mock.MagicMock()) is False
+        assert time.time() - start < 10
+    out = capsys.readouterr()[0]
+    assert 'Cancelled due to failure of other tests' in out
+    assert 'not_started done' not in out
+    assert 'were not run' in out
+
+
+def test_run_tests_concurrently_cancel_kills_children(do_tests, Config, tmpdir):
+    pidfile = str(tmpdir.join('pid'))
+    tests_list = [
+        {'pytest': 'slow', 'sleep': 60, 'spawn': pidfile},
+        {'pytest': 'failing', 'sleep': 0.5, 'result': False},
+    ]
+    dt = concurrent_dt(do_tests, Config, tests_list, concurrency=2)
+    with mock.patch.object(do_tests, 'KILL_GRACE_PERIOD', 0.5):
+        with mock.patch.object(dt, 'run_test', side_effect=fake_run_test):
+            assert dt.run_all_tests(mock.MagicMock()) is False
+    child = int(open(pidfile).read())
+    for i in range(100):
+        if not os.path.exists('/proc/%s' % child):
+            break
+        if open('/proc/%s/stat' % child).read().split(')')[-1].split()[0] == 'Z':
+            break
+        time.sleep(0.05)
+    else:
+        assert False, 'child of cancelled entry is still running'
+
+
+def test_run_tests_concurrently_shares_ssh(do_tests, Config):
+    dt = concurrent_dt(do_tests, Config, [{'pytest': 'a'}, {'pytest': 'b'}])
+    dt.ssh = mock.MagicMock()
+    with mock.patch.object(dt, 'run_test', side_effect=fake_run_test):
+        assert dt.run_all_tests(mock.MagicMock()) is True
+    assert dt.ssh.share.called
+
+
+def test_run_tests_concurrently_error_in_entry(do_tests, Config, capsys):
+    dt = concurrent_dt(do_tests, Config, [{'pytest': 'a'}, {'pytest': 'b'}])
+    with mock.patch.object(dt, 'run_test', side_effect=ValueError('boom')):
+        assert dt.run_all_tests(mock.MagicMock()) is False
+    assert 'ValueError: boom' in capsys.readouterr()[0]
+
+
+def test_run_tests_concurrently_bad_config(do_tests, Config):
+    dt = concurrent_dt(do_tests, Config, [{'pytest': 'a'}, {'badrunner': 'b'}])
+    with pytest.raises(do_tests.BadTestConfigError):
+        dt.run_all_tests(mock.MagicMock())
+
+
 @pytest.mark.parametrize('retval, keep', [
     [0, False],
     [1, False],
@@ -180,6 +180,266 @@ def test_context_manager_without_processing(i_p):
         assert tempname == new_name
 
 
+@pytest.fixture
+def stream_files(tmpdir):
+    source = tmpdir.join('image')
+    source.write('x' * 100000)
+    return str(source), str(tmpdir.join('image.raw'))
+
+
+def streaming(cmdline, **kwargs):
+    settings = {
+        'output_filename': '%(input_filename)s.raw',
+        'cmdline': cmdline,
+        'streaming': True
+    }
+    settings.update(kwargs)
+    return settings
+
+
+def read_all(stream):
+    data = b''
+    while True:
+        chunk = stream.read(4096)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_streaming(i_p, stream_files):
+    source, output = stream_files
+    p = i_p.Preprocess(source, {}, streaming(
+        'cat %(input_filename)s > %(output_filename)s'
+    ))
+    with p as name:
+        assert name == output
+        assert not os.path.isfile(output)  # FIFO, not a file
+        stream = p.source()
+        assert read_all(stream) == 'x' * 100000
+        stream.close()
+    assert not os.path.exists(output)
+
+
+def test_streaming_failure(i_p, stream_files):
+    source, output = stream_files
+    p = i_p.Preprocess(source, {}, streaming(
+        'printf abc > %(output_filename)s; exit 3'
+    ))
+    with p:
+        stream = p.source()
+        assert stream.read(3) == 'abc'
+        with pytest.raises(i_p.PreprocessError):
+            stream.read(3)
+    assert not os.path.exists(output)
+
+
+@pytest.mark.parametrize('code, error', [
+    [0, False],
+    [2, True]
+])
+def test_streaming_command_without_output(i_p, stream_files, code, error):
+    p = i_p.Preprocess(stream_files[0], {}, streaming('exit %s' % code))
+    with p:
+        stream = p.source()
+        if error:
+            with pytest.raises(i_p.PreprocessError):
+                stream.read()
+        else:
+            assert stream.read() == ''
+
+
+def test_streaming_source_once(i_p, stream_files):
+    p = i_p.Preprocess(stream_files[0], {}, streaming('exit 0'))
+    with p:
+        p.source().close()
+        with pytest.raises(i_p.PreprocessError):
+            p.source()
+
+
+def test_streaming_stops_unread_command(i_p, stream_files):
+    source, output = stream_files
+    p = i_p.Preprocess(source, {}, streaming('exec yes > %(output_filename)s'))
+    with p:
+        assert p.source().read(10) == 'y\ny\ny\ny\ny\n'
+    assert not p.watcher.is_alive()
+    assert not os.path.exists(output)
+
+
+def test_streaming_stale_fifo(i_p, stream_files):
+    source, output = stream_files
+    os.mkfifo(output)
+    p = i_p.Preprocess(source, {}, streaming(
+        'cat %(input_filename)s > %(output_filename)s'
+    ))
+    with p:
+        assert len(read_all(p.source())) == 100000
+
+
+def test_streaming_use_existing_file(i_p, stream_files):
+    source, output = stream_files
+    open(output, 'w').write('converted')
+    p = i_p.Preprocess(source, {}, streaming('exit 1', use_existing=True))
+    with p as name:
+        assert name == output
+        assert p.source is None
+    assert open(output).read() == 'converted'
+
+
+def test_streaming_into_upload(i_p, stream_files):
+    from dibctl import image_upload
+    source, output = stream_files
+    p = i_p.Preprocess(source, {}, streaming(
+        'cat %(input_filename)s > %(output_filename)s'
+    ))
+    with p as name:
+        assert image_upload.file_key(name) is None
+        reader = image_upload.ChunkedReader(p.source(), chunk_size=4096)
+        try:
+            assert read_all(reader) == 'x' * 100000
+        finally:
+            reader.close()
+        assert reader.checksum.complete
+
+
+@pytest.fixture
+def cache_files(tmpdir):
+    source = tmpdir.join('image')
+    source.write('image')
+    return str(source), str(tmpdir.join('cache')), str(tmpdir.join('runs'))
+
+
+def cached(cache_dir, runs, cmdline='cat %(input_filename)s > %(output_filename)s', **kwargs):
+    settings = {
+        'output_filename': '%(input_filename)s.raw',
+        'cmdline': 'echo run >> %s; %s' % (runs, cmdline),
+        'cache': True,
+        'cache_dir': cache_dir
+    }
+    settings.update(kwargs)
+    return settings
+
+
+def count_runs(runs):
+    if not os.path.exists(runs):
+        return 0
+    return len(open(runs).readlines())
+
+
+def test_cache_reuses_result(i_p, cache_files):
+    source, cache_dir, runs = cache_files
+    for attempt in range(2):
+        with i_p.Preprocess(source, {}, cached(cache_dir, runs)) as name:
+            assert os.path.dirname(name) == cache_dir
+            assert open(name).read() == 'image'
+        assert os.path.isfile(name)  # not removed after upload
+    assert not os.path.exists(source + '.raw')
+    assert count_runs(runs) == 1
+
+
+def test_cache_key_depends_on_content_and_formats(i_p, cache_files):
+    source, cache_dir, runs = cache_files
+    with i_p.Preprocess(source, {}, cached(cache_dir, runs)) as name1:
+        pass
+    with i_p.Preprocess(source, {'disk_format': 'raw'}, cached(cache_dir, runs)) as name2:
+        pass
+    with open(source, 'w') as f:
+        f.write('new image')
+    os.utime(source, (0, 0))
+    with i_p.Preprocess(source, {}, cached(cache_dir, runs)) as name3:
+        assert open(name3).read() == 'new image'
+    assert len(set([name1, name2, name3])) == 3
+    assert count_runs(runs) == 3
+
+
+def test_cache_key_ignores_file_names(i_p, cache_files, tmpdir):
+    source, cache_dir, runs = cache_files
+    copy = str(tmpdir.join('copy'))
+    with open(copy, 'w') as f:
+        f.write('image')
+    with i_p.Preprocess(source, {}, cached(cache_dir, runs)) as name1:
+        pass
+    with i_p.Preprocess(copy, {}, cached(cache_dir, runs)) as name2:
+        pass
+    assert name1 == name2
+    assert count_runs(runs) == 1
+
+
+def test_cache_failed_command_leaves_nothing(i_p, cache_files):
+    source, cache_dir, runs = cache_files
+    with pytest.raises(i_p.PreprocessError):
+        with i_p.Preprocess(source, {}, cached(cache_dir, runs, 'echo partial > %(output_filename)s; exit 1')):
+            pass
+    assert [f for f in os.listdir(cache_dir) if not f.startswith(i_p.CACHE_INDEX_FILE_NAME)] == []
+    with i_p.Preprocess(source, {}, cached(cache_dir, runs)) as name:
+        assert open(name).read() == 'image'
+    assert count_runs(runs) == 2
+
+
+def test_cache_evicts_least_recently_used(i_p, tmpdir):
+    store = i_p.PreprocessCache(str(tmpdir), max_size=10)
+
+    def add(key, data):
+        name = store.temp_name()
+        with open(name, 'w') as f:
+            f.write(data)
+        try:
+            return store.publish(key, name)
+        finally:
+            store.release()
+
+    def lookup(key):
+        try:
+            return store.lookup(key)
+        finally:
+            store.release()
+    add('a', 'xxxx')
+    add('b', 'xxxx')
+    assert lookup('a')
+    add('c', 'xxxx')
+    assert lookup('b') is None
+    assert lookup('a')
+    assert lookup('c')
+    add('big', 'x' * 20)
+    assert lookup('big')  # newest entry is kept even if too big
+    assert lookup('a') is None
+    assert lookup('c') is None
+
+
+def test_cache_does_not_evict_entry_in_use(i_p, tmpdir):
+    user = i_p.PreprocessCache(str(tmpdir), max_size=10)
+    other = i_p.PreprocessCache(str(tmpdir), max_size=10)
+
+    def add(key, data):
+        name = other.temp_name()
+        with open(name, 'w') as f:
+            f.write(data)
+        other.publish(key, name)
+        other.release()
+    add('a', 'xxxxxx')
+    path = user.lookup('a')
+    add('b', 'xxxxxx')
+    assert os.path.isfile(path)
+    assert other.in_use('a')
+    user.release()
+    add('c', 'xxxxxx')
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + i_p.USE_LOCK_SUFFIX)
+    assert other.lookup('b') is None
+
+
+def test_cache_lookup_forgets_removed_file(i_p, tmpdir):
+    store = i_p.PreprocessCache(str(tmpdir))
+    name = store.temp_name()
+    open(name, 'w').close()
+    os.remove(store.publish('key', name))
+    store.release()
+    assert store.lookup('key') is None
+
+
+def test_cache_default_location(i_p, dibctl_cache_dir):
+    assert i_p.PreprocessCache().directory.startswith(str(dibctl_cache_dir))
+
+
 if __name__ == "__main__":
     ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
     currentdir = os.path.dirname(ourfilename)
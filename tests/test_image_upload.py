@@ -0,0 +1,471 @@
+#!/usr/bin/python
+import os
+import inspect
+import sys
+import io
+import pytest
+import mock
+from mock import sentinel
+
+
+@pytest.fixture
+def image_upload():
+    from dibctl import image_upload
+    return image_upload
+
+
+@pytest.fixture
+def image_file(tmpdir):
+    f = tmpdir.join('image.qcow2')
+    f.write('0123456789' * 10)
+    return str(f)
+
+
+@pytest.fixture
+def glance():
+    g = mock.MagicMock()
+    g.images.get_import_info.return_value = {
+        'import-methods': {'value': []}
+    }
+    g.images.create.return_value = mock.MagicMock(id='img_id')
+    g.images.get.return_value = g.images.create.return_value
+    return g
+
+
+def consume(image_id, data):
+    read_all(data, 64 * 1024)
+
+
+def read_all(reader, size):
+    result = b''
+    while True:
+        chunk = reader.read(size)
+        if not chunk:
+            return result
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        result += chunk
+
+
+@pytest.mark.parametrize('chunk_size, read_size', [
+    [1, 1],
+    [7, 3],
+    [3, 7],
+    [1000, 64],
+])
+def test_chunked_reader_content(image_upload, chunk_size, read_size):
+    data = b'0123456789' * 10
+    reader = image_upload.ChunkedReader(io.BytesIO(data), chunk_size)
+    assert read_all(reader, read_size) == data
+    reader.close()
+
+
+def test_chunked_reader_progress(image_upload):
+    progress = image_upload.UploadProgress('name', total=100, interval=1000)
+    reader = image_upload.ChunkedReader(io.BytesIO(b'x' * 100), 16, progress)
+    read_all(reader, 10)
+    reader.close()
+    assert progress.done_bytes == 100
+
+
+def test_chunked_reader_error(image_upload):
+    bad_file = mock.MagicMock()
+    bad_file.read.side_effect = IOError
+    reader = image_upload.ChunkedReader(bad_file, 16)
+    with pytest.raises(IOError):
+        reader.read(10)
+    reader.close()
+    assert bad_file.close.called
+
+
+def test_chunked_reader_deadline(image_upload):
+    errors = []
+
+    def worker():
+        reader = image_upload.ChunkedReader(io.BytesIO(b'x' * 100), 16)
+        try:
+            with image_upload.timeout.timeout(0.01):
+                image_upload.time.sleep(0.05)
+                reader.read(10)
+        except Exception as e:
+            errors.append(e)
+        reader.close()
+
+    t = image_upload.threading.Thread(target=worker)
+    t.start()
+    t.join()
+    assert isinstance(errors[0], image_upload.timeout.TimeoutError)
+
+
+def test_chunked_reader_close_without_read(image_upload):
+    reader = image_upload.ChunkedReader(io.BytesIO(b'x'), 16)
+    reader.close()
+
+
+@pytest.mark.parametrize('count', [1, 3])
+def test_tee_reader_all_consumers_get_data(image_upload, count):
+    from dibctl import parallel
+    data = b'0123456789' * 100
+    tee = image_upload.TeeReader(io.BytesIO(data), count, chunk_size=7)
+    results = parallel.run_parallel(lambda c: read_all(c, 13), tee.consumers, count)
+    assert [r.value for r in results] == [data] * count
+
+
+def test_tee_reader_closed_consumer_does_not_block(image_upload):
+    data = b'x' * 1000
+    tee = image_upload.TeeReader(io.BytesIO(data), 2, chunk_size=1, readahead=1)
+    tee.consumers[1].close()
+    assert read_all(tee.consumers[0], 100) == data
+
+
+def test_tee_reader_closes_source_after_consumers(image_upload):
+    source = mock.MagicMock()
+    source.read.return_value = b''
+    tee = image_upload.TeeReader(source, 2)
+    assert tee.consumers[0].read(10) == b''
+    tee.consumers[0].close()
+    assert not source.close.called
+    tee.consumers[1].close()
+    assert source.close.call_count == 1
+
+
+def test_tee_reader_error(image_upload):
+    bad_file = mock.MagicMock()
+    bad_file.read.side_effect = IOError
+    tee = image_upload.TeeReader(bad_file, 2)
+    for consumer in tee.consumers:
+        with pytest.raises(IOError):
+            consumer.read(10)
+
+
+def test_progress_report(image_upload, capsys):
+    progress = image_upload.UploadProgress('name', total=2 * image_upload.MB, interval=0)
+    progress.update(image_upload.MB)
+    assert '50.0%' in capsys.readouterr()[0]
+    progress.finish()
+    assert 'MB/s' in capsys.readouterr()[0]
+
+
+def test_mmap_file(image_upload, image_file):
+    f = image_upload.open_source(image_file)
+    assert isinstance(f, image_upload.MmapFile)
+    chunk = f.read(5)
+    assert isinstance(chunk, memoryview)
+    assert chunk == b'01234'
+    assert f.read() == (b'0123456789' * 10)[5:]
+    assert f.read(5) == b''
+    f.close()
+
+
+def test_chunked_reader_does_not_copy_mmap(image_upload, image_file):
+    r = image_upload.ChunkedReader(image_upload.open_source(image_file), chunk_size=30)
+    data = r.read(10)
+    assert isinstance(data, memoryview)
+    assert data == b'0123456789'
+    assert read_all(r, 7) == (b'0123456789' * 10)[10:]
+    assert r.checksum.complete
+    r.close()
+
+
+def test_open_source_empty_file(image_upload, tmpdir):
+    empty = tmpdir.join('empty')
+    empty.write('')
+    f = image_upload.open_source(str(empty))
+    assert not isinstance(f, image_upload.MmapFile)
+    assert f.read() == b''
+    f.close()
+
+
+def test_checksum(image_upload):
+    import hashlib
+    checksum = image_upload.Checksum()
+    checksum.update(b'foo')
+    checksum.update(b'bar')
+    checksum.update(b'')
+    assert checksum.complete
+    assert checksum.hexdigest('md5') == hashlib.md5(b'foobar').hexdigest()
+    assert checksum.hexdigest('sha256') == hashlib.sha256(b'foobar').hexdigest()
+
+
+@pytest.mark.parametrize('attrs', [
+    {'checksum': None, 'os_hash_algo': None},
+    {'checksum': 'bad', 'os_hash_algo': None},
+    {'checksum': None, 'os_hash_algo': 'sha256', 'os_hash_value': 'bad'},
+])
+def test_checksum_verify_incomplete(image_upload, attrs):
+    checksum = image_upload.Checksum()
+    checksum.update(b'foo')
+    checksum.verify(mock.MagicMock(**attrs))
+
+
+@pytest.mark.parametrize('attrs', [
+    {'checksum': 'bad', 'os_hash_algo': None},
+    {'checksum': None, 'os_hash_algo': 'sha256', 'os_hash_value': 'bad'},
+])
+def test_checksum_verify_mismatch(image_upload, attrs):
+    checksum = image_upload.Checksum()
+    checksum.update(b'foo')
+    checksum.update(b'')
+    with pytest.raises(image_upload.ChecksumMismatchError):
+        checksum.verify(mock.MagicMock(**attrs))
+
+
+def test_checksum_verify_ignores_unknown_algo(image_upload):
+    checksum = image_upload.Checksum()
+    checksum.update(b'')
+    checksum.verify(mock.MagicMock(checksum=None, os_hash_algo='sha512', os_hash_value='x'))
+
+
+def test_hash_cache(image_upload, image_file, tmpdir):
+    import hashlib
+    cache_file = str(tmpdir.join('hashes.json'))
+    hash_cache = image_upload.HashCache(cache_file)
+    assert hash_cache.get(image_file) is None
+    expected = hashlib.sha256(b'0123456789' * 10).hexdigest()
+    assert hash_cache.sha256(image_file) == expected
+    with mock.patch.object(image_upload, 'open_source') as mock_open:
+        assert image_upload.HashCache(cache_file).sha256(image_file) == expected
+        assert not mock_open.called
+
+
+def test_hash_cache_changed_file(image_upload, image_file):
+    hash_cache = image_upload.HashCache()
+    hash_cache.put(image_file, 'old')
+    with open(image_file, 'a') as f:
+        f.write('more')
+    assert hash_cache.get(image_file) is None
+
+
+def test_hash_cache_forgets_removed_files(image_upload, image_file, tmpdir):
+    other = tmpdir.join('other')
+    other.write('')
+    hash_cache = image_upload.HashCache()
+    hash_cache.put(str(other), 'other')
+    other.remove()
+    hash_cache.put(image_file, 'sha')
+    assert image_upload.cache.load_json(hash_cache.cache_file).keys() == [
+        os.path.abspath(image_file)
+    ]
+
+
+def test_upload_state_key_changes_with_file(image_upload, image_file):
+    key1 = image_upload.UploadState.key('loc', image_file)
+    with open(image_file, 'a') as f:
+        f.write('more')
+    key2 = image_upload.UploadState.key('loc', image_file)
+    assert key1 != key2
+    assert image_upload.UploadState.key('loc', '/nonexistent') is None
+
+
+def test_upload_state_persistence(image_upload, tmpdir):
+    state_file = str(tmpdir.join('state.json'))
+    state = image_upload.UploadState(state_file)
+    state.update('key', image_id='foo')
+    state.update('key', staged=True)
+    assert image_upload.UploadState(state_file).get('key') == {
+        'image_id': 'foo', 'staged': True
+    }
+    state.forget('key')
+    assert state.get('key') is None
+
+
+def test_upload_state_default_location(image_upload, dibctl_cache_dir):
+    state = image_upload.UploadState()
+    assert state.state_file.startswith(str(dibctl_cache_dir))
+
+
+def test_uploader_plain(image_upload, glance, image_file):
+    state = image_upload.UploadState()
+    uploader = image_upload.ImageUploader(glance, state, 'loc')
+    img = uploader.upload(image_file, lambda: open(image_file, 'rb'), {'name': 'foo'}, {'key': 'value'})
+    assert img.id == 'img_id'
+    assert glance.images.create.call_args == mock.call(name='foo')
+    assert glance.images.update.call_args == mock.call('img_id', key='value')
+    assert glance.images.upload.called
+    assert not glance.images.stage.called
+    assert state.get(state.key('loc', image_file)) is None
+
+
+def test_uploader_import(image_upload, glance, image_file):
+    glance.images.get_import_info.return_value = {
+        'import-methods': {'value': ['glance-direct', 'web-download']}
+    }
+    glance.images.get.return_value = mock.MagicMock(status='active')
+    uploader = image_upload.ImageUploader(glance)
+    uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {})
+    assert glance.images.stage.called
+    assert glance.images.image_import.call_args == mock.call('img_id', method='glance-direct')
+    assert not glance.images.upload.called
+
+
+def test_uploader_import_failed(image_upload, glance, image_file):
+    glance.images.get_import_info.return_value = {
+        'import-methods': {'value': ['glance-direct']}
+    }
+    glance.images.get.return_value = mock.MagicMock(status='killed')
+    uploader = image_upload.ImageUploader(glance)
+    with pytest.raises(image_upload.ImportFailedError):
+        uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {})
+
+
+def test_uploader_retry(image_upload, glance, image_file, capsys):
+    glance.images.upload.side_effect = [IOError('network'), None]
+    glance.images.create.side_effect = [
+        mock.MagicMock(id='broken'), mock.MagicMock(id='img_id')
+    ]
+    state = image_upload.UploadState()
+    uploader = image_upload.ImageUploader(glance, state, 'loc', retries=1)
+    img = uploader.upload(image_file, lambda: open(image_file, 'rb'), {'name': 'foo'}, {'key': 'value'})
+    assert img.id == 'img_id'
+    assert glance.images.upload.call_args_list == [
+        mock.call('broken', mock.ANY), mock.call('img_id', mock.ANY)
+    ]
+    assert glance.images.delete.call_args == mock.call('broken')
+    assert glance.images.create.call_args_list == [mock.call(name='foo')] * 2
+    assert glance.images.update.call_args == mock.call('img_id', key='value')
+    assert 'retrying' in capsys.readouterr()[0]
+
+
+def test_uploader_retry_exhausted(image_upload, glance, image_file):
+    glance.images.upload.side_effect = IOError('network')
+    state = image_upload.UploadState()
+    uploader = image_upload.ImageUploader(glance, state, 'loc', retries=1)
+    with pytest.raises(IOError):
+        uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {})
+    assert state.get(state.key('loc', image_file)) == {'image_id': 'img_id', 'staged': False}
+
+
+def test_uploader_timeout_not_retried(image_upload, glance, image_file):
+    glance.images.upload.side_effect = image_upload.timeout.TimeoutError('late')
+    uploader = image_upload.ImageUploader(glance, retries=3)
+    with pytest.raises(image_upload.timeout.TimeoutError):
+        uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {})
+    assert glance.images.upload.call_count == 1
+
+
+def test_uploader_resume_queued(image_upload, glance, image_file):
+    state = image_upload.UploadState()
+    state.update(state.key('loc', image_file), image_id='old_id', staged=False)
+    glance.images.get.return_value = mock.MagicMock(id='old_id', status='queued')
+    uploader = image_upload.ImageUploader(glance, state, 'loc')
+    img = uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {})
+    assert img.id == 'old_id'
+    assert not glance.images.create.called
+    assert glance.images.upload.call_args[0][0] == 'old_id'
+
+
+def test_uploader_resume_staged(image_upload, glance, image_file):
+    state = image_upload.UploadState()
+    state.update(state.key('loc', image_file), image_id='old_id', staged=True)
+    glance.images.get.return_value = mock.MagicMock(id='old_id', status='uploading')
+    glance.images.get.side_effect = [
+        mock.MagicMock(id='old_id', status='uploading'),
+        mock.MagicMock(id='old_id', status='active')
+    ]
+    uploader = image_upload.ImageUploader(glance, state, 'loc')
+    uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {})
+    assert not glance.images.create.called
+    assert not glance.images.stage.called
+    assert not glance.images.upload.called
+    assert glance.images.image_import.called
+
+
+def test_uploader_resume_active(image_upload, glance, image_file):
+    state = image_upload.UploadState()
+    state.update(state.key('loc', image_file), image_id='old_id')
+    glance.images.get.return_value = mock.MagicMock(id='old_id', status='active')
+    uploader = image_upload.ImageUploader(glance, state, 'loc')
+    assert uploader.upload(image_file, None, {}, {}).id == 'old_id'
+    assert not glance.images.create.called
+    assert state.get(state.key('loc', image_file)) is None
+
+
+@pytest.mark.parametrize('status', ['killed', 'deleted', 'uploading'])
+def test_uploader_resume_unusable(image_upload, glance, image_file, status):
+    state = image_upload.UploadState()
+    state.update(state.key('loc', image_file), image_id='old_id', staged=False)
+    glance.images.get.side_effect = [
+        mock.MagicMock(id='old_id', status=status),
+        glance.images.create.return_value
+    ]
+    uploader = image_upload.ImageUploader(glance, state, 'loc')
+    assert uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {}).id == 'img_id'
+    assert glance.images.create.called
+
+
+def test_uploader_checksum_ok(image_upload, glance, image_file):
+    import hashlib
+    data = open(image_file, 'rb').read()
+    glance.images.upload.side_effect = consume
+    glance.images.get.return_value = mock.MagicMock(
+        id='img_id',
+        checksum=hashlib.md5(data).hexdigest(),
+        os_hash_algo='sha256',
+        os_hash_value=hashlib.sha256(data).hexdigest()
+    )
+    uploader = image_upload.ImageUploader(glance)
+    uploader.upload(image_file, lambda: image_upload.open_source(image_file), {}, {})
+    assert not glance.images.delete.called
+
+
+def test_uploader_saves_hash(image_upload, glance, image_file):
+    import hashlib
+    glance.images.upload.side_effect = consume
+    glance.images.get.return_value = mock.MagicMock(id='img_id', checksum=None, dibctl_sha256=None)
+    hash_cache = image_upload.HashCache()
+    uploader = image_upload.ImageUploader(glance, hash_cache=hash_cache)
+    uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {})
+    expected = hashlib.sha256(b'0123456789' * 10).hexdigest()
+    assert hash_cache.get(image_file) == expected
+    assert glance.images.update.call_args == mock.call('img_id', dibctl_sha256=expected)
+
+
+def test_uploader_known_hash_in_meta(image_upload, glance, image_file):
+    hash_cache = image_upload.HashCache()
+    hash_cache.put(image_file, 'sha')
+    uploader = image_upload.ImageUploader(glance, hash_cache=hash_cache)
+    uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {'key': 'value'})
+    assert glance.images.update.call_args_list[0] == mock.call('img_id', key='value', dibctl_sha256='sha')
+
+
+def test_uploader_checksum_mismatch(image_upload, glance, image_file):
+    glance.images.upload.side_effect = consume
+    glance.images.get.return_value = mock.MagicMock(id='img_id', checksum='bad')
+    state = image_upload.UploadState()
+    uploader = image_upload.ImageUploader(glance, state, 'loc')
+    with pytest.raises(image_upload.ChecksumMismatchError):
+        uploader.upload(image_file, lambda: open(image_file, 'rb'), {}, {})
+    assert glance.images.delete.call_args == mock.call('img_id')
+    assert state.get(state.key('loc', image_file)) is None
+
+
+def test_tee_reader_checksum(image_upload):
+    import hashlib
+    data = b'x' * 100
+    tee = image_upload.TeeReader(io.BytesIO(data), 2, chunk_size=7)
+    tee.consumers[1].close()
+    read_all(tee.consumers[0], 10)
+    for consumer in tee.consumers:
+        assert consumer.checksum.hexdigest('md5') == hashlib.md5(data).hexdigest()
+
+
+def test_uploader_raw_data(image_upload, glance, image_file):
+    uploader = image_upload.ImageUploader(glance)
+    uploader.upload(image_file, lambda: sentinel.data, {}, {})
+    assert glance.images.upload.call_args == mock.call('img_id', sentinel.data)
+
+
+if __name__ == "__main__":
+    ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
+    currentdir = os.path.dirname(ourfilename)
+    parentdir = os.path.dirname(currentdir)
+    file_to_test = os.path.join(
+        parentdir,
+        os.path.basename(parentdir),
+        os.path.basename(ourfilename).replace("test_", '', 1)
+    )
+    pytest.main([
+     "-vv",
+     "--cov", file_to_test,
+     "--cov-report", "term-missing"
+     ] + sys.argv)
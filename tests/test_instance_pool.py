@@ -0,0 +1,307 @@
+#!/usr/bin/python
+import os
+import inspect
+import sys
+import stat
+import pytest
+import mock
+from mock import sentinel
+
+
+@pytest.fixture
+def instance_pool():
+    from dibctl import instance_pool
+    return instance_pool
+
+
+@pytest.fixture
+def pool(instance_pool, tmpdir):
+    return instance_pool.InstancePool(str(tmpdir.join('pool.json')), ttl=100)
+
+
+def add(pool, instance_id, image_uuid='img', name='image@env', owns_image=False, image_sha256='sha'):
+    return pool.add(
+        name, 'env', instance_id, 'key_' + instance_id, 'PRIVATE', image_uuid, owns_image, image_sha256
+    )
+
+
+@pytest.fixture
+def image(tmpdir):
+    image_file = tmpdir.join('image.qcow2')
+    image_file.write('data')
+    return {'filename': str(image_file)}
+
+
+@pytest.fixture
+def image_hash(instance_pool):
+    with mock.patch.object(instance_pool.image_upload, 'HashCache') as hash_cache:
+        hash_cache.return_value.sha256.return_value = 'sha'
+        yield hash_cache.return_value.sha256
+
+
+def test_pool_name(instance_pool):
+    assert instance_pool.InstancePool.pool_name('image', 'env') == 'image@env'
+
+
+def test_add(pool):
+    record = add(pool, 'i1')
+    assert pool.records() == [record]
+    assert open(record['key_file']).read() == 'PRIVATE'
+    assert stat.S_IMODE(os.stat(record['key_file']).st_mode) == 0o600
+
+
+def test_records_by_pool(pool):
+    add(pool, 'i1', name='a@env')
+    add(pool, 'i2', name='b@env')
+    assert [r['instance_id'] for r in pool.records('b@env')] == ['i2']
+
+
+def test_acquire_and_release(pool):
+    add(pool, 'i1')
+    record = pool.acquire('image@env')
+    assert record['instance_id'] == 'i1'
+    assert pool.acquire('image@env') is None
+    pool.release(record)
+    assert pool.acquire('image@env')['instance_id'] == 'i1'
+
+
+def test_acquire_other_pool(pool):
+    add(pool, 'i1')
+    assert pool.acquire('other@env') is None
+
+
+def test_acquire_by_image(pool):
+    add(pool, 'i1', image_uuid='img1')
+    add(pool, 'i2', image_uuid='img2')
+    assert pool.acquire('image@env', 'img2')['instance_id'] == 'i2'
+
+
+def test_acquire_by_image_sha256(pool):
+    add(pool, 'i1', image_sha256='old')
+    add(pool, 'i2', image_sha256='new')
+    assert pool.acquire('image@env', image_sha256='new')['instance_id'] == 'i2'
+    assert pool.acquire('image@env', image_sha256='new') is None
+
+
+def test_acquire_skips_expired(instance_pool, pool):
+    add(pool, 'i1')
+    with mock.patch.object(instance_pool.time, 'time', return_value=10 ** 10):
+        assert pool.acquire('image@env') is None
+
+
+def test_remove(pool):
+    r1 = add(pool, 'i1')
+    r2 = add(pool, 'i2')
+    assert pool.remove(r1) is False
+    assert not os.path.exists(r1['key_file'])
+    assert pool.remove(r2) is True
+    assert pool.records() == []
+
+
+def test_expired(instance_pool, pool):
+    add(pool, 'i1')
+    add(pool, 'i2')
+    pool.acquire('image@env')
+    assert pool.expired() == []
+    assert [r['instance_id'] for r in pool.expired(everything=True)] == ['i2']
+    now = instance_pool.time.time()
+    with mock.patch.object(instance_pool.time, 'time', return_value=now + 1000):
+        assert [r['instance_id'] for r in pool.expired()] == ['i2']
+    with mock.patch.object(instance_pool.time, 'time', return_value=now + 10 ** 6):
+        assert len(pool.expired()) == 2
+
+
+@pytest.mark.parametrize('owns_image, image_deleted', [
+    [True, True],
+    [False, False]
+])
+def test_delete(instance_pool, pool, owns_image, image_deleted):
+    record = add(pool, 'i1', owns_image=owns_image)
+    os_client = mock.MagicMock()
+    instance_pool.delete(pool, record, os_client)
+    assert os_client.delete_instance.call_args == mock.call('i1')
+    assert os_client.delete_keypair.call_args == mock.call('key_i1')
+    assert os_client.delete_image.called is image_deleted
+    assert pool.records() == []
+
+
+def test_delete_keeps_shared_image(instance_pool, pool):
+    record = add(pool, 'i1', owns_image=True)
+    add(pool, 'i2', owns_image=True)
+    os_client = mock.MagicMock()
+    instance_pool.delete(pool, record, os_client)
+    assert not os_client.delete_image.called
+
+
+def test_delete_failure_keeps_record(instance_pool, pool):
+    record = add(pool, 'i1', owns_image=True)
+    os_client = mock.MagicMock()
+    os_client.delete_keypair.side_effect = EnvironmentError('nova is down')
+    with pytest.raises(EnvironmentError):
+        instance_pool.delete(pool, record, os_client)
+    assert not os_client.delete_image.called
+    stored = pool.records()[0]
+    assert stored['leased'] is True
+    assert stored['deleted'] == ['instance']
+    assert os.path.exists(record['key_file'])
+    assert pool.acquire('image@env') is None
+    assert pool.expired() == [stored]
+    os_client.reset_mock()
+    os_client.delete_keypair.side_effect = None
+    instance_pool.delete(pool, stored, os_client)
+    assert not os_client.delete_instance.called
+    assert os_client.delete_keypair.call_args == mock.call('key_i1')
+    assert os_client.delete_image.call_args == mock.call('img')
+    assert pool.records() == []
+
+
+def test_delete_instance_failure_keeps_record(instance_pool, pool):
+    record = add(pool, 'i1')
+    os_client = mock.MagicMock()
+    os_client.delete_instance.side_effect = EnvironmentError('nova is down')
+    with pytest.raises(EnvironmentError):
+        instance_pool.delete(pool, record, os_client)
+    assert [r['instance_id'] for r in pool.records()] == ['i1']
+    assert not os_client.delete_keypair.called
+
+
+def test_reap(instance_pool, pool):
+    add(pool, 'i1')
+    add(pool, 'i2')
+    with mock.patch.object(instance_pool.prepare_os, 'connect') as connect:
+        results = instance_pool.reap(pool, {'env': sentinel.env}, everything=True)
+    assert connect.call_args == mock.call(sentinel.env)
+    assert connect.call_count == 1
+    assert len(results) == 2
+    assert pool.records() == []
+
+
+def test_fill_uploads_once(instance_pool, pool, image, image_hash):
+    with mock.patch.object(instance_pool.prepare_os, 'PrepOS') as prep:
+        prep.return_value.os_image.id = 'img'
+        prep.return_value.os_key.private_key = 'PRIVATE'
+        prep.return_value.os_key.name = 'key'
+        prep.return_value.os_instance.id = 'i1'
+        results = instance_pool.fill(
+            pool, 'image', image, 'env', sentinel.env, 2, workers=1
+        )
+    assert prep.return_value.upload_image.call_count == 1
+    assert prep.return_value.prepare.call_count == 2
+    assert prep.call_args == mock.call(image, sentinel.env, override_image='img')
+    assert all(r.error is None for r in results)
+    records = pool.records('image@env')
+    assert len(records) == 2
+    assert records[0]['owns_image'] is True
+    assert records[0]['image_sha256'] == 'sha'
+    assert not prep.return_value.os.delete_image.called
+
+
+def test_fill_removes_image_if_nothing_booted(instance_pool, pool, image, image_hash):
+    with mock.patch.object(instance_pool.prepare_os, 'PrepOS') as prep:
+        prep.return_value.os_image.id = 'img'
+        prep.return_value.prepare.side_effect = EnvironmentError('no quota')
+        results = instance_pool.fill(
+            pool, 'image', image, 'env', sentinel.env, 2, workers=1
+        )
+    assert all(r.error for r in results)
+    assert prep.return_value.os.delete_image.call_args == mock.call('img')
+    assert pool.records() == []
+
+
+def test_fill_existing_image_boot_error(instance_pool, pool):
+    with mock.patch.object(instance_pool.prepare_os, 'PrepOS') as prep:
+        prep.return_value.prepare.side_effect = EnvironmentError('no quota')
+        results = instance_pool.fill(
+            pool, 'image', sentinel.image, 'env', sentinel.env, 1, image_uuid='img'
+        )
+    assert not prep.return_value.upload_image.called
+    assert not prep.return_value.os.delete_image.called
+    assert prep.return_value.cleanup.called
+    assert isinstance(results[0].error, EnvironmentError)
+    assert pool.records() == []
+
+
+def test_lease(instance_pool, pool, image, image_hash):
+    add(pool, 'i1')
+    dt = mock.MagicMock()
+    record = instance_pool.lease(pool, 'image@env', dt, image=image)
+    assert image_hash.call_args == mock.call(image['filename'])
+    assert dt.reconfigure_for_existing_instance.call_args == mock.call(
+        'i1', record['key_file']
+    )
+
+
+def test_lease_changed_image(instance_pool, pool, image, image_hash, capsys):
+    add(pool, 'i1', image_sha256='old')
+    dt = mock.MagicMock()
+    assert instance_pool.lease(pool, 'image@env', dt, image=image) is None
+    assert not dt.reconfigure_for_existing_instance.called
+
+
+def test_lease_no_image_file(instance_pool, pool, capsys):
+    add(pool, 'i1')
+    dt = mock.MagicMock()
+    assert instance_pool.lease(pool, 'image@env', dt, image={'filename': '/nonexistent'}) is None
+    assert pool.records()[0]['leased'] is False
+
+
+def test_lease_by_uuid(instance_pool, pool):
+    add(pool, 'i1', image_sha256=None)
+    dt = mock.MagicMock()
+    assert instance_pool.lease(pool, 'image@env', dt, 'img')['instance_id'] == 'i1'
+
+
+def test_lease_empty_pool(instance_pool, pool, image, image_hash, capsys):
+    dt = mock.MagicMock()
+    assert instance_pool.lease(pool, 'image@env', dt, image=image) is None
+    assert not dt.reconfigure_for_existing_instance.called
+    assert 'will boot a new one' in capsys.readouterr()[0]
+
+
+def test_give_back_success(instance_pool, pool):
+    add(pool, 'i1')
+    record = pool.acquire('image@env')
+    instance_pool.give_back(pool, record, True, sentinel.env)
+    assert pool.records()[0]['leased'] is False
+
+
+def test_give_back_failure(instance_pool, pool):
+    add(pool, 'i1')
+    record = pool.acquire('image@env')
+    with mock.patch.object(instance_pool.prepare_os, 'connect') as connect:
+        instance_pool.give_back(pool, record, False, sentinel.env)
+    assert connect.return_value.delete_instance.called
+    assert pool.records() == []
+
+
+def test_give_back_failure_keep(instance_pool, pool):
+    add(pool, 'i1')
+    record = pool.acquire('image@env')
+    with mock.patch.object(instance_pool.prepare_os, 'connect') as connect:
+        instance_pool.give_back(pool, record, False, sentinel.env, keep=True)
+    assert not connect.called
+    assert pool.records() == []
+
+
+def test_give_back_error_is_reported(instance_pool, pool, capsys):
+    add(pool, 'i1')
+    record = pool.acquire('image@env')
+    with mock.patch.object(instance_pool.prepare_os, 'connect', side_effect=EnvironmentError('no keystone')):
+        instance_pool.give_back(pool, record, False, sentinel.env)
+    assert 'no keystone' in capsys.readouterr()[0]
+
+
+if __name__ == "__main__":
+    ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
+    currentdir = os.path.dirname(ourfilename)
+    parentdir = os.path.dirname(currentdir)
+    file_to_test = os.path.join(
+        parentdir,
+        os.path.basename(parentdir),
+        os.path.basename(ourfilename).replace("test_", '', 1)
+    )
+    pytest.main([
+     "-vv",
+     "--cov", file_to_test,
+     "--cov-report", "term-missing"
+     ] + sys.argv)
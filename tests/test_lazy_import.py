@@ -0,0 +1,166 @@
+#!/usr/bin/python
+import os
+import inspect
+import sys
+import json
+import subprocess
+import pytest
+import mock
+from mock import sentinel
+
+
+@pytest.fixture
+def lazy_import():
+    from dibctl import lazy_import
+    return lazy_import
+
+
+@pytest.fixture
+def dibctl_globals():
+    from dibctl import commands
+    return vars(commands)
+
+
+@pytest.fixture
+def unloaded():
+    sys.modules.pop('colorsys', None)
+    yield 'colorsys'
+    sys.modules.pop('colorsys', None)
+
+
+def test_lazy_module_imports_on_use(lazy_import, unloaded):
+    module = lazy_import.module(unloaded, globals())
+    assert unloaded not in sys.modules
+    assert module.rgb_to_hsv(0, 0, 0) == (0, 0, 0)
+    assert unloaded in sys.modules
+
+
+def test_lazy_module_relative_import(lazy_import, dibctl_globals):
+    from dibctl import timeout
+    module = lazy_import.module('timeout', dibctl_globals)
+    assert module.TimeoutError is timeout.TimeoutError
+
+
+def test_lazy_module_dotted_name(lazy_import):
+    import os.path
+    assert lazy_import.module('os.path', globals()).join is os.path.join
+
+
+def test_lazy_module_setattr_delattr(lazy_import, unloaded):
+    module = lazy_import.module(unloaded, globals())
+    module.new_attribute = sentinel.value
+    assert sys.modules[unloaded].new_attribute == sentinel.value
+    del module.new_attribute
+    assert not hasattr(sys.modules[unloaded], 'new_attribute')
+
+
+def test_lazy_module_mock_patch(lazy_import, unloaded):
+    module = lazy_import.module(unloaded, globals())
+    original = module.rgb_to_hsv
+    with mock.patch.object(module, 'rgb_to_hsv') as mock_func:
+        assert sys.modules[unloaded].rgb_to_hsv is mock_func
+    assert sys.modules[unloaded].rgb_to_hsv is original
+
+
+def test_lazy_module_import_error(lazy_import):
+    module = lazy_import.module('no_such_module_for_dibctl', globals())
+    with pytest.raises(ImportError):
+        module.foo
+
+
+def test_loaded(lazy_import, dibctl_globals, unloaded):
+    from dibctl import config
+    assert lazy_import.loaded('config', dibctl_globals) is config
+    assert lazy_import.loaded('os', dibctl_globals) is os
+    assert lazy_import.loaded(unloaded, dibctl_globals) is None
+
+
+def test_find_loaded(lazy_import, dibctl_globals, unloaded):
+    from dibctl import config
+    assert lazy_import.find_loaded(
+        'config.ConfigNotFound', dibctl_globals
+    ) is config.ConfigNotFound
+    assert lazy_import.find_loaded('os.path.join', {}) is os.path.join
+    assert lazy_import.find_loaded('os.no_such_name', {}) is None
+    assert lazy_import.find_loaded(unloaded + '.hsv_to_rgb', {}) is None
+    assert unloaded not in sys.modules
+
+
+HEAVY_MODULES = [
+    'keystoneauth1',
+    'novaclient',
+    'glanceclient',
+    'pytest',
+    'paramiko',
+    'pkg_resources'
+]
+
+
+def import_time(statement):
+    '''runs statement in a new interpreter, returns time and heavy modules'''
+    code = (
+        "import sys, time, json\n"
+        "start = time.time()\n"
+        "%s\n"
+        "duration = time.time() - start\n"
+        "print(json.dumps([duration, [m for m in %r if m in sys.modules]]))\n"
+    ) % (statement, HEAVY_MODULES)
+    output = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stderr=open(os.devnull, 'w')
+    )
+    return json.loads(output.splitlines()[-1])
+
+
+def test_startup_does_not_import_heavy_modules():
+    duration, heavy = import_time("import dibctl.commands")
+    assert heavy == []
+
+
+@pytest.mark.parametrize('command_line', [
+    ['validate'] + [
+        '--%s-config=docs/example_configs/%s.yaml' % (option, name)
+        for option, name in (
+            ('images', 'images'), ('upload', 'upload'), ('test', 'test')
+        )
+    ],
+    ['help', 'test'],
+    ['help', 'pool'],
+    ['help', 'rotate'],
+])
+def test_light_commands_do_not_import_heavy_modules(tmpdir, command_line):
+    duration, heavy = import_time(
+        "import os\n"
+        "os.environ['DIBCTL_CACHE_DIR'] = %r\n"
+        "import dibctl.commands\n"
+        "dibctl.commands.Main(%r).run()" % (str(tmpdir), command_line)
+    )
+    assert heavy == []
+
+
+def test_startup_benchmark():
+    startup, heavy = import_time("import dibctl.commands")
+    full, heavy = import_time(
+        "import dibctl.commands, dibctl.osclient, dibctl.pytest_runner"
+    )
+    print("startup import: %.3f s, with clients and runners: %.3f s" % (
+        startup, full
+    ))
+    assert startup < full
+
+
+if __name__ == "__main__":
+    ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
+    currentdir = os.path.dirname(ourfilename)
+    parentdir = os.path.dirname(currentdir)
+    file_to_test = os.path.join(
+        parentdir,
+        os.path.basename(parentdir),
+        os.path.basename(ourfilename).replace("test_", '', 1)
+    )
+    pytest.main([
+     "-vv",
+     "--cov", file_to_test,
+     "--cov-report", "term-missing"
+     ] + sys.argv)
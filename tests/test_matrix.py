@@ -0,0 +1,186 @@
+#!/usr/bin/python
+import os
+import inspect
+import sys
+import pytest
+import mock
+from mock import sentinel
+
+
+@pytest.fixture
+def matrix():
+    from dibctl import matrix
+    return matrix
+
+
+@pytest.fixture
+def config():
+    from dibctl import config
+    return config
+
+
+@pytest.fixture
+def envs(config):
+    return config.Config({
+        'env1': {
+            'keystone': {'auth_url': 'cloud1'},
+            'nova': {'flavor_id': 'id1', 'nics': []}
+        },
+        'env2': {
+            'keystone': {'auth_url': 'cloud1'},
+            'nova': {'flavor': 'small', 'availability_zone': 'az0'}
+        },
+        'env3': {
+            'keystone': {'auth_url': 'cloud2'},
+            'nova': {'flavor': 'small'}
+        }
+    })
+
+
+def test_cell_no_override(matrix, envs):
+    cell = matrix.Cell('env1', envs['env1'])
+    assert cell.name == 'env1'
+    assert cell.test_env['nova.flavor_id'] == 'id1'
+
+
+def test_cell_override(matrix, envs):
+    cell = matrix.Cell('env1', envs['env1'], 'large', 'az1')
+    assert cell.name == 'env1/large/az1'
+    assert cell.test_env['nova.flavor'] == 'large'
+    assert cell.test_env['nova.availability_zone'] == 'az1'
+    assert 'flavor_id' not in cell.test_env['nova'].config
+    assert envs['env1.nova.flavor_id'] == 'id1'
+
+
+def test_cell_cloud(matrix, envs):
+    cells = [matrix.Cell(label, envs[label]) for label in ('env1', 'env2', 'env3')]
+    assert cells[0].cloud() == cells[1].cloud()
+    assert cells[0].cloud() != cells[2].cloud()
+
+
+def test_make_cells(matrix, envs):
+    cells = matrix.make_cells(envs, ['env1', 'env2'], ['a', 'b'], ['z1', 'z2', 'z3'])
+    assert len(cells) == 12
+    assert cells[0].name == 'env1/a/z1'
+    assert cells[-1].name == 'env2/b/z3'
+
+
+def test_make_cells_no_overrides(matrix, envs):
+    cells = matrix.make_cells(envs, ['env1', 'env3'])
+    assert [c.name for c in cells] == ['env1', 'env3']
+
+
+def test_clouds(matrix, envs):
+    cells = matrix.make_cells(envs, ['env1', 'env3', 'env2'])
+    tm = matrix.TestMatrix(sentinel.image, cells)
+    assert [[c.name for c in cloud] for cloud in tm.clouds()] == [
+        ['env1', 'env2'], ['env3']
+    ]
+
+
+@pytest.mark.parametrize('status, code', [
+    [True, 0],
+    [False, 1]
+])
+def test_run_cell(matrix, envs, tmpdir, status, code):
+    cell = matrix.Cell('env1', envs['env1'])
+    tm = matrix.TestMatrix(
+        sentinel.image, [cell], keep_failed_instance=True, continue_on_fail=True
+    )
+    errors = tmpdir.join('errors').open('w+')
+    with mock.patch.object(matrix.do_tests, 'DoTests') as dt:
+        dt.return_value.process.return_value = status
+        assert tm.run_cell(cell, sentinel.uuid, errors) == code
+    assert dt.call_args[1]['image_uuid'] == sentinel.uuid
+    assert dt.call_args[1]['keep_failed_instance'] is True
+    assert dt.call_args[1]['continue_on_fail'] is True
+
+
+def test_run_cell_error(matrix, envs, capsys):
+    cells = matrix.make_cells(envs, ['env1'])
+    tm = matrix.TestMatrix(sentinel.image, cells)
+    with mock.patch.object(matrix.prepare_os, 'PrepOS'):
+        with mock.patch.object(matrix.do_tests, 'DoTests') as dt:
+            dt.return_value.process.side_effect = EnvironmentError('boom')
+            assert tm.run() is False
+    assert cells[0].result == 'error'
+    assert cells[0].error == 'boom'
+    assert cells[0].duration is not None
+    assert 'Output of env1:\nError: boom' in capsys.readouterr()[0]
+
+
+def test_run_uploads_once_per_cloud(matrix, envs, capsys, tmpdir):
+    cells = matrix.make_cells(envs, ['env1', 'env2', 'env3'], ['a', 'b'])
+    tm = matrix.TestMatrix(sentinel.image, cells, workers=3)
+    log = tmpdir.join('testers')
+    uploaders = []
+
+    def prep_os(image, test_env):
+        uploaders.append(mock.Mock())
+        return uploaders[-1]
+
+    def do_tests(*args, **kwargs):
+        log.write('%s\n' % os.getpid(), mode='a')
+        tester = mock.Mock()
+        tester.process.return_value = True
+        return tester
+
+    with mock.patch.object(matrix.prepare_os, 'PrepOS', side_effect=prep_os):
+        with mock.patch.object(matrix.do_tests, 'DoTests', side_effect=do_tests):
+            assert tm.run() is True
+    assert len(uploaders) == 2
+    pids = log.read().split()
+    assert len(set(pids)) == 6  # each cell in it's own process
+    assert str(os.getpid()) not in pids
+    for uploader in uploaders:
+        assert uploader.upload_image.call_count == 1
+        assert uploader.cleanup_image.call_count == 1
+    out = capsys.readouterr()[0]
+    assert 'env3/b' in out
+    assert '6 of 6 passed' in out
+
+
+def test_run_keep_failed_image(matrix, envs, capsys):
+    cells = matrix.make_cells(envs, ['env1'])
+    tm = matrix.TestMatrix(sentinel.image, cells, keep_failed_image=True)
+    with mock.patch.object(matrix.prepare_os, 'PrepOS') as prep:
+        with mock.patch.object(matrix.do_tests, 'DoTests') as dt:
+            dt.return_value.process.return_value = False
+            assert tm.run() is False
+    assert prep.return_value.update_image_delete_status.call_args == mock.call(delete=False)
+    assert prep.return_value.cleanup_image.called
+    assert '0 of 1 passed' in capsys.readouterr()[0]
+
+
+def test_run_upload_fails(matrix, envs, capsys):
+    cells = matrix.make_cells(envs, ['env1', 'env3'])
+    tm = matrix.TestMatrix(sentinel.image, cells)
+    def prep_os(image, test_env):
+        prep = mock.Mock()
+        if test_env['keystone.auth_url'] == 'cloud1':
+            prep.upload_image.side_effect = EnvironmentError('no space')
+        return prep
+
+    with mock.patch.object(matrix.prepare_os, 'PrepOS', side_effect=prep_os):
+        with mock.patch.object(matrix.do_tests, 'DoTests') as dt:
+            dt.return_value.process.return_value = True
+            assert tm.run() is False
+    results = sorted((c.name, c.result) for c in cells)
+    assert results == [('env1', 'error'), ('env3', 'passed')]
+    assert 'no space' in capsys.readouterr()[0]
+
+
+if __name__ == "__main__":
+    ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
+    currentdir = os.path.dirname(ourfilename)
+    parentdir = os.path.dirname(currentdir)
+    file_to_test = os.path.join(
+        parentdir,
+        os.path.basename(parentdir),
+        os.path.basename(ourfilename).replace("test_", '', 1)
+    )
+    pytest.main([
+     "-vv",
+     "--cov", file_to_test,
+     "--cov-report", "term-missing"
+     ] + sys.argv)
@@ -257,6 +257,51 @@ def test_set_api_version_bad_non_forced(empty_OSClient, osclient):
             empty_OSClient._set_api_version({}, False)
 
 
+def test_set_api_version_cached(empty_OSClient, osclient):
+    empty_OSClient.auth_cache = osclient.auth_cache.AuthCache()
+    with mock.patch.object(empty_OSClient, '_ask_for_version', return_value='v3') as ask:
+        empty_OSClient._set_api_version({'auth_url': 'http://keystone'}, False)
+        empty_OSClient._set_api_version({'auth_url': 'http://keystone'}, False)
+        assert ask.call_count == 1
+    assert empty_OSClient.api_version == 'v3'
+
+
+def test_auth_cache_broken(empty_OSClient, osclient, capsys):
+    empty_OSClient.auth_cache = mock.MagicMock()
+    empty_OSClient.auth_cache.get_version.side_effect = osclient.auth_cache.InsecureCacheError('bad')
+    with mock.patch.object(empty_OSClient, '_ask_for_version', return_value='v3'):
+        empty_OSClient._set_api_version({'auth_url': 'http://keystone'}, False)
+    assert empty_OSClient.auth_cache is None
+    assert 'Auth cache is disabled' in capsys.readouterr()[0]
+
+
+def test_auth_state_restore_and_save(empty_OSClient, osclient):
+    empty_OSClient.auth_cache = osclient.auth_cache.AuthCache()
+    empty_OSClient.auth_cache.set_auth_state('cache_id', 'old_state')
+    empty_OSClient.session = mock.MagicMock()
+    empty_OSClient.session.auth.get_cache_id.return_value = 'cache_id'
+    with mock.patch.object(osclient, '_auth_clients', osclient.weakref.WeakSet()):
+        empty_OSClient._restore_auth_state()
+        assert empty_OSClient.session.auth.set_auth_state.call_args == mock.call('old_state')
+        empty_OSClient.session.auth.get_auth_state.return_value = 'new_state'
+        osclient.save_auth_states()
+    assert empty_OSClient.auth_cache.get_auth_state('cache_id') == 'new_state'
+
+
+def test_save_auth_states_once_per_cache_id(osclient):
+    clients = [mock.MagicMock(auth_cache_id=cache_id) for cache_id in ('a', 'a', 'b')]
+    with mock.patch.object(osclient, '_auth_clients', set(clients)):
+        osclient.save_auth_states()
+    assert sum(client.save_auth_state.call_count for client in clients) == 2
+    assert clients[2].save_auth_state.called
+
+
+def test_auth_state_no_cache(empty_OSClient, osclient):
+    empty_OSClient.session = mock.MagicMock()
+    empty_OSClient.save_auth_state()
+    assert not empty_OSClient.session.auth.get_auth_state.called
+
+
 @pytest.mark.parametrize('version', ['v2', 'v3'])
 def test_set_api_version_ok_forced(empty_OSClient, osclient, version):
     empty_OSClient._set_api_version({'api_version': version}, False)
@@ -393,17 +438,23 @@ def test_init_disable_warnings(osclient, actual_keystone_data_v2):
             assert osclient.OSClient(actual_keystone_data_v2, {}, {}, {}, {}, disable_warnings=True)
 
 
-def test_osclient_upload_image_simple(osclient, mock_os):
+def test_osclient_upload_image_simple(osclient, mock_os, tmpdir):
+    image_file = tmpdir.join('image')
+    image_file.write('data')
+    mock_os.glance.images.create.return_value.id = 'uuid'
     with mock.patch.object(osclient, "open", mock.mock_open()):
-        mock_os.upload_image(sentinel.name, sentinel.filename)
+        mock_os.upload_image(sentinel.name, str(image_file))
         assert mock_os.glance.images.create.called
 
 
-def test_osclient_upload_image_all_args(osclient, mock_os):
+def test_osclient_upload_image_all_args(osclient, mock_os, tmpdir):
+    image_file = tmpdir.join('image')
+    image_file.write('data')
+    mock_os.glance.images.create.return_value.id = 'uuid'
     with mock.patch.object(osclient, "open", return_value=sentinel.opened_file):
         mock_os.upload_image(
             name=sentinel.name,
-            filename=sentinel.filename,
+            filename=str(image_file),
             public=True,
             disk_format=sentinel.disk_format,
             container_format=sentinel.container_format,
@@ -425,6 +476,22 @@ def test_osclient_upload_image_all_args(osclient, mock_os):
         assert mock_os.glance.images.update.called
 
 
+def test_osclient_upload_image_no_resume(osclient, mock_os):
+    with mock.patch.object(osclient.image_upload, "ImageUploader") as mock_uploader:
+        mock_os.upload_image(sentinel.name, sentinel.filename, resume=False)
+        assert mock_uploader.call_args[1]['state'] is None
+        assert mock_uploader.return_value.upload.called
+
+
+@pytest.mark.parametrize('auth, location', [
+    [{'auth_url': 'http://x', 'tenant_name': 'foo'}, 'http://x/foo'],
+    [{'auth_url': 'http://x', 'project_name': 'bar'}, 'http://x/bar'],
+])
+def test_osclient_location(empty_OSClient, auth, location):
+    empty_OSClient.auth = auth
+    assert empty_OSClient.location() == location
+
+
 def test_osclient_older_images(osclient, mock_os):
     mock_os.glance.images.list.return_value = [mock.MagicMock(id=42), mock.MagicMock(id=43)]
     assert mock_os.older_images(sentinel.name, 42) == set([43, ])
@@ -464,16 +531,148 @@ def test_osclient_delete_instance(mock_os):
     assert mock_os.nova.servers.delete.called
 
 
+def test_osclient_rebuild_instance(mock_os):
+    assert mock_os.rebuild_instance(sentinel.uuid, sentinel.image) == \
+        mock_os.nova.servers.rebuild.return_value
+    assert mock_os.nova.servers.rebuild.call_args == mock.call(
+        sentinel.uuid, sentinel.image
+    )
+
+
 def test_osclient_delete_keypair(mock_os):
     mock_os.delete_keypair(sentinel.uuid)
     assert mock_os.nova.keypairs.delete.called
 
 
+def test_osclient_find_images_by_hash(mock_os):
+    mock_os.glance.images.list.return_value = iter([sentinel.img])
+    assert mock_os.find_images_by_hash('sha') == [sentinel.img]
+    assert mock_os.glance.images.list.call_args == mock.call(filters={
+        'dibctl_sha256': 'sha',
+        'status': 'active'
+    })
+
+
+def test_osclient_add_remove_image_ref(osclient, mock_os):
+    with mock.patch.object(osclient.time, 'time', return_value=42):
+        mock_os.add_image_ref(sentinel.id, 'user')
+    assert mock_os.glance.images.update.call_args == mock.call(sentinel.id, dibctl_ref_user='42')
+    mock_os.remove_image_ref(sentinel.id, 'user')
+    assert mock_os.glance.images.update.call_args == mock.call(
+        sentinel.id, remove_props=['dibctl_ref_user']
+    )
+
+
+def test_osclient_image_refs(osclient, mock_os):
+    img = {
+        'name': 'foo',
+        'dibctl_ref_fresh': '1000',
+        'dibctl_ref_expired': '1',
+        'dibctl_ref_bad': 'bad'
+    }
+    with mock.patch.object(osclient.time, 'time', return_value=1000 + mock_os.IMAGE_REF_TTL):
+        assert sorted(mock_os.image_refs(img)) == ['bad', 'fresh']
+
+
+@pytest.mark.parametrize('created_at, age', [
+    ['1970-01-01T00:16:40Z', 42],
+    ['garbage', None],
+    [None, None],
+])
+def test_osclient_image_age(osclient, created_at, age):
+    img = mock.MagicMock(created_at=created_at)
+    with mock.patch.object(osclient.time, 'time', return_value=1042):
+        assert osclient.OSClient.image_age(img) == age
+
+
+def test_osclient_all_used_images_pages(mock_os):
+    def server(image):
+        return mock.MagicMock(image=image)
+    page1 = [server({'id': 'img1'}), server('')]
+    page2 = [server({'id': 'img2'})]
+    mock_os.nova.servers.list.side_effect = [page1, page2, []]
+    assert list(mock_os._all_used_images(page_size=2)) == ['img1', 'img2']
+    calls = mock_os.nova.servers.list.call_args_list
+    assert calls[0] == mock.call(search_opts={'all_tenants': 1}, marker=None, limit=2)
+    assert calls[1][1]['marker'] == page1[-1].id
+    assert calls[2][1]['marker'] == page2[-1].id
+
+
+@pytest.mark.parametrize('namefilter, filters', [
+    [None, {'obsolete': 'true'}],
+    ['foo', {'obsolete': 'true', 'name': 'Obsolete foo'}]
+])
+def test_osclient_find_obsolete_unused_candidates(mock_os, namefilter, filters):
+    mock_os.glance.images.list.return_value = [
+        mock.MagicMock(id='used'), mock.MagicMock(id='unused')
+    ]
+    mock_os.nova.servers.list.side_effect = [[mock.MagicMock(image={'id': 'used'})], []]
+    assert mock_os.find_obsolete_unused_candidates(namefilter, page_size=10) == set(['unused'])
+    assert mock_os.glance.images.list.call_args == mock.call(filters=filters, page_size=10)
+
+
+def test_osclient_find_obsolete_unused_candidates_by_name(mock_os):
+    def image(id, name):
+        img = mock.MagicMock(id=id)
+        img.name = name
+        return img
+    mock_os.glance.images.list.return_value = [
+        image('foo1', 'Obsolete foo'),
+        image('foo2', 'Obsolete foo'),
+        image('bar1', 'Obsolete bar'),
+        image('odd', 'renamed by hand'),
+    ]
+    mock_os.nova.servers.list.side_effect = [[mock.MagicMock(image={'id': 'foo2'})], []]
+    assert mock_os.find_obsolete_unused_candidates_by_name(['foo', 'bar', 'baz']) == {
+        'foo': set(['foo1']),
+        'bar': set(['bar1']),
+        'baz': set()
+    }
+    assert mock_os.glance.images.list.call_count == 1
+    assert mock_os.nova.servers.list.call_count == 2
+
+
+def test_osclient_find_obsolete_unused_candidates_error(mock_os):
+    mock_os.nova.servers.list.side_effect = ValueError('forbidden')
+    with pytest.raises(ValueError):
+        mock_os.find_obsolete_unused_candidates()
+
+
+def test_osclient_delete_images(osclient, mock_os):
+    class PermanentError(Exception):
+        code = 409
+
+    class TransientError(Exception):
+        code = 503
+    attempts = {}
+
+    def delete(image_id):
+        attempts[image_id] = attempts.get(image_id, 0) + 1
+        if image_id == 'protected':
+            raise PermanentError
+        if image_id == 'flaky' and attempts[image_id] < 2:
+            raise TransientError
+    mock_os.glance.images.delete.side_effect = delete
+    with mock.patch.object(osclient.parallel.time, 'sleep'):
+        results = mock_os.delete_images(['ok', 'protected', 'flaky'], workers=3)
+    assert [r.error is None for r in results] == [True, False, True]
+    assert attempts == {'ok': 1, 'protected': 1, 'flaky': 2}
+
+
 def test_osclient_delete_image(mock_os):
     mock_os.delete_image(sentinel.uuid)
     assert mock_os.glance.images.delete.called
 
 
+def test_osclient_set_connection_pool(mock_os):
+    mock_os.session = mock.MagicMock()
+    mock_os.set_connection_pool(7)
+    assert mock_os.session.session.mount.call_count == 2
+    adapter = mock_os.session.session.mount.call_args[0][1]
+    assert adapter._pool_maxsize == 7
+    assert adapter._pool_block is True
+
+
 def test_osclient_get_instance(mock_os):
     assert mock_os.get_instance(sentinel.uuid)
     assert mock_os.nova.servers.get.called
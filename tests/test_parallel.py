@@ -0,0 +1,92 @@
+#!/usr/bin/python
+import os
+import inspect
+import sys
+import pytest
+import mock
+
+
+@pytest.fixture
+def parallel():
+    from dibctl import parallel
+    return parallel
+
+
+@pytest.mark.parametrize('workers', [1, 2, 10])
+def test_run_parallel_order(parallel, workers):
+    results = parallel.run_parallel(lambda x: x * 2, range(5), workers)
+    assert [r.item for r in results] == list(range(5))
+    assert [r.value for r in results] == [0, 2, 4, 6, 8]
+    assert all(r.error is None for r in results)
+
+
+def test_run_parallel_errors(parallel):
+    def func(x):
+        if x == 1:
+            raise ValueError(x)
+        return x
+    results = parallel.run_parallel(func, [0, 1, 2], 3)
+    assert isinstance(results[1].error, ValueError)
+    assert results[0].value == 0
+    assert results[2].value == 2
+
+
+def test_run_parallel_empty(parallel):
+    assert parallel.run_parallel(lambda x: x, []) == []
+
+
+@pytest.mark.parametrize('items, size, result', [
+    [[1, 2, 3], 2, [[1, 2], [3]]],
+    [[1, 2, 3], 5, [[1, 2, 3]]],
+    [[], 5, []],
+    [[1, 2], 0, [[1], [2]]],
+])
+def test_batches(parallel, items, size, result):
+    assert parallel.batches(items, size) == result
+
+
+def test_retry_success_after_errors(parallel):
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) < 3:
+            raise IOError
+        return 'ok'
+    with mock.patch.object(parallel.time, 'sleep') as sleep:
+        assert parallel.retry(func, attempts=3, delay=1, backoff=2) == 'ok'
+    assert len(calls) == 3
+    delays = [c[0][0] for c in sleep.call_args_list]
+    assert 1 <= delays[0] <= 1.25
+    assert 2 <= delays[1] <= 2.5
+
+
+def test_retry_exhausted(parallel):
+    func = mock.MagicMock(side_effect=IOError)
+    with mock.patch.object(parallel.time, 'sleep'):
+        with pytest.raises(IOError):
+            parallel.retry(func, attempts=2)
+    assert func.call_count == 2
+
+
+def test_retry_permanent_error(parallel):
+    func = mock.MagicMock(side_effect=ValueError)
+    with pytest.raises(ValueError):
+        parallel.retry(func, should_retry=lambda e: not isinstance(e, ValueError))
+    assert func.call_count == 1
+
+
+if __name__ == "__main__":
+    ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
+    currentdir = os.path.dirname(ourfilename)
+    parentdir = os.path.dirname(currentdir)
+    file_to_test = os.path.join(
+        parentdir,
+        os.path.basename(parentdir),
+        os.path.basename(ourfilename).replace("test_", '', 1)
+    )
+    pytest.main([
+     "-vv",
+     "--cov", file_to_test,
+     "--cov-report", "term-missing"
+     ] + sys.argv)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+import os
+import inspect
+import sys
+import socket
+import threading
+import pytest
+import mock
+
+
+@pytest.fixture
+def port_probe():
+    from dibctl import port_probe
+    return port_probe
+
+
+@pytest.fixture
+def listener():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    yield sock
+    sock.close()
+
+
+def closed_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def send_banner(listener, banner):
+    conn, _ = listener.accept()
+    conn.sendall(banner)
+    conn.close()
+
+
+def test_probe_open_port(port_probe, listener):
+    port = listener.getsockname()[1]
+    assert port_probe.probe(['127.0.0.1'], port, 1) == '127.0.0.1'
+
+
+def test_probe_refused_port(port_probe):
+    assert port_probe.probe(['127.0.0.1'], closed_port(), 1) is None
+
+
+def test_probe_no_addresses(port_probe):
+    assert port_probe.probe([], 22, 1) is None
+
+
+def test_probe_first_accepting_address(port_probe, listener):
+    port = listener.getsockname()[1]
+    assert port_probe.probe(
+        ['127.0.0.2', '127.0.0.1'], port, 1
+    ) == '127.0.0.1'
+
+
+def test_probe_closes_sockets(port_probe, listener):
+    port = listener.getsockname()[1]
+    sockets = []
+    real_socket = socket.socket
+
+    def track(*args):
+        sock = real_socket(*args)
+        sockets.append(sock)
+        return sock
+
+    with mock.patch.object(port_probe.socket, 'socket', track):
+        port_probe.probe(['127.0.0.1', '127.0.0.1'], port, 1)
+    assert len(sockets) == 2
+    for sock in sockets:
+        with pytest.raises(socket.error):
+            sock.getpeername()
+
+
+def test_probe_banner(port_probe, listener):
+    port = listener.getsockname()[1]
+    t = threading.Thread(target=send_banner, args=(listener, b'SSH-2.0-x\r\n'))
+    t.start()
+    assert port_probe.probe(['127.0.0.1'], port, 2, b'SSH-') == '127.0.0.1'
+    t.join()
+
+
+def test_probe_wrong_banner(port_probe, listener):
+    port = listener.getsockname()[1]
+    t = threading.Thread(target=send_banner, args=(listener, b'HTTP/1.1'))
+    t.start()
+    assert port_probe.probe(['127.0.0.1'], port, 2, b'SSH-') is None
+    t.join()
+
+
+def test_probe_banner_timeout(port_probe, listener):
+    port = listener.getsockname()[1]
+    assert port_probe.probe(['127.0.0.1'], port, 0.2, b'SSH-') is None
+
+
+def test_family(port_probe):
+    assert port_probe._family('fc00::1') == socket.AF_INET6
+    assert port_probe._family('192.168.0.1') == socket.AF_INET
+
+
+if __name__ == "__main__":
+    ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
+    currentdir = os.path.dirname(ourfilename)
+    parentdir = os.path.dirname(currentdir)
+    file_to_test = os.path.join(
+        parentdir,
+        os.path.basename(parentdir),
+        os.path.basename(ourfilename).replace("test_", '', 1)
+    )
+    pytest.main([
+     "-vv",
+     "--cov", file_to_test,
+     "--cov-report", "term-missing"
+     ] + sys.argv)
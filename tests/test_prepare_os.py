@@ -6,6 +6,8 @@ import pytest
 import mock
 from mock import sentinel
 import tempfile
+import threading
+import time
 
 
 @pytest.fixture
@@ -25,7 +27,10 @@ def prep_os(prepare_os):
     with mock.patch.object(prepare_os.PrepOS, "__init__", lambda x: None):
         prep_os = prepare_os.PrepOS()
     prep_os.os = mock.MagicMock(spec=prepare_os.osclient.OSClient)
+    prep_os.timings = prepare_os.waiter.Timings()
     prep_os.delete_image = True
+    prep_os.reuse_image = False
+    prep_os.reuse_instance = False
     prep_os.delete_instance = True
     prep_os.delete_keypair = True
     prep_os.upload_timeout = 1
@@ -37,7 +42,11 @@ def prep_os(prepare_os):
     prep_os.os_image.id = sentinel.image_id
     prep_os.os_instance = sentinel.instance
     prep_os.os_key = sentinel.key
+    prep_os.flavor = None
+    prep_os.override_instance = None
+    prep_os.private_key_file = None
     prep_os.ssh = None
+    prep_os.metadata = prepare_os.InstanceMetadata(prep_os)
     return prep_os
 
 
@@ -190,6 +199,82 @@ def test_upload_image_normal(prep_os):
     )
 
 
+@pytest.fixture
+def reuse_prep_os(prepare_os, prep_os):
+    prep_os.override_image = None
+    prep_os.reuse_image = True
+    prep_os.image_name = 'DIBCTL-test'
+    prep_os.image = {
+        'filename': sentinel.filename,
+        'glance': {
+            'name': 'image name',
+            'properties': {'key': 'value'}
+        }
+    }
+    prep_os.combined_glance_section = prep_os.image['glance']
+    with mock.patch.object(prepare_os.image_upload, 'HashCache') as hash_cache:
+        hash_cache.return_value.sha256.return_value = 'sha'
+        with mock.patch.object(
+            prepare_os.osclient.OSClient, 'image_ref_property',
+            return_value={'dibctl_ref_DIBCTL-test': '42'}
+        ):
+            yield prep_os
+
+
+def test_upload_image_reuse_identical(reuse_prep_os):
+    img = mock.MagicMock(disk_format='qcow2', container_format='bare', key='value')
+    reuse_prep_os.os.find_images_by_hash.return_value = [img]
+    reuse_prep_os.upload_image(1)
+    assert reuse_prep_os.os_image == img
+    assert reuse_prep_os.os.find_images_by_hash.call_args == mock.call('sha')
+    assert not reuse_prep_os.os.upload_image.called
+    assert reuse_prep_os.os.add_image_ref.call_args == mock.call(img.id, 'DIBCTL-test')
+
+
+@pytest.mark.parametrize('attrs', [
+    {'disk_format': 'raw', 'container_format': 'bare', 'key': 'value'},
+    {'disk_format': 'qcow2', 'container_format': 'ovf', 'key': 'value'},
+    {'disk_format': 'qcow2', 'container_format': 'bare', 'key': 'other'},
+])
+def test_upload_image_reuse_no_identical(reuse_prep_os, attrs):
+    reuse_prep_os.os.find_images_by_hash.return_value = [mock.MagicMock(**attrs)]
+    reuse_prep_os.upload_image(1)
+    assert reuse_prep_os.os_image == reuse_prep_os.os.upload_image.return_value
+    assert reuse_prep_os.os.upload_image.call_args[1]['meta'] == {
+        'key': 'value',
+        'dibctl_test_image': 'image name',
+        'dibctl_ref_DIBCTL-test': '42'
+    }
+    assert not reuse_prep_os.os.add_image_ref.called
+
+
+def test_upload_image_reuse_ref_failed(reuse_prep_os, capsys):
+    reuse_prep_os.os.find_images_by_hash.return_value = [
+        mock.MagicMock(disk_format='qcow2', container_format='bare', key='value')
+    ]
+    reuse_prep_os.os.add_image_ref.side_effect = ValueError('forbidden')
+    reuse_prep_os.upload_image(1)
+    assert 'forbidden' in capsys.readouterr()[0]
+
+
+def test_cleanup_image_reuse(reuse_prep_os):
+    current = reuse_prep_os.os_image
+    current.status = 'active'
+    used = mock.MagicMock(id='used', status='active')
+    unused = mock.MagicMock(id='unused', status='active')
+    young = mock.MagicMock(id='young', status='active')
+    saving = mock.MagicMock(id='saving', status='saving')
+    reuse_prep_os.os.find_images_by_property.return_value = [current, used, unused, young, saving]
+    reuse_prep_os.os.image_refs.side_effect = lambda img: ['other'] if img == used else []
+    reuse_prep_os.os.image_age.side_effect = lambda img: 60 if img == young else 7200
+    reuse_prep_os.cleanup_image()
+    assert reuse_prep_os.os.remove_image_ref.call_args == mock.call(current.id, 'DIBCTL-test')
+    assert reuse_prep_os.os.find_images_by_property.call_args == mock.call(
+        'dibctl_test_image', 'image name'
+    )
+    assert reuse_prep_os.os.delete_image.call_args_list == [mock.call('unused')]
+
+
 def test_spawn_instance(prepare_os, mock_image_cfg, mock_env_cfg):
     prep_os = prepare_os.PrepOS(mock_image_cfg, mock_env_cfg)
     with mock.patch.object(prepare_os.osclient, 'OSClient'):
@@ -329,6 +414,18 @@ def test_wait_for_instance_long_error(prepare_os, prep_os):
             prep_os.wait_for_instance(10)
 
 
+def test_wait_for_instance_timings(prepare_os, prep_os, capsys):
+    prep_os.os_instance = mock.MagicMock(status='BUILD')
+    prep_os.os.get_instance.side_effect = [
+        mock.MagicMock(status='BUILD'),
+        mock.MagicMock(status='ACTIVE')
+    ]
+    with mock.patch.object(prepare_os.time, "sleep"):
+        prep_os.wait_for_instance(10)
+    assert '2 status checks' in capsys.readouterr()[0]
+    assert prep_os.timings.phases[0][0] == 'instance become active'
+
+
 def test_wait_for_instance_timeout(prepare_os, prep_os):
     prep_os.os_instance = mock.MagicMock(status='BUILDING')
     with pytest.raises(prepare_os.timeout.TimeoutError):
@@ -344,9 +441,149 @@ def test_prepare(prepare_os, prep_os):
     prep_os.get_instance_main_ip = mock.create_autospec(prep_os.get_instance_main_ip)
     prep_os.image = mock.MagicMock()
     prep_os.prepare_ssh = mock.create_autospec(prep_os.prepare_ssh)
+    prep_os.resolve_flavor = mock.create_autospec(prep_os.resolve_flavor)
     prep_os.prepare()
     assert prep_os.init_keypair.called
-    assert prep_os.init_keypair.called
+    assert prep_os.resolve_flavor.called
+    assert prep_os.spawn_instance.called
+    names = [name for name, duration in prep_os.timings.phases]
+    assert names[-2:] == ['instance boot', 'instance metadata']
+    assert set(names) == set([
+        'keypair', 'flavor lookup', 'image upload', 'instance boot',
+        'instance metadata'
+    ])
+
+
+def test_prepare_overlaps_keypair_and_upload(prepare_os, prep_os):
+    import threading
+    keypair_started = threading.Event()
+
+    def init_keypair():
+        keypair_started.set()
+
+    def upload_image(timeout):
+        assert keypair_started.wait(2)
+
+    prep_os.init_keypair = init_keypair
+    prep_os.upload_image = upload_image
+    prep_os.resolve_flavor = mock.Mock()
+    prep_os.spawn_instance = mock.Mock()
+    prep_os.wait_for_instance = mock.Mock()
+    prep_os.get_instance_main_ip = mock.Mock()
+    prep_os.prepare_ssh = mock.Mock()
+    prep_os.prepare()
+    assert set(name for name, d in prep_os.timings.phases) == set([
+        'keypair', 'flavor lookup', 'image upload', 'instance boot',
+        'instance metadata'
+    ])
+
+
+def test_prepare_upload_failure_waits_for_keypair(prepare_os, prep_os):
+    import threading
+    upload_failed = threading.Event()
+
+    def init_keypair():
+        upload_failed.wait(2)
+        prep_os.os_key = sentinel.new_key
+
+    def upload_image(timeout):
+        upload_failed.set()
+        raise IOError('upload')
+
+    prep_os.init_keypair = init_keypair
+    prep_os.upload_image = upload_image
+    prep_os.resolve_flavor = mock.Mock()
+    prep_os.spawn_instance = mock.Mock()
+    with pytest.raises(IOError):
+        prep_os.prepare()
+    assert prep_os.os_key is sentinel.new_key
+    assert not prep_os.spawn_instance.called
+
+
+def test_prepare_keypair_timeout(prepare_os, prep_os):
+    release = threading.Event()
+    prep_os.key_name = sentinel.key_name
+    prep_os.keypair_timeout = 0.3
+    prep_os.os.new_keypair.side_effect = lambda name: release.wait(10)
+    prep_os.upload_image = mock.Mock()
+    prep_os.resolve_flavor = mock.Mock()
+    prep_os.spawn_instance = mock.Mock()
+    start = time.time()
+    try:
+        with pytest.raises(prepare_os.timeout.TimeoutError) as e:
+            prep_os.prepare()
+        assert time.time() - start < 2
+        assert str(e.value) == 'Timed out after 0.3'
+        assert not prep_os.spawn_instance.called
+    finally:
+        release.set()
+
+
+def test_prepare_background_failure(prepare_os, prep_os):
+    prep_os.init_keypair = mock.Mock()
+    prep_os.upload_image = mock.Mock()
+    prep_os.resolve_flavor = mock.Mock(side_effect=prepare_os.FlavorError)
+    prep_os.spawn_instance = mock.Mock()
+    with pytest.raises(prepare_os.FlavorError):
+        prep_os.prepare()
+    assert prep_os.upload_image.called
+    assert not prep_os.spawn_instance.called
+
+
+def test_init_override_instance(prepare_os, mock_image_cfg, mock_env_cfg):
+    prep_os = prepare_os.PrepOS(
+        mock_image_cfg,
+        mock_env_cfg,
+        override_instance=sentinel.instance,
+        private_key_file=sentinel.key_file
+    )
+    assert prep_os.override_instance == sentinel.instance
+    assert prep_os.private_key_file == sentinel.key_file
+    assert prep_os.delete_instance is False
+    assert prep_os.delete_keypair is False
+    assert prep_os.delete_image is False
+
+
+def test_prepare_existing_instance(prepare_os, prep_os, tmpdir, config):
+    key_file = tmpdir.join('key')
+    key_file.write('PRIVATE')
+    prep_os.override_instance = sentinel.instance_id
+    prep_os.private_key_file = str(key_file)
+    prep_os.os_image = None
+    prep_os.image = config.Config({'tests': {'ssh': {'username': 'user'}}})
+    instance = prep_os.os.get_instance.return_value
+    instance.image = {'id': sentinel.image_id}
+    instance.flavor = {'id': sentinel.flavor_id}
+    instance.key_name = 'key_name'
+    prep_os.wait_for_instance = mock.Mock()
+    prep_os.os.get_instance_ip.return_value = '192.168.0.1'
+    prep_os.main_nic_regexp = None
+    prep_os.active_timeout = sentinel.timeout
+    prep_os.prepare()
+    assert prep_os.os.get_instance.call_args == mock.call(sentinel.instance_id)
+    assert prep_os.os.get_image.call_args == mock.call(sentinel.image_id)
+    assert prep_os.os.get_flavor.call_args == mock.call(sentinel.flavor_id)
+    assert prep_os.os_key.name == 'key_name'
+    assert prep_os.os_key.private_key == 'PRIVATE'
+    assert prep_os.wait_for_instance.call_args == mock.call(sentinel.timeout)
+    assert prep_os.ssh.key_file() == str(key_file)
+    assert not prep_os.os.new_keypair.called
+    assert not prep_os.os.boot_instance.called
+
+
+def test_connect_function(prepare_os, mock_env_cfg):
+    with mock.patch.object(prepare_os.osclient, 'OSClient') as mock_os:
+        assert prepare_os.connect(mock_env_cfg, sentinel.glance) == mock_os.return_value
+    assert mock_os.call_args[1]['glance_data'] == sentinel.glance
+    assert mock_os.call_args[1]['use_auth_cache'] is False
+
+
+def test_resolve_flavor_once(prep_os):
+    prep_os.test_environment = sentinel.env
+    prep_os.guess_flavor = mock.Mock(return_value=sentinel.flavor)
+    assert prep_os.resolve_flavor() == sentinel.flavor
+    assert prep_os.resolve_flavor() == sentinel.flavor
+    assert prep_os.guess_flavor.call_count == 1
 
 
 def test_cleanup(prepare_os, prep_os):
@@ -359,6 +596,183 @@ def test_cleanup(prepare_os, prep_os):
     assert prep_os.os.delete_keypair.called
 
 
+def test_cleanup_stops_ssh_master(prep_os):
+    ssh = mock.Mock()
+    prep_os.ssh = ssh
+    prep_os.cleanup()
+    assert ssh.stop_master.called
+
+
+@pytest.mark.parametrize('ssh_settings, multiplexing', [
+    [{'username': 'user'}, True],
+    [{'username': 'user', 'multiplexing': False}, False]
+])
+def test_prepare_ssh_multiplexing(prepare_os, config, mock_env_cfg, ssh_settings, multiplexing):
+    p = prepare_os.PrepOS(
+        config.Config({'glance': {'name': 'foo'}, 'tests': {'ssh': ssh_settings}}),
+        mock_env_cfg
+    )
+    p.ip = '192.168.0.1'
+    p.os_key = mock.MagicMock()
+    p.prepare_ssh()
+    assert p.ssh.multiplexing is multiplexing
+
+
+@pytest.fixture
+def reuse_os(prepare_os, prep_os, config, dibctl_cache_dir):
+    prep_os.reuse_instance = True
+    prep_os.tests_passed = True
+    prep_os.image_name = 'DIBCTL-test'
+    prep_os.os_image.id = 'old_image'
+    prep_os.image = config.Config({'glance': {'name': 'foo'}})
+    prep_os.test_environment = config.Config({
+        'keystone': {'auth_url': 'http://keystone'},
+        'nova': {'flavor': 'small'}
+    })
+    prep_os.os_instance = mock.Mock(id='instance_id')
+    prep_os.os_key = prepare_os.ExistingKeypair(
+        'key_name', 'key_name', 'PRIVATE'
+    )
+    return prep_os
+
+
+def test_reusable_instance_store_and_take(reuse_os):
+    assert reuse_os.take_reusable_instance() is None
+    assert reuse_os.store_reusable_instance() is True
+    assert reuse_os.store_reusable_instance() is False
+    record = reuse_os.take_reusable_instance()
+    assert record['instance_id'] == 'instance_id'
+    assert record['keypair'] == 'key_name'
+    assert record['private_key'] == 'PRIVATE'
+    assert reuse_os.take_reusable_instance() is None
+
+
+def test_reusable_instance_per_environment(reuse_os, config):
+    reuse_os.store_reusable_instance()
+    reuse_os.test_environment = config.Config({
+        'keystone': {'auth_url': 'http://keystone'},
+        'nova': {'flavor': 'large'}
+    })
+    assert reuse_os.take_reusable_instance() is None
+
+
+def test_cleanup_keeps_instance_for_reuse(reuse_os):
+    reuse_os.os.get_instance.return_value.status = 'ACTIVE'
+    reuse_os.cleanup()
+    assert not reuse_os.os.delete_instance.called
+    assert not reuse_os.os.delete_keypair.called
+    assert not reuse_os.os.delete_image.called
+    record = reuse_os.take_reusable_instance()
+    assert record['instance_id'] == 'instance_id'
+    assert record['image_id'] == 'old_image'
+    assert record['delete_image'] is True
+
+
+@pytest.mark.parametrize('status, delete_instance, tests_passed', [
+    ('ERROR', True, True),
+    ('ACTIVE', False, True),
+    ('ACTIVE', True, False),
+])
+def test_cleanup_does_not_keep_for_reuse(reuse_os, status, delete_instance, tests_passed):
+    reuse_os.os.get_instance.return_value.status = status
+    reuse_os.delete_instance = delete_instance
+    reuse_os.tests_passed = tests_passed
+    reuse_os.cleanup()
+    assert reuse_os.os.delete_instance.called is delete_instance
+    assert reuse_os.os.delete_image.called
+    assert reuse_os.take_reusable_instance() is None
+
+
+def test_reuse_instance_disabled_by_userdata(prepare_os, config, mock_env_cfg_with_userdata):
+    image = config.Config({
+        'glance': {'name': 'foo'},
+        'filename': sentinel.filename,
+        'tests': {'ssh': {'username': 'user'}, 'reuse_instance': True}
+    })
+    prep_os = prepare_os.PrepOS(image, mock_env_cfg_with_userdata)
+    assert prep_os.reuse_instance is False
+
+
+def test_prepare_rebuilds_reusable_instance(reuse_os):
+    reuse_os.store_reusable_instance()
+    reuse_os.os_instance = None
+    reuse_os.os_key = None
+    reuse_os.os_image = mock.Mock(id='new_image')
+    reuse_os.upload_image = mock.Mock()
+    reuse_os.wait_for_instance = mock.Mock()
+    reuse_os.create_instance = mock.Mock()
+    reuse_os.get_instance_main_ip = mock.Mock()
+    reuse_os.prepare_ssh = mock.Mock()
+    reuse_os.prepare()
+    assert reuse_os.os.rebuild_instance.call_args == mock.call(
+        'instance_id', reuse_os.os_image
+    )
+    assert reuse_os.os_instance == reuse_os.os.rebuild_instance.return_value
+    assert reuse_os.os_key.private_key == 'PRIVATE'
+    assert not reuse_os.create_instance.called
+    assert 'instance rebuild' in [n for n, d in reuse_os.timings.phases]
+    assert reuse_os.os.delete_image.call_args == mock.call('old_image')
+
+
+def test_prepare_rebuilt_instance_env_config(reuse_os):
+    reuse_os.store_reusable_instance()
+    reuse_os.os_instance = None
+    reuse_os.os_key = None
+    reuse_os.flavor = None
+    reuse_os.os_image = mock.Mock(id='new_image')
+    reuse_os.upload_image = mock.Mock()
+    reuse_os.wait_for_instance = mock.Mock()
+    reuse_os.create_instance = mock.Mock()
+    reuse_os.get_instance_main_ip = mock.Mock()
+    reuse_os.prepare_ssh = mock.Mock()
+    instance = reuse_os.os.rebuild_instance.return_value
+    instance.flavor = {'id': 'flavor_id'}
+    instance.name = 'DIBCTL-kept'
+    instance.networks = {}
+    reuse_os.ip = '192.0.2.1'
+    reuse_os.os.get_flavor.return_value = mock.Mock(id='flavor_id', ram=512)
+    reuse_os.os.get_flavor.return_value.get_keys.return_value = {}
+    reuse_os.prepare()
+    assert reuse_os.os.get_flavor.call_args == mock.call('flavor_id')
+    env = reuse_os.get_env_config()
+    assert env['flavor_id'] == 'flavor_id'
+    assert env['flavor_ram'] == '512'
+    assert env['instance_name'] == 'dibctl-kept'
+
+
+def test_release_previous_shared_image(reuse_os):
+    reuse_os.reuse_image = True
+    reuse_os.store_reusable_instance()
+    record = reuse_os.take_reusable_instance()
+    reuse_os.release_previous_image(record)
+    assert reuse_os.os.remove_image_ref.call_args == mock.call('old_image', 'DIBCTL-test')
+    assert not reuse_os.os.delete_image.called
+
+
+def test_prepare_rebuild_failure_creates_instance(reuse_os):
+    reuse_os.store_reusable_instance()
+    reuse_os.upload_image = mock.Mock()
+    reuse_os.os.rebuild_instance.side_effect = ValueError('no rebuild')
+    reuse_os.create_instance = mock.Mock()
+    reuse_os.get_instance_main_ip = mock.Mock()
+    reuse_os.prepare_ssh = mock.Mock()
+    reuse_os.prepare()
+    assert reuse_os.os.delete_instance.call_args == mock.call('instance_id')
+    assert reuse_os.os.delete_keypair.call_args == mock.call('key_name')
+    assert not reuse_os.os.delete_image.called  # current image of this test
+    assert reuse_os.create_instance.call_args == mock.call(upload=False)
+    assert reuse_os.upload_image.called
+
+
+def test_prepare_no_reusable_instance_creates(reuse_os):
+    reuse_os.create_instance = mock.Mock()
+    reuse_os.get_instance_main_ip = mock.Mock()
+    reuse_os.prepare_ssh = mock.Mock()
+    reuse_os.prepare()
+    assert reuse_os.create_instance.call_args == mock.call(upload=True)
+    assert not reuse_os.os.rebuild_instance.called
+
+
 def test_inner__cleanup_normal(prepare_os):
     mock_delete = mock.MagicMock()
     prepare_os.PrepOS._cleanup("name", sentinel.object, True, mock_delete)
@@ -391,10 +805,11 @@ def test_cleanup_ssh_key_delete(prep_os):
     assert prep_os._cleanup.called
 
 
-def test_is_port_available_instant(prepare_os, prep_os, MockSocket):
+def test_is_port_available_instant(prepare_os, prep_os, MockPortProbe):
     with mock.patch.object(prepare_os.time, "time", mock.MagicMock(return_value=0)):
-        with mock.patch.object(prepare_os, "socket", MockSocket([0])):
+        with mock.patch.object(prepare_os, "port_probe", MockPortProbe([0])):
             prep_os.ip = sentinel.ip
+            prep_os.ips = mock.Mock(return_value=[sentinel.ip])
             assert prep_os.wait_for_port(sentinel.port, 60) is True
 
 
@@ -463,6 +878,54 @@ def test_get_env_config(prepare_os, prep_os):
     assert env['flavor_meta_sentinel.name2'] == 'sentinel.value2'
 
 
+@pytest.fixture
+def meta_os(prep_os):
+    prep_os.os_instance = mock.Mock(id='instance_id', networks={})
+    prep_os.os_instance.image = {'id': 'image_id'}
+    prep_os.os_instance.interface_list.return_value = [mock.Mock(_info={})]
+    prep_os.flavor = mock.Mock()
+    prep_os.flavor.get_keys.return_value = {'key': 'value'}
+    prep_os.os.get_image.return_value = sentinel.image_info
+    prep_os.instance_name = 'name'
+    prep_os.ip = '192.168.0.1'
+    return prep_os
+
+
+def test_metadata_fetched_once(meta_os):
+    meta_os.metadata.fetch()
+    for attempt in range(3):
+        assert meta_os.get_env_config()['flavor_meta_key'] == 'value'
+        assert meta_os.network() == meta_os.os_instance.interface_list.return_value
+        assert meta_os.flavor_keys() == {'key': 'value'}
+        assert meta_os.get_image_info() == sentinel.image_info
+    assert meta_os.os_instance.interface_list.call_count == 1
+    assert meta_os.flavor.get_keys.call_count == 1
+    assert meta_os.os.get_image.call_count == 1
+
+
+def test_metadata_env_config_is_a_copy(meta_os):
+    meta_os.get_env_config()['foo'] = 'bar'
+    assert 'foo' not in meta_os.get_env_config()
+
+
+def test_metadata_fetch_failure_is_retried_on_use(meta_os, capsys):
+    meta_os.flavor.get_keys.side_effect = [ValueError('boom'), {'key': 'value'}]
+    meta_os.metadata.fetch()
+    assert 'Unable to get instance flavor_keys: boom' in capsys.readouterr()[0]
+    assert meta_os.flavor_keys() == {'key': 'value'}
+
+
+def test_refresh_metadata(meta_os):
+    meta_os.metadata.fetch()
+    new_instance = mock.Mock(id='instance_id')
+    new_instance.interface_list.return_value = [sentinel.iface]
+    meta_os.os.get_instance.return_value = new_instance
+    meta_os.refresh_metadata()
+    assert meta_os.os_instance is new_instance
+    assert meta_os.network() == [sentinel.iface]
+    assert meta_os.flavor.get_keys.call_count == 2
+
+
 def test_ips(prep_os):
     prep_os.os_instance.networks = {
         'net1': [sentinel.ip1],
@@ -492,27 +955,30 @@ def test_ips_by_version_invalid_version(prep_os):
         assert prep_os.ips_by_version(version='invalid') == []
 
 
-def test_wait_for_port_never(prepare_os, prep_os, MockSocket):
+def test_wait_for_port_never(prepare_os, prep_os, MockPortProbe):
     with mock.patch.object(prepare_os.time, "time", mock.MagicMock(side_effect=[0, 10, 60, 80])):
-        with mock.patch.object(prepare_os, "socket", MockSocket([None])):
+        with mock.patch.object(prepare_os, "port_probe", MockPortProbe([None])):
             with mock.patch.object(prepare_os.time, "sleep"):
                 prep_os.ip = sentinel.ip
+                prep_os.ips = mock.Mock(return_value=[sentinel.ip])
                 assert prep_os.wait_for_port(sentinel.port, 60) is False
 
 
-def test_wait_for_port_eventually_succeed(prepare_os, prep_os, MockSocket):
+def test_wait_for_port_eventually_succeed(prepare_os, prep_os, MockPortProbe):
     with mock.patch.object(prepare_os.time, "time", mock.MagicMock(side_effect=[0, 0, 10, 20, 80])):
-        with mock.patch.object(prepare_os, "socket", MockSocket([-1, -1, 0])):
+        with mock.patch.object(prepare_os, "port_probe", MockPortProbe([-1, -1, 0])):
             with mock.patch.object(prepare_os.time, "sleep"):
                 prep_os.ip = sentinel.ip
+                prep_os.ips = mock.Mock(return_value=[sentinel.ip])
                 assert prep_os.wait_for_port(sentinel.port, 60) is True
 
 
-def test_wait_for_port_eventually_fail(prepare_os, prep_os, MockSocket):
+def test_wait_for_port_eventually_fail(prepare_os, prep_os, MockPortProbe):
     with mock.patch.object(prepare_os.time, "time", mock.MagicMock(side_effect=[0, 0, 10, 20, 80])):
-        with mock.patch.object(prepare_os, "socket", MockSocket([-1, -1, -1, -1, 0])):
+        with mock.patch.object(prepare_os, "port_probe", MockPortProbe([-1, -1, -1, -1, 0])):
             with mock.patch.object(prepare_os.time, "sleep"):
                 prep_os.ip = sentinel.ip
+                prep_os.ips = mock.Mock(return_value=[sentinel.ip])
                 assert prep_os.wait_for_port(sentinel.port, 60) is False
 
 
@@ -2,6 +2,7 @@
 import mock
 import pytest
 import os
+import time
 import inspect
 import sys
 from mock import sentinel
@@ -30,8 +31,8 @@ def prepare_os():
 def dcp(pytest_runner, ssh):
     tos = mock.MagicMock()
     tos.ip = '192.168.0.1'
-    tos.os_instance.interface_list.return_value = [sentinel.iface1, sentinel.iface2]
-    tos.flavor.return_value.get_keys.return_value = {'name': 'value'}
+    tos.network.return_value = [sentinel.iface1, sentinel.iface2]
+    tos.flavor_keys.return_value = {'name': 'value'}
     tos.key_name = 'foo-key-name'
     tos.os_key_private_file = 'private-file'
     tos.ips.return_value = [sentinel.ip1, sentinel.ip2]
@@ -124,7 +125,7 @@ def test_DibCtlPlugin_network_fixture(dcp):
 
 def test_DibCtlPlugin_wait_for_port_fixture(dcp):
     dcp.wait_for_port(sentinel.request)()
-    assert dcp.tos.wait_for_port.call_args == mock.call(22, 60)
+    assert dcp.tos.wait_for_port.call_args == mock.call(22, 60, None)
 
 
 def test_DibCtlPlugin_ips_fixture(dcp):
@@ -147,6 +148,11 @@ def test_DibCtlPlugin_image_config_fixture(dcp):
     assert dcp.image_config(sentinel.request) == sentinel.image
 
 
+def test_DibCtlPlugin_refresh_metadata_fixture(dcp):
+    dcp.refresh_metadata(sentinel.request)()
+    assert dcp.tos.refresh_metadata.called
+
+
 def test_DibCtlPlugin_console_output_fixture(dcp):
     assert dcp.console_output(sentinel.request) == sentinel.console_out
 
@@ -164,6 +170,128 @@ def test_DibCtlPlugin_ssh_fixture(dcp, key, value):
     assert ssh[key] == value
 
 
+def test_DibCtlPlugin_ssh_backend_checks_master(dcp):
+    dcp.ssh_data = mock.MagicMock()
+    dcp.testinfra = mock.MagicMock()
+    assert dcp.ssh_backend(sentinel.request) == dcp.testinfra.get_backend.return_value
+    assert dcp.ssh_backend(sentinel.request) == dcp.testinfra.get_backend.return_value
+    assert dcp.testinfra.get_backend.call_count == 1
+    assert dcp.ssh_data.ensure_master.call_count == 2
+
+
+def write_suite(tmpdir, body):
+    suite = tmpdir.join('test_suite.py')
+    suite.write(body)
+    return str(suite)
+
+
+SUITE = '''
+import os
+
+
+def record(name):
+    with open(%r, 'a') as f:
+        f.write('%%s %%s\\n' %% (name, os.getpid()))
+
+''' + ''.join('''
+def test_%s(ssh):
+    record('%s')
+''' % (n, n) for n in range(6))
+
+
+@pytest.fixture
+def pdcp(dcp):
+    dcp.ssh_data = mock.MagicMock()
+    dcp.ssh_data.info.return_value = {}
+    return dcp
+
+
+def parallel_run(pytest_runner, pdcp, path, workers, continue_on_fail=True):
+    with mock.patch.object(pytest_runner, "DibCtlPlugin", return_value=pdcp):
+        return pytest_runner.runner(
+            path,
+            pdcp.ssh_data,
+            pdcp.tos,
+            {},
+            sentinel.timeout_val,
+            continue_on_fail,
+            workers=workers
+        )
+
+
+def test_parallel_runner_shards_tests(pytest_runner, pdcp, tmpdir):
+    log = str(tmpdir.join('log'))
+    path = write_suite(tmpdir, SUITE % log)
+    assert parallel_run(pytest_runner, pdcp, path, 3) is True
+    records = [line.split() for line in open(log)]
+    assert sorted(name for name, pid in records) == [str(n) for n in range(6)]
+    assert len(set(pid for name, pid in records)) == 3
+    assert os.getpid() not in [int(pid) for name, pid in records]
+    assert pdcp.ssh_data.ensure_master.called
+
+
+def test_parallel_runner_more_workers_than_tests(pytest_runner, pdcp, tmpdir):
+    path = write_suite(tmpdir, 'def test_one():\n    pass\n')
+    assert parallel_run(pytest_runner, pdcp, path, 3) is True
+
+
+def test_parallel_runner_no_tests(pytest_runner, pdcp, tmpdir):
+    path = write_suite(tmpdir, '')
+    assert parallel_run(pytest_runner, pdcp, path, 2) is False
+
+
+def test_parallel_runner_failure(pytest_runner, pdcp, tmpdir):
+    path = write_suite(tmpdir, 'def test_ok():\n    pass\n\n\ndef test_fail():\n    assert False\n')
+    assert parallel_run(pytest_runner, pdcp, path, 2) is False
+
+
+def test_parallel_runner_stops_workers_after_failure(pytest_runner, pdcp, tmpdir):
+    path = write_suite(
+        tmpdir,
+        'import time\n\n\ndef test_fail():\n    assert False\n\n\n'
+        'def test_slow():\n    time.sleep(60)\n'
+    )
+    start = time.time()
+    assert parallel_run(pytest_runner, pdcp, path, 2, continue_on_fail=False) is False
+    assert time.time() - start < 30
+
+
+@pytest.mark.parametrize('test_timeout, expected', [
+    [None, False],
+    [30, True],
+])
+def test_runner_test_timeout(pytest_runner, test_timeout, expected):
+    with mock.patch.object(pytest_runner, "DibCtlPlugin"):
+        with mock.patch.object(pytest_runner.pytest, "main", return_value=0) as mock_main:
+            pytest_runner.runner(
+                sentinel.path,
+                sentinel.ssh,
+                sentinel.tos,
+                sentinel.environment_variables,
+                sentinel.timeout_val,
+                True,
+                test_timeout=test_timeout
+            )
+    assert ('--timeout' in mock_main.call_args[0][0]) is expected
+
+
+def test_shard_plugin(pytest_runner):
+    items = list(range(5))
+    config = mock.MagicMock()
+    pytest_runner.ShardPlugin(1, 2).pytest_collection_modifyitems(None, config, items)
+    assert items == [1, 3]
+    assert config.hook.pytest_deselected.call_args == mock.call(items=[0, 2, 4])
+
+
+def test_DibCtlPlugin_forked(dcp):
+    dcp.cached_ssh_backend = sentinel.backend
+    old_client = dcp.sshclient
+    dcp.forked()
+    assert dcp.cached_ssh_backend is None
+    assert dcp.sshclient is not old_client
+    assert dcp.tos.os.set_connection_pool.call_args == mock.call(1)
+
+
 if __name__ == "__main__":
     ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
     currentdir = os.path.dirname(ourfilename)
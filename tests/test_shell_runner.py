@@ -2,6 +2,7 @@
 import mock
 import pytest
 import os
+import time
 import inspect
 import sys
 from mock import sentinel
@@ -40,17 +41,6 @@ def test_unwrap_config(shell_runner, input, output):
     assert shell_runner.unwrap_config("P", input) == output
 
 
-def test_run_shell_test_success(shell_runner):
-    with mock.patch.object(shell_runner.subprocess, "check_call", autospec=True) as mock_call:
-        assert shell_runner.run_shell_test(sentinel.path, sentinel.evn)
-
-
-def test_run_shell_test_fail(shell_runner):
-    with mock.patch.object(shell_runner.subprocess, "check_call") as mock_call:
-        mock_call.side_effect = shell_runner.subprocess.CalledProcessError(0, [], "")
-        assert shell_runner.run_shell_test(sentinel.path, sentinel.evn) is False
-
-
 def test_gather_tests_bad_file(shell_runner):
     assert shell_runner.gather_tests('/dev/null') is None
 
@@ -106,46 +96,181 @@ def test_runner_empty_tests(shell_runner, ssh):
     vars = {}
     s = ssh.SSH('192.168.1.1', 'user', 'secret')
     with mock.patch.object(shell_runner, "gather_tests", return_value=[]):
-        assert shell_runner.runner(sentinel.path, s, tos, vars, sentinel.timeout, continue_on_fail=False) is True
+        assert shell_runner.runner(sentinel.path, s, tos, vars, 10, continue_on_fail=False) is True
     del s
 
 
-def test_runner_all_ok(shell_runner, ssh):
-    tos = mock.MagicMock()
-    tos.ip = '192.168.1.1'
-    tos.os_key_private_file = '~/.ssh/config'
-    vars = {}
-    with mock.patch.object(shell_runner, "gather_tests", return_value=["test1", "test2"]):
-        with mock.patch.object(shell_runner, "run_shell_test", return_value=True):
-            s = ssh.SSH('192.168.1.1', 'user', 'secret')
-            assert shell_runner.runner(sentinel.path, s, tos, vars, sentinel.timeout, continue_on_fail=False) is True
-            del s
-
-
-def test_runner_all_no_continue(shell_runner, ssh):
+@pytest.mark.parametrize('results, expected', [
+    [[True, True], True],
+    [[True, False], False],
+])
+def test_runner_result(shell_runner, ssh, results, expected):
     tos = mock.MagicMock()
-    tos.ip = '192.168.1.1'
-    tos.os_key_private_file = '~/.ssh/config'
-    vars = {}
     s = ssh.SSH('192.168.1.1', 'user', 'secret')
     with mock.patch.object(shell_runner, "gather_tests", return_value=["test1", "test2"]):
-        with mock.patch.object(shell_runner, "run_shell_test", return_value=False) as mock_run:
-            assert shell_runner.runner(sentinel.path, s, tos, vars, sentinel.timeout, continue_on_fail=False) is False
-            assert mock_run.call_count == 1
+        with mock.patch.object(shell_runner, "run_tests") as mock_run:
+            mock_run.return_value = [mock.Mock(success=r) for r in results]
+            assert shell_runner.runner(
+                sentinel.path, s, tos, {}, sentinel.timeout, continue_on_fail=False,
+                workers=sentinel.workers, test_timeout=sentinel.test_timeout
+            ) is expected
+    assert mock_run.call_args[0][0] == ["test1", "test2"]
+    assert mock_run.call_args[0][1]['DIBCTL_SSH_IP'] == '192.168.1.1'
+    assert mock_run.call_args[0][2] == sentinel.workers
+    assert mock_run.call_args[1] == {
+        'timeout_val': sentinel.timeout,
+        'test_timeout': sentinel.test_timeout,
+        'continue_on_fail': False
+    }
     del s
 
 
-def test_runner_all_with_continue(shell_runner, ssh):
-    tos = mock.MagicMock()
-    tos.ip = '192.168.1.1'
-    tos.os_key_private_file = '~/.ssh/config'
-    vars = {}
-    s = ssh.SSH('192.168.1.1', 'user', 'secret')
-    with mock.patch.object(shell_runner, "gather_tests", return_value=["test1", "test2"]):
-        with mock.patch.object(shell_runner, "run_shell_test", return_value=False) as mock_run:
-            assert shell_runner.runner(sentinel.path, s, tos, vars, sentinel.timeout, continue_on_fail=True) is False
-            assert mock_run.call_count == 2
-    del s
+def script(directory, name, body):
+    path = directory.join(name)
+    path.write('#!/bin/bash\n' + body + '\n')
+    path.chmod(0o700)
+    return str(path)
+
+
+def test_chains(shell_runner, tmpdir):
+    serial = tmpdir.mkdir('serial')
+    serial.join(shell_runner.SERIAL_MARKER).write('')
+    tests = [
+        str(tmpdir.join('a')),
+        str(serial.join('b')),
+        str(serial.join('c')),
+        str(tmpdir.join('d'))
+    ]
+    assert shell_runner.chains(tests) == [[tests[0]], [tests[1], tests[2]], [tests[3]]]
+
+
+@pytest.mark.parametrize('continue_on_fail, started', [
+    [False, 2],
+    [True, 3],
+])
+def test_run_tests_sequential(shell_runner, tmpdir, continue_on_fail, started):
+    tests = [
+        script(tmpdir, '1', 'exit 0'),
+        script(tmpdir, '2', 'exit 3'),
+        script(tmpdir, '3', 'exit 0')
+    ]
+    results = shell_runner.run_tests(tests, {}, 1, continue_on_fail=continue_on_fail)
+    assert [t.success for t in results] == [True, False, continue_on_fail]
+    assert len([t for t in results if t.process]) == started
+    assert results[1].returncode == 3
+
+
+def test_run_tests_concurrently(shell_runner, tmpdir):
+    tests = [script(tmpdir, str(n), 'sleep 1') for n in range(4)]
+    start = time.time()
+    results = shell_runner.run_tests(tests, {}, 4)
+    assert time.time() - start < 3
+    assert all(t.success for t in results)
+
+
+def test_run_tests_output_in_order(shell_runner, tmpdir, capsys):
+    tests = [
+        script(tmpdir, '1', 'sleep 0.5; echo first'),
+        script(tmpdir, '2', 'echo second')
+    ]
+    shell_runner.run_tests(tests, {}, 2)
+    out = capsys.readouterr()[0]
+    assert out.index('first') < out.index('second')
+    assert out.index('Output of %s' % tests[1]) > out.index('first')
+
+
+def test_run_tests_env(shell_runner, tmpdir, capsys):
+    tests = [script(tmpdir, '1', 'test "$FOO" = bar')]
+    assert shell_runner.run_tests(tests, {'FOO': 'bar'}, 2)[0].success
+
+
+def test_run_tests_serial_directory(shell_runner, tmpdir):
+    serial = tmpdir.mkdir('serial')
+    serial.join(shell_runner.SERIAL_MARKER).write('')
+    log = str(tmpdir.join('log'))
+    tests = [
+        script(serial, str(n), 'echo start >> %s; sleep 0.2; echo end >> %s' % (log, log))
+        for n in range(3)
+    ]
+    results = shell_runner.run_tests(tests, {}, 3)
+    assert all(t.success for t in results)
+    assert open(log).read().split() == ['start', 'end'] * 3
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+def wait_dead(pid, limit=5):
+    until = time.time() + limit
+    while alive(pid) and time.time() < until:
+        time.sleep(0.05)
+    return not alive(pid)
+
+
+def test_run_tests_test_timeout_kills_process_group(shell_runner, tmpdir):
+    pidfile = str(tmpdir.join('pid'))
+    tests = [
+        script(tmpdir, '1', 'sleep 60 & echo $! > %s; wait' % pidfile),
+        script(tmpdir, '2', 'exit 0')
+    ]
+    start = time.time()
+    results = shell_runner.run_tests(tests, {}, 2, test_timeout=0.5, continue_on_fail=True)
+    assert time.time() - start < 10
+    assert not results[0].success
+    assert 'timed out' in results[0].killed
+    assert results[1].success
+    assert wait_dead(int(open(pidfile).read()))
+
+
+def test_run_tests_total_timeout(shell_runner, tmpdir, capsys):
+    tests = [
+        script(tmpdir, '1', 'trap "" TERM; sleep 60'),
+        script(tmpdir, '2', 'exit 0')
+    ]
+    with mock.patch.object(shell_runner, 'KILL_GRACE_PERIOD', 0.3):
+        results = shell_runner.run_tests(tests, {}, 1, timeout_val=0.5, continue_on_fail=True)
+    assert results[0].killed
+    assert results[1].process is None
+    assert not any(t.success for t in results)
+    assert 'skipped' in capsys.readouterr()[0]
+
+
+def test_run_tests_interrupted_kills_stubborn_tests(shell_runner, tmpdir):
+    pidfile = str(tmpdir.join('pid'))
+    tests = [script(tmpdir, '1', 'trap "" TERM; echo $$ > %s; sleep 60' % pidfile)]
+    real_sleep = time.sleep
+    interrupted = []
+
+    def interrupt(delay):
+        if not interrupted and os.path.exists(pidfile) and os.path.getsize(pidfile):
+            interrupted.append(True)
+            raise KeyboardInterrupt
+        real_sleep(delay)
+
+    with mock.patch.object(shell_runner, 'KILL_GRACE_PERIOD', 0.3):
+        with mock.patch.object(shell_runner.time, 'sleep', side_effect=interrupt):
+            with pytest.raises(KeyboardInterrupt):
+                shell_runner.run_tests(tests, {}, 1)
+    assert wait_dead(int(open(pidfile).read()))
+
+
+def test_run_tests_stops_starting_after_failure(shell_runner, tmpdir):
+    tests = [
+        script(tmpdir, '1', 'exit 1'),
+        script(tmpdir, '2', 'sleep 0.5'),
+        script(tmpdir, '3', 'exit 0')
+    ]
+    results = shell_runner.run_tests(tests, {}, 1)
+    assert results[2].process is None
 
 
 if __name__ == "__main__":
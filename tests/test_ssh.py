@@ -198,6 +198,91 @@ def test_info_2(ssh, key):
     del s
 
 
+@pytest.fixture
+def mux(ssh):
+    s = ssh.SSH('192.168.0.1', 'user', 'secret', port=2222, multiplexing=True)
+    yield s
+    s.stop_master()
+
+
+def test_command_line_multiplexing(mux):
+    cmdline = mux.command_line()
+    assert "ControlMaster=no" in cmdline
+    assert "ControlPath=%s" % mux.control_path() in cmdline
+    assert cmdline[-1] == mux.user_host_and_port()
+
+
+def test_command_line_no_multiplexing(ssh):
+    s = ssh.SSH('192.168.0.1', 'user', 'secret')
+    assert 'Control' not in " ".join(s.command_line())
+    assert s.control_dir is None
+
+
+def test_config_multiplexing(mux):
+    data = open(mux.config(), 'r').read()
+    assert "ControlMaster no" in data
+    assert "ControlPath %s" % mux.control_path() in data
+
+
+def test_ensure_master_disabled(ssh):
+    s = ssh.SSH('192.168.0.1', 'user', 'secret')
+    with mock.patch.object(ssh.subprocess, 'call') as mock_call:
+        assert s.ensure_master() is False
+    assert not mock_call.called
+
+
+def test_ensure_master_alive(ssh, mux):
+    with mock.patch.object(ssh.subprocess, 'call', return_value=0) as mock_call:
+        assert mux.ensure_master() is True
+    assert mock_call.call_count == 1
+    cmdline = mock_call.call_args[0][0]
+    assert cmdline[-3:] == ['-p', '2222', 'user@192.168.0.1']
+    assert '-O' in cmdline and 'check' in cmdline
+
+
+def test_ensure_master_restarts_dead_master(ssh, mux):
+    open(mux.control_path(), 'w').close()  # stale socket
+    with mock.patch.object(ssh.subprocess, 'call', side_effect=[255, 0]) as mock_call:
+        assert mux.ensure_master() is True
+    assert not os.path.exists(mux.control_path())
+    cmdline = mock_call.call_args[0][0]
+    assert 'ControlMaster=yes' in cmdline
+    assert 'ControlPersist=%s' % ssh.CONTROL_PERSIST in cmdline
+    assert '-f' in cmdline and '-N' in cmdline
+    assert mock_call.call_args[1]['stdout'] is not None  # not our stdout
+
+
+def test_ensure_master_fallback(ssh, mux):
+    with mock.patch.object(ssh.subprocess, 'call', return_value=255):
+        assert mux.ensure_master() is False
+    assert "ControlMaster=no" in mux.command_line()
+
+
+def test_share(ssh):
+    s = ssh.SSH('192.168.0.1', 'user', 'secret', multiplexing=True)
+    with mock.patch.object(s, 'ensure_master') as ensure_master:
+        s.share()
+        assert ensure_master.called
+    assert os.path.exists(s.key_file())
+    assert os.path.exists(s.config())
+
+
+def test_stop_master(ssh, mux):
+    control_dir = os.path.dirname(mux.control_path())
+    open(mux.control_path(), 'w').close()
+    with mock.patch.object(ssh.subprocess, 'call', return_value=0) as mock_call:
+        mux.stop_master()
+    assert 'exit' in mock_call.call_args[0][0]
+    assert not os.path.exists(control_dir)
+    assert mux.control_dir is None
+
+
+def test_stop_master_not_started(ssh, mux):
+    with mock.patch.object(ssh.subprocess, 'call') as mock_call:
+        mux.stop_master()
+    assert not mock_call.called
+
+
 if __name__ == "__main__":
     ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
     currentdir = os.path.dirname(ourfilename)
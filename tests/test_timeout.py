@@ -34,6 +34,97 @@ def test_timeout_check_no_error(timeout):
         pass
 
 
+def test_timeout_in_thread_does_not_use_signals(timeout):
+    import threading
+    errors = []
+
+    def worker():
+        try:
+            with timeout.timeout(1):
+                pass
+        except Exception as e:
+            errors.append(e)
+
+    with mock.patch.object(timeout.signal, 'setitimer') as mock_alarm:
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+    assert not errors
+    assert not mock_alarm.called
+
+
+def test_timeout_subsecond(timeout):
+    start = time.time()
+    with pytest.raises(timeout.TimeoutError):
+        with timeout.timeout(0.2):
+            time.sleep(2)
+    assert time.time() - start < 1
+
+
+def test_timeout_nested_inner_fires(timeout):
+    with timeout.timeout(5) as outer:
+        with pytest.raises(timeout.TimeoutError):
+            with timeout.timeout(0.1):
+                time.sleep(1)
+        assert timeout.current() is outer
+        assert 4 < timeout.remaining() <= 5
+
+
+def test_timeout_nested_outer_survives_inner(timeout):
+    with pytest.raises(timeout.TimeoutError):
+        with timeout.timeout(0.3):
+            with timeout.timeout(0.1):
+                pass
+            time.sleep(2)
+
+
+def test_timeout_nested_inner_limited_by_outer(timeout):
+    with timeout.timeout(1) as outer:
+        with timeout.timeout(10) as inner:
+            assert inner.deadline == outer.deadline
+            assert inner.remaining() <= 1
+
+
+def test_timeout_no_deadline(timeout):
+    assert timeout.current() is None
+    assert timeout.remaining() is None
+    assert timeout.remaining(sentinel.default) is sentinel.default
+    timeout.check()
+
+
+def test_timeout_check_in_thread(timeout):
+    import threading
+    errors = []
+
+    def worker():
+        try:
+            with timeout.timeout(0.1):
+                time.sleep(0.2)
+                timeout.check()
+        except Exception as e:
+            errors.append(e)
+
+    t = threading.Thread(target=worker)
+    t.start()
+    t.join()
+    assert isinstance(errors[0], timeout.TimeoutError)
+    assert timeout.current() is None
+
+
+def test_timeout_threads_are_independent(timeout):
+    import threading
+    seen = []
+
+    def worker():
+        seen.append(timeout.current())
+
+    with timeout.timeout(5):
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+    assert seen == [None]
+
+
 def test_timeout_bad_signal(timeout):
     t = timeout.timeout(1)
     with pytest.raises(RuntimeError):
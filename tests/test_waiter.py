@@ -0,0 +1,130 @@
+#!/usr/bin/python
+import os
+import inspect
+import sys
+import pytest
+import mock
+
+
+@pytest.fixture
+def waiter():
+    from dibctl import waiter
+    return waiter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_delays_grow_to_max(waiter):
+    w = waiter.Waiter('test', initial_delay=1, max_delay=4, backoff=2, jitter=0)
+    delays = w.delays()
+    assert [next(delays) for i in range(5)] == [1, 2, 4, 4, 4]
+
+
+def test_delays_jitter(waiter):
+    w = waiter.Waiter('test', initial_delay=1, jitter=0.5)
+    delay = next(w.delays())
+    assert 0.5 <= delay <= 1.5
+
+
+def test_delays_jitter_does_not_exceed_max(waiter):
+    w = waiter.Waiter('test', initial_delay=4, max_delay=4, jitter=0.5)
+    delays = w.delays()
+    with mock.patch.object(waiter.random, 'uniform', return_value=1.5):
+        assert [next(delays) for i in range(3)] == [4, 4, 4]
+
+
+def test_wait_success(waiter, clock):
+    results = [None, None, 'done']
+    timings = waiter.Timings()
+    w = waiter.Waiter(
+        'test', timeout=60, initial_delay=1, backoff=2, jitter=0,
+        timings=timings, clock=clock.time, sleep=clock.sleep
+    )
+    assert w.wait(lambda: results.pop(0)) == 'done'
+    assert clock.sleeps == [1, 2]
+    assert w.attempts == 3
+    assert w.elapsed == 3
+    assert timings.phases == [('test', 3)]
+
+
+def test_wait_timeout(waiter, clock):
+    w = waiter.Waiter(
+        'test', timeout=10, initial_delay=4, backoff=1, jitter=0,
+        clock=clock.time, sleep=clock.sleep
+    )
+    assert w.wait(lambda: False) is None
+    assert clock.sleeps == [4, 4, 2]
+    assert w.elapsed == 10
+
+
+def test_wait_no_timeout(waiter, clock):
+    results = [False] * 20 + [True]
+    w = waiter.Waiter('test', clock=clock.time, sleep=clock.sleep)
+    assert w.wait(lambda: results.pop(0)) is True
+    assert max(clock.sleeps) <= waiter.MAX_DELAY * (1 + waiter.JITTER)
+
+
+def test_wait_error(waiter, clock):
+    w = waiter.Waiter('test', clock=clock.time, sleep=clock.sleep)
+    with pytest.raises(ValueError):
+        w.wait(mock.MagicMock(side_effect=ValueError))
+
+
+def test_timings_report(waiter, capsys):
+    timings = waiter.Timings()
+    timings.report()
+    assert capsys.readouterr()[0] == ''
+    timings.add('boot', 12.34)
+    timings.report()
+    assert 'boot' in capsys.readouterr()[0]
+
+
+def test_waiter_respects_thread_deadline(waiter):
+    from dibctl import timeout
+    import threading
+    errors = []
+
+    def worker():
+        w = waiter.Waiter('test', initial_delay=0.01, max_delay=0.01)
+        try:
+            with timeout.timeout(0.1):
+                w.wait(lambda: False)
+        except Exception as e:
+            errors.append(e)
+
+    t = threading.Thread(target=worker)
+    t.start()
+    t.join()
+    assert isinstance(errors[0], timeout.TimeoutError)
+
+
+if __name__ == "__main__":
+    ourfilename = os.path.abspath(inspect.getfile(inspect.currentframe()))
+    currentdir = os.path.dirname(ourfilename)
+    parentdir = os.path.dirname(currentdir)
+    file_to_test = os.path.join(
+        parentdir,
+        os.path.basename(parentdir),
+        os.path.basename(ourfilename).replace("test_", '', 1)
+    )
+    pytest.main([
+     "-vv",
+     "--cov", file_to_test,
+     "--cov-report", "term-missing"
+     ] + sys.argv)